@@ -0,0 +1,425 @@
+"""
+    Scale benchmark of the copy and save pipelines against synthetic fleets.
+
+    Every scenario generates a fleet in moto: DB instances tagged
+    Failsafe=true, each with automated snapshots taken daily and failsafe
+    manual snapshots retained for as many days. The copy pipeline then runs
+    rdscopysnapshots.handler with the scheduled event of the fleet scan, and
+    the save pipeline runs rdssavesnapshot.handler with one SNS record per
+    instance. The retention pipeline runs rdssavesnapshot.handler with its
+    scheduled event. Each pipeline reports one JSON line with its wall time,
+    its peak memory (tracemalloc, moto included), the RDS and SNS API calls
+    it made per operation and the outcome of the handler.
+
+    moto 3 lists every snapshot as manual, ignores MaxRecords and lacks
+    modify_db_snapshot_attribute and shared snapshots, so the RDS client
+    handed to the handlers is wrapped by MotoRdsAdapter: it classifies
+    'rds:' snapshots as automated, pages the listings, and serves the shared
+    snapshots of the Failsafe account. moto renders every snapshot of a
+    response through a freshly compiled template, so the adapter reads the
+    listings and deletes the snapshots in the moto backend directly, and
+    reads a listing once rather than once per page; the large scenario
+    would not finish otherwise. The moto backend is not thread safe,
+    so the adapter serialises the calls of the parallel backups and
+    deletions. The handler runs on the VirtualClock of rdssimulator: its
+    snapshot waiters are handed the clock, and time.time and time.sleep
+    read and advance it while the handler runs, so waits on copies are
+    counted in virtual_wait_s rather than spent and copy durations are
+    measured in virtual seconds. The copy quota keeps waiting on its
+    condition in real time, as its queued copies wait on the other threads
+    rather than on RDS. Logging is disabled during the runs, and the
+    metrics and spans the handlers print go to stderr, so stdout holds
+    only the JSON lines of the results.
+
+    tracemalloc slows the runs down several times, --no-memory leaves it
+    out when only wall times and call counts are of interest.
+
+    usage: python benchmark_scale.py [--scenario small] [--no-memory]
+                                     [--output scale.jsonl]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ['MOTO_RDS_SNAPSHOT_LIMIT'] = str(sys.maxsize)
+
+from boto3 import client  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+from botocore.utils import parse_timestamp  # noqa: E402
+from moto import mock_rds2, mock_sns  # noqa: E402
+from moto.core import ACCOUNT_ID  # noqa: E402
+from moto.core.utils import iso_8601_datetime_with_milliseconds  # noqa: E402
+from moto.rds.models import DatabaseSnapshot, rds_backends  # noqa: E402
+
+import rdscopysnapshots as copy_service  # noqa: E402
+import rdssavesnapshot as save_service  # noqa: E402
+from rdscopyquota import CopyQuotaScheduler  # noqa: E402
+from rdsprogress import CopyProgressEstimator  # noqa: E402
+from rdssimulator import Simulation, VirtualClock  # noqa: E402
+from rdswaiter import SnapshotWaiter, WaiterRegistry  # noqa: E402
+
+REGION = 'ap-southeast-2'
+SOURCE_ACCOUNT_ID = '129000003686'
+SCENARIOS = {
+    'small': {'instances': 10, 'automated': 35, 'manual': 31},
+    'medium': {'instances': 100, 'automated': 35, 'manual': 31},
+    'large': {'instances': 1000, 'automated': 35, 'manual': 31},
+}
+FLEET_DATE = datetime(2017, 11, 26, 18)
+
+
+class MotoRdsAdapter(object):
+    """
+    Counts the RDS calls of a pipeline and fills the gaps of moto 3
+    """
+
+    def __init__(self, rds, calls, shared_snapshots=None):
+        """
+        :param rds: the moto RDS client, its backend serves the listings
+        :param calls: Counter of the calls per operation
+        :param shared_snapshots: dict of the snapshots shared with the
+        account, by arn, to the moto snapshot each one is copied from
+        """
+        self.rds = rds
+        self.backend = rds_backends[ACCOUNT_ID][REGION]
+        self.calls = calls
+        self.shared_snapshots = shared_snapshots or {}
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        operation = getattr(self.rds, name)
+
+        def call(*args, **kwargs):
+            return self._call(name, operation, *args, **kwargs)
+        return call
+
+    def _call(self, name, operation, *args, **kwargs):
+        with self._lock:
+            self.calls['rds.' + name] += 1
+            return operation(*args, **kwargs)
+
+    def describe_db_snapshots(self, **kwargs):
+        """
+        Pages the listings moto returns whole. The first page of a listing
+        reads its snapshots and keeps them for the thread, the following
+        pages are served from them, so a listing of the account reads the
+        snapshots once rather than once per page.
+        """
+        if kwargs.get('DBSnapshotIdentifier'):
+            return self._call(
+                'describe_db_snapshots', self.rds.describe_db_snapshots,
+                DBSnapshotIdentifier=kwargs['DBSnapshotIdentifier'])
+        listing = (threading.current_thread().ident,
+                   kwargs.get('SnapshotType'),
+                   kwargs.get('DBInstanceIdentifier'),
+                   json.dumps(kwargs.get('Filters'), sort_keys=True))
+        if kwargs.get('Marker') and listing in self._listings:
+            self._call('describe_db_snapshots', lambda: None)
+            snapshots = self._listings[listing]
+        else:
+            snapshots = self._list_snapshots(**kwargs)
+        start = int(kwargs.get('Marker') or 0)
+        end = start + kwargs.get('MaxRecords', 100)
+        response = {'DBSnapshots': snapshots[start:end]}
+        if end < len(snapshots):
+            response['Marker'] = str(end)
+            self._listings[listing] = snapshots
+        else:
+            self._listings.pop(listing, None)
+        return response
+
+    def _list_snapshots(self, **kwargs):
+        """
+        Lists the snapshots of a describe_db_snapshots call. moto renders
+        every snapshot through a freshly compiled template, which takes
+        hours for the tens of thousands of the large scenario, so the
+        listings without Filters read the moto backend instead.
+        """
+        snapshot_type = kwargs.get('SnapshotType')
+        if snapshot_type == 'shared':
+            self._call('describe_db_snapshots', lambda: None)
+            return [snapshot for snapshot, _ in
+                    self.shared_snapshots.values()]
+        if kwargs.get('Filters'):
+            filters = {'Filters': kwargs['Filters']}
+            if kwargs.get('DBInstanceIdentifier'):
+                filters['DBInstanceIdentifier'] = \
+                    kwargs['DBInstanceIdentifier']
+            listed = self._call('describe_db_snapshots',
+                                self.rds.describe_db_snapshots,
+                                **filters)['DBSnapshots']
+        else:
+            listed = self._call('describe_db_snapshots',
+                                self._backend_snapshots,
+                                kwargs.get('DBInstanceIdentifier'))
+        snapshots = []
+        for snapshot in listed:
+            snapshot['SnapshotType'] = 'automated' \
+                if snapshot['DBSnapshotIdentifier'].startswith('rds:') \
+                else 'manual'
+            if snapshot_type in (None, snapshot['SnapshotType']):
+                snapshots.append(snapshot)
+        return snapshots
+
+    def _backend_snapshots(self, instance=None):
+        """
+        :param instance: identifier of the DB instance the snapshots are
+        listed for, every instance when None
+        :return: the snapshots of the moto backend
+        """
+        return [snapshot_payload(snapshot)
+                for snapshot in list(self.backend.database_snapshots.values())
+                if instance in (None,
+                                snapshot.database.db_instance_identifier)]
+
+    def delete_db_snapshot(self, **kwargs):
+        """
+        Deletes the snapshot from the moto backend, moto would render the
+        deleted snapshot through a freshly compiled template as well
+        """
+        return self._call('delete_db_snapshot', self._delete_snapshot,
+                          kwargs['DBSnapshotIdentifier'])
+
+    def _delete_snapshot(self, snapshot_id):
+        if snapshot_id not in self.backend.database_snapshots:
+            raise ClientError({'Error': {
+                'Code': 'DBSnapshotNotFound',
+                'Message': 'DBSnapshot {} not found.'.format(snapshot_id)}},
+                'DeleteDBSnapshot')
+        return {'DBSnapshot': snapshot_payload(
+            self.backend.database_snapshots.pop(snapshot_id))}
+
+    def copy_db_snapshot(self, **kwargs):
+        source = kwargs['SourceDBSnapshotIdentifier']
+        if source in self.shared_snapshots:
+            kwargs['SourceDBSnapshotIdentifier'] = \
+                self.shared_snapshots[source][1]
+        return self._call('copy_db_snapshot', self.rds.copy_db_snapshot,
+                          **kwargs)
+
+    def modify_db_snapshot_attribute(self, **kwargs):
+        self._call('modify_db_snapshot_attribute', lambda: None)
+        return {'DBSnapshotAttributesResult': {
+            'DBSnapshotIdentifier': kwargs['DBSnapshotIdentifier'],
+            'DBSnapshotAttributes': [{
+                'AttributeName': kwargs['AttributeName'],
+                'AttributeValues': kwargs.get('ValuesToAdd', [])}]}}
+
+
+
+def snapshot_payload(snapshot):
+    """
+    :param snapshot: DatabaseSnapshot of the moto backend
+    :return: the fields of the snapshot the moto describe would return and
+    the modules read
+    """
+    return {'DBSnapshotIdentifier': snapshot.snapshot_id,
+            'DBInstanceIdentifier': snapshot.database.db_instance_identifier,
+            'DBSnapshotArn': snapshot.snapshot_arn,
+            'SnapshotCreateTime': parse_timestamp(snapshot.created_at),
+            'AllocatedStorage': snapshot.database.allocated_storage,
+            'Status': snapshot.status,
+            'PercentProgress': 100}
+
+def automated_snapshot_id(instance, age):
+    return 'rds:{}-{:%Y-%m-%d-%H-%M}'.format(instance,
+                                            FLEET_DATE - timedelta(age))
+
+
+def failsafe_snapshot_id(instance, age):
+    return 'failsafe-{}-{:%Y-%m-%d-%H-%M}'.format(
+        instance, FLEET_DATE - timedelta(age))
+
+
+def generate_fleet(instances, automated, manual):
+    """
+    Creates the tagged DB instances in moto and injects their snapshots
+    straight into the moto backend, creating tens of thousands of them
+    through the API would dominate the benchmark
+    :return: the moto RDS client and the names of the instances
+    """
+    rds = client('rds', region_name=REGION)
+    backend = rds_backends[ACCOUNT_ID][REGION]
+    now = datetime.now()
+    names = []
+    for number in range(instances):
+        name = 'failsafe-database-{:04d}'.format(number)
+        rds.create_db_instance(DBInstanceIdentifier=name,
+                               AllocatedStorage=10,
+                               Engine='postgres',
+                               DBInstanceClass='db.m1.small',
+                               MasterUsername='root_failsafe',
+                               MasterUserPassword='hunter_failsafe',
+                               Tags=[{'Key': 'Failsafe', 'Value': 'true'}])
+        database = backend.databases[name]
+        snapshots = [(automated_snapshot_id(name, age), age)
+                     for age in range(automated)] + \
+                    [(failsafe_snapshot_id(name, age), age)
+                     for age in range(1, manual + 1)]
+        for snapshot_id, age in snapshots:
+            snapshot = DatabaseSnapshot(database, snapshot_id, [])
+            snapshot.created_at = iso_8601_datetime_with_milliseconds(
+                now - timedelta(age))
+            backend.database_snapshots[snapshot_id] = snapshot
+        names.append(name)
+    return rds, names
+
+
+def shared_snapshot_id(instance):
+    return 'failsafe-' + automated_snapshot_id(instance, 0)[4:]
+
+
+def shared_snapshots_of(instances):
+    """
+    :return: the failsafe snapshot the source account shared for each
+    instance, by arn, with the moto snapshot its copy is made from
+    """
+    shared_snapshots = {}
+    for name in instances:
+        arn = 'arn:aws:rds:{}:{}:snapshot:{}'.format(
+            REGION, SOURCE_ACCOUNT_ID, shared_snapshot_id(name))
+        shared_snapshots[arn] = ({'DBSnapshotIdentifier': arn,
+                                  'DBInstanceIdentifier': name,
+                                  'SnapshotType': 'shared',
+                                  'Status': 'available',
+                                  'SnapshotCreateTime': FLEET_DATE},
+                                 automated_snapshot_id(name, 0))
+    return shared_snapshots
+
+
+def save_event_of(instances):
+    return {'Records': [{
+        'EventSource': 'aws:sns',
+        'Sns': {'Message': json.dumps({
+            'Instance': name,
+            'FailsafeSnapshotID': shared_snapshot_id(name)})}}
+        for name in instances]}
+
+
+def counting_client_factory(rds, calls):
+    """
+    :return: client factory serving the adapted RDS client and counting
+    the calls of every other client through botocore events
+    """
+    def factory(service_name, **kwargs):
+        if service_name == 'rds':
+            return rds
+        service_client = client(service_name, **kwargs)
+        service_client.meta.events.register(
+            'before-call.*.*',
+            lambda model, **_: calls.update(
+                ['{}.{}'.format(service_name, model.name)]))
+        return service_client
+    return factory
+
+
+def prepare(service, factory, clock):
+    """
+    Points a Lambda module at the moto clients and the virtual clock
+    :param clock: VirtualClock the snapshot waiters run on
+    """
+    service.client = factory
+    service.clients.clear()
+    service.copy_quota = CopyQuotaScheduler()
+    service.snapshot_waiters = WaiterRegistry(
+        lambda rds: SnapshotWaiter(
+            rds, clock=clock.time, sleep=clock.sleep,
+            estimator=CopyProgressEstimator(clock=clock.time)))
+
+
+def run_pipeline(scenario, pipeline, instances, automated, manual,
+                 memory=True):
+    """
+    Runs one pipeline against a fresh fleet
+    :param memory: whether peak memory is traced
+    :return: dict of the measurements of the run
+    """
+    with mock_rds2(), mock_sns():
+        calls = Counter()
+        rds, names = generate_fleet(instances, automated, manual)
+        client('sns', region_name=REGION).create_topic(
+            Name=copy_service.SNS_RDS_SAVE_TOPIC)
+        if pipeline == 'copy':
+            service, event = copy_service, {'detail-type': 'Scheduled Event',
+                                            'source': 'aws.events'}
+            copy_service._db_instance_tags.clear()
+            copy_service._sns_topic_arns.clear()
+            adapter = MotoRdsAdapter(rds, calls)
+        elif pipeline == 'retention':
+            service, event = save_service, {'detail-type': 'Scheduled Event',
+                                            'source': 'aws.events'}
+            adapter = MotoRdsAdapter(rds, calls)
+        else:
+            service, event = save_service, save_event_of(names)
+            adapter = MotoRdsAdapter(rds, calls, shared_snapshots_of(names))
+        simulation = Simulation(VirtualClock())
+        prepare(service, counting_client_factory(adapter, calls),
+                simulation.clock)
+        if memory:
+            tracemalloc.start()
+        started = time.time()
+        with simulation.running(), redirect_stdout(sys.stderr):
+            try:
+                outcome = service.handler(event, None)
+            except Exception as e:
+                outcome = '{}: {}'.format(type(e).__name__, e)
+        wall_time = time.time() - started
+        peak = None
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    if isinstance(outcome, list):
+        outcome = dict(Counter(result['Status'] for result in outcome))
+    return {'scenario': scenario,
+            'pipeline': pipeline,
+            'instances': instances,
+            'snapshots': instances * (automated + manual),
+            'wall_s': round(wall_time, 2),
+            'virtual_wait_s': round(simulation.clock.elapsed(), 1),
+            'peak_memory_mb': round(peak / 1024.0 / 1024.0, 1)
+            if peak is not None else None,
+            'api_calls': dict(sorted(calls.items())),
+            'api_calls_total': sum(calls.values()),
+            'outcome': outcome}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='scenario to run, small by default')
+    parser.add_argument('--pipeline', action='append',
+                        choices=['copy', 'save', 'retention'])
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='do not trace peak memory')
+    parser.add_argument('--output', help='JSON lines file to append to')
+    options = parser.parse_args(arguments)
+    logging.disable(logging.CRITICAL)
+    for scenario in options.scenario or ['small']:
+        for pipeline in options.pipeline or ['copy', 'save', 'retention']:
+            result = json.dumps(run_pipeline(scenario, pipeline,
+                                             memory=options.memory,
+                                             **SCENARIOS[scenario]),
+                                sort_keys=True)
+            print(result)
+            sys.stdout.flush()
+            if options.output:
+                with open(options.output, 'a') as output:
+                    output.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
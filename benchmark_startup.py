@@ -0,0 +1,158 @@
+"""
+    Startup benchmark of the rdscopysnapshots and rdssavesnapshot Lambda
+    functions.
+
+    Every run starts a fresh interpreter, as a Lambda cold start does, and
+    records for each module:
+        import_ms: cumulative import time of the module reported by
+                   python -X importtime
+        first_handler_ms: time of the first handler call, with the AWS
+                          services mocked by moto, including the imports
+                          and client creation deferred to first use. The
+                          call has to succeed, see SETUP
+    The median of the runs is printed as one JSON line per module, and
+    appended to --output when given, so regressions show up as numbers.
+
+    usage: python benchmark_startup.py [--runs 5] [--output startup.jsonl]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ('rdscopysnapshots', 'rdssavesnapshot')
+
+FIRST_HANDLER_SCRIPT = '''
+import json, sys, time
+import boto3
+from moto import mock_rds2, mock_sns
+with mock_rds2(), mock_sns():
+    setup = boto3.session.Session(region_name='ap-southeast-2')
+    rds = setup.client('rds')
+    rds.create_db_instance(
+        DBInstanceIdentifier='failsafe_database', AllocatedStorage=10,
+        Engine='postgres', DBInstanceClass='db.m1.small',
+        MasterUsername='root_failsafe', MasterUserPassword='hunter_failsafe',
+        Tags=[{{'Key': 'Failsafe', 'Value': 'true'}}])
+    rds.create_db_snapshot(DBInstanceIdentifier='failsafe_database',
+                           DBSnapshotIdentifier={snapshot!r})
+    setup.client('sns').create_topic(
+        Name='reptileinx_save_failsafe_snapshot_sns_topic')
+    started = time.time()
+    import {module} as service
+    results = service.handler({event}, None)
+    failed = [result for result in results if result['Status'] == 'failed']
+    if failed:
+        raise RuntimeError('First handler call failed: {{}}'.format(failed))
+    print(json.dumps((time.time() - started) * 1000))
+'''
+
+# The first handler call of each module runs against the snapshot SETUP
+# creates in moto, with the environment that lets it succeed there. The
+# copy Lambda copies and notifies without polling the copy, and without
+# sharing it, which moto does not implement. The save Lambda finds the
+# local copy of a redelivered record. A handler that raises or fails a
+# backup stops the benchmark.
+SETUP = {
+    'rdscopysnapshots': {
+        'snapshot': 'rds:failsafe-database-2017-11-26',
+        'event': {'detail-type': 'Scheduled Event', 'source': 'aws.events',
+                  'detail': {}},
+        'environment': {'FAILSAFE_ACCOUNT_ID': '',
+                        'FAILSAFE_COMPLETION_MODE': 'event'}},
+    'rdssavesnapshot': {
+        'snapshot': 'failsafe-failsafe-database-2017-11-26',
+        'event': {'Records': [{
+            'EventSource': 'aws:sns',
+            'Sns': {'Message': json.dumps({
+                'Instance': 'failsafe_database',
+                'FailsafeSnapshotID':
+                    'failsafe-failsafe-database-2017-11-26'})}}]},
+        'environment': {'FAILSAFE_COPY_MODE': 'incremental'}},
+}
+
+
+def measure_import_ms(module):
+    """
+    :param module: name of the module to import
+    :return: cumulative import time of the module in milliseconds
+    """
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True,
+        env=_environment()).stderr
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000.0
+    raise RuntimeError('No import time reported for {}'.format(module))
+
+
+def measure_first_handler_ms(module):
+    """
+    :param module: name of the module whose handler is called
+    :return: milliseconds from the import to the return of the first
+    handler call
+    """
+    setup = SETUP[module]
+    script = FIRST_HANDLER_SCRIPT.format(module=module,
+                                         snapshot=setup['snapshot'],
+                                         event=repr(setup['event']))
+    run = subprocess.run([sys.executable, '-c', script],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True,
+                         env=_environment(setup['environment']))
+    if run.returncode:
+        raise RuntimeError('First handler call of {} failed:\n{}'
+                           .format(module, run.stderr))
+    return json.loads(run.stdout.splitlines()[-1])
+
+
+def benchmark(module, runs):
+    """
+    :param module: name of the module to benchmark
+    :param runs: number of fresh interpreters measured
+    :return: dict of the median timings of the module
+    """
+    return {
+        'module': module,
+        'runs': runs,
+        'python': '{}.{}'.format(*sys.version_info[:2]),
+        'timestamp': int(time.time()),
+        'import_ms': round(statistics.median(
+            measure_import_ms(module) for _ in range(runs)), 1),
+        'first_handler_ms': round(statistics.median(
+            measure_first_handler_ms(module) for _ in range(runs)), 1),
+    }
+
+
+def _environment(overrides=None):
+    environment = dict(os.environ, **(overrides or {}))
+    environment.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    environment.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    environment.setdefault('AWS_DEFAULT_REGION', 'ap-southeast-2')
+    environment['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    return environment
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='JSON lines file to append to')
+    parser.add_argument('modules', nargs='*', default=list(MODULES))
+    options = parser.parse_args(arguments)
+    for module in options.modules:
+        result = json.dumps(benchmark(module, options.runs), sort_keys=True)
+        print(result)
+        if options.output:
+            with open(options.output, 'a') as output:
+                output.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
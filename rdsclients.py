@@ -0,0 +1,124 @@
+"""
+    Boto3 client reuse shared by the rdscopysnapshots and rdssavesnapshot
+    Lambda functions.
+
+    Creating a client is one of the most expensive steps of a short Lambda
+    invocation. ClientRegistry keeps one client per (service, region, role)
+    for the life of the container, so warm invocations and the threads of
+    the parallel backups and deletions share them. Clients are created with
+    a botocore Config sized for those thread pools, with TCP keep-alive and
+    the retry mode of CLIENT_RETRY_MODE.
+
+    boto3 and botocore.config are imported on first use rather than at
+    module load: boto3 alone is most of the import time of the Lambda
+    modules, and events that need no client never pay for it.
+"""
+import os
+import threading
+import time
+
+CLIENT_MAX_POOL_CONNECTIONS = int(
+    os.getenv('CLIENT_MAX_POOL_CONNECTIONS', '16'))
+CLIENT_RETRY_MODE = os.getenv('CLIENT_RETRY_MODE', 'standard')
+CLIENT_MAX_ATTEMPTS = int(os.getenv('CLIENT_MAX_ATTEMPTS', '5'))
+ROLE_SESSION_NAME = 'failsafe-rds-backup'
+CREDENTIALS_REFRESH_MARGIN_SECONDS = 300
+
+
+def client(*args, **kwargs):
+    """
+    boto3.client, importing boto3 on first use
+    :return: the Boto3 client
+    """
+    import boto3
+    return boto3.client(*args, **kwargs)
+
+
+def client_config():
+    """
+    :return: the botocore Config every registry client is created with
+    """
+    from botocore.config import Config
+    return Config(max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+                  tcp_keepalive=True,
+                  retries={'mode': CLIENT_RETRY_MODE,
+                           'max_attempts': CLIENT_MAX_ATTEMPTS})
+
+
+class ClientRegistry(object):
+    """
+    Container-wide cache of Boto3 clients keyed by (service, region, role).
+    Creating clients from the default session is not thread safe, so
+    creation is serialised; the clients themselves are safe to share
+    between threads.
+    """
+
+    def __init__(self, factory, config=None, clock=time.time,
+                 on_create=None):
+        """
+        :param factory: function creating a client, e.g. boto3.client
+        :param config: botocore Config of the clients, client_config() on
+        first use when not provided
+        :param clock: function returning the current time, replaceable for
+        tests
+        :param on_create: function called with every new client, e.g. to
+        register botocore event hooks
+        """
+        self.factory = factory
+        self.config = config
+        self.clock = clock
+        self.on_create = on_create
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, service_name, region_name, role_arn=None):
+        """
+        Returns the client of the key, creating it on first use. Clients
+        of an assumed role are created again shortly before their
+        credentials expire.
+        :param service_name: e.g. 'rds' or 'sns'
+        :param region_name: the AWS region of the client
+        :param role_arn: role to assume, the Lambda role when None
+        :return: the Boto3 client
+        """
+        key = (service_name, region_name, role_arn)
+        with self._lock:
+            expiry, service_client = self._clients.get(key, (None, None))
+            if service_client is None or \
+                    (expiry is not None and expiry <= self.clock()):
+                expiry, service_client = self._create(*key)
+                if self.on_create is not None:
+                    self.on_create(service_client)
+                self._clients[key] = (expiry, service_client)
+            return service_client
+
+    def clear(self):
+        """
+        Forgets every client, e.g. after the credentials were revoked
+        """
+        with self._lock:
+            self._clients.clear()
+
+    def _create(self, service_name, region_name, role_arn):
+        if self.config is None:
+            self.config = client_config()
+        if not role_arn:
+            return None, self.factory(service_name, region_name=region_name,
+                                      config=self.config)
+        sts = self.factory('sts', region_name=region_name,
+                           config=self.config)
+        credentials = sts.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        expiry = _timestamp(credentials['Expiration']) - \
+            CREDENTIALS_REFRESH_MARGIN_SECONDS
+        return expiry, self.factory(
+            service_name, region_name=region_name, config=self.config,
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'])
+
+
+def _timestamp(expiration):
+    return expiration.timestamp() if hasattr(expiration, 'timestamp') \
+        else float(expiration)
@@ -0,0 +1,194 @@
+"""
+    Continuation of the work of an invocation in a fresh one, shared by the
+    rdscopysnapshots and rdssavesnapshot Lambda functions.
+
+    When a copy outlasts the function, or cannot get a slot of the copy
+    quota before the deadline, the pipeline serialises its state (pipeline,
+    phase to resume at, instance, snapshot ids and the attempt number) and
+    hands it to an invoker before returning. The next invocation reads the
+    state from its event and resumes at that phase, e.g. waits for the copy
+    and then shares it.
+
+    CONTINUATION_MODE picks the invoker: 'invoke' invokes the function
+    itself asynchronously, 'topic' publishes the state to
+    CONTINUATION_TOPIC_ARN, e.g. the copy topic the function subscribes to.
+    Continuations are off when it is empty. FakeInvoker keeps the states and
+    runs them with a handler, to test a chain of invocations locally. A
+    phase is resumed at most CONTINUATION_MAX_ATTEMPTS times in a row.
+"""
+import json
+import logging
+import os
+
+CONTINUATION_MODE = os.getenv('CONTINUATION_MODE', '')
+CONTINUATION_MODE_INVOKE = 'invoke'
+CONTINUATION_MODE_TOPIC = 'topic'
+CONTINUATION_TOPIC_ARN = os.getenv('CONTINUATION_TOPIC_ARN', '')
+CONTINUATION_MAX_ATTEMPTS = int(os.getenv('CONTINUATION_MAX_ATTEMPTS', '8'))
+CONTINUATION_KEY = 'Continuation'
+PIPELINE_COPY = 'copy'
+PIPELINE_SAVE = 'save'
+PHASE_COPY = 'copy'
+PHASE_WAIT = 'wait'
+
+logger = logging.getLogger()
+
+
+class LambdaInvoker(object):
+    """
+    Invokes a Lambda function asynchronously with the state as its event
+    """
+
+    def __init__(self, lambda_client, function_name):
+        """
+        :param lambda_client: the Boto3 Lambda client
+        :param function_name: name or ARN of the function to invoke
+        """
+        self.lambda_client = lambda_client
+        self.function_name = function_name
+
+    def invoke(self, payload):
+        self.lambda_client.invoke(FunctionName=self.function_name,
+                                  InvocationType='Event',
+                                  Payload=json.dumps(payload))
+
+
+class TopicInvoker(object):
+    """
+    Publishes the state to an SNS topic the function subscribes to
+    """
+
+    def __init__(self, sns, topic_arn):
+        """
+        :param sns: the Boto3 SNS client
+        :param topic_arn: ARN of the topic
+        """
+        self.sns = sns
+        self.topic_arn = topic_arn
+
+    def invoke(self, payload):
+        self.sns.publish(TopicArn=self.topic_arn, Message=json.dumps(payload))
+
+
+class FakeInvoker(object):
+    """
+    Keeps the states instead of sending them, for local tests
+    """
+
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, payload):
+        self.payloads.append(json.loads(json.dumps(payload)))
+
+    def drain(self, handler, context=None, limit=100):
+        """
+        Runs the handler on every kept state, and on the states those runs
+        keep in turn, like a chain of invocations would
+        :param handler: the Lambda handler
+        :param context: the Lambda context of every run
+        :param limit: maximum number of runs
+        :return: list of what every run of the handler returned
+        """
+        results = []
+        while self.payloads and len(results) < limit:
+            results.append(handler(self.payloads.pop(0), context))
+        return results
+
+
+def continuation(pipeline, phase, attempt, **state):
+    """
+    :param pipeline: the function resuming the work, PIPELINE_COPY or
+    PIPELINE_SAVE
+    :param phase: the phase to resume at, PHASE_COPY or PHASE_WAIT
+    :param attempt: number of the continuations of the phase so far
+    :param state: what the phase needs e.g. Instance and FailsafeSnapshotID
+    :return: the event of the continuation
+    """
+    payload = dict(state, Pipeline=pipeline, Phase=phase, Attempt=attempt)
+    return {CONTINUATION_KEY: payload}
+
+
+def continue_later(invoker, pipeline, phase, attempt, **state):
+    """
+    Hands the state of the work to the next invocation
+    :param invoker: invoker of the continuation, None when they are off
+    :return: True if the continuation was sent, False when continuations
+    are off or the phase was resumed CONTINUATION_MAX_ATTEMPTS times
+    already
+    """
+    if invoker is None:
+        return False
+    if attempt > CONTINUATION_MAX_ATTEMPTS:
+        logger.error('Giving up on {} {} after {} continuations: {}'
+                     .format(pipeline, phase, attempt - 1, state))
+        return False
+    logger.info('Continuing {} at {} in a new invocation, attempt {}'
+                .format(pipeline, phase, attempt))
+    invoker.invoke(continuation(pipeline, phase, attempt, **state))
+    return True
+
+
+def continuations_enabled(invoker=None):
+    """
+    :param invoker: invoker of the continuations set by the caller, if any
+    :return: True if a phase that runs out of time is continued
+    """
+    return invoker is not None or bool(CONTINUATION_MODE)
+
+
+def read_continuations(event, pipeline):
+    """
+    Reads the states of the continuations of an event, sent directly or
+    through an SNS topic
+    :param event: the Lambda event
+    :param pipeline: the function reading the event, the continuations of
+    the other function are ignored
+    :return: list of the states, empty when the event is not a continuation
+    """
+    if not isinstance(event, dict):
+        return []
+    messages = [event] + [_read_message(record)
+                          for record in event.get('Records') or []]
+    return [message[CONTINUATION_KEY] for message in messages
+            if _is_continuation(message) and
+            message[CONTINUATION_KEY].get('Pipeline') == pipeline]
+
+
+def notification_records(event):
+    """
+    Reads the records of an event that are not continuations, so a batch
+    mixing continuations and notifications is processed whole
+    :param event: the Lambda event
+    :return: list of the other records, in the order received, empty for
+    a continuation invoked directly
+    """
+    if CONTINUATION_KEY in event:
+        return []
+    return [record for record in event['Records']
+            if not _is_continuation(_read_message(record))]
+
+
+def _read_message(record):
+    try:
+        return json.loads(record['Sns']['Message'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _is_continuation(message):
+    return isinstance(message, dict) and CONTINUATION_KEY in message
+
+
+def invoker_from_environment(new_client, context):
+    """
+    :param new_client: function returning the Boto3 client of a service
+    :param context: the Lambda context, naming the function to invoke
+    :return: the invoker of CONTINUATION_MODE, None when it is not set
+    """
+    if CONTINUATION_MODE == CONTINUATION_MODE_INVOKE:
+        return LambdaInvoker(new_client('lambda'),
+                             getattr(context, 'invoked_function_arn', None))
+    if CONTINUATION_MODE == CONTINUATION_MODE_TOPIC:
+        return TopicInvoker(new_client('sns'), CONTINUATION_TOPIC_ARN)
+    return None
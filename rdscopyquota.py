@@ -0,0 +1,214 @@
+"""
+    Copy quota scheduling shared by the rdscopysnapshots and rdssavesnapshot
+    Lambda functions.
+
+    RDS limits how many snapshot copies may be in progress per account at
+    once. CopyQuotaScheduler counts the copies in progress, admits new ones
+    while the count is under MAX_CONCURRENT_SNAPSHOT_COPIES and queues the
+    rest, first come first served, until a copy finishes or the Lambda
+    deadline is reached.
+
+    The count is the union of the manual snapshots RDS reports in progress
+    and the copies started by this process that RDS does not list yet.
+    Manual snapshots created by other means count against the quota too, so
+    the count errs on the safe side.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+from rdsinventory import iterate_snapshots
+from rdspolling import DeadlineExceeded, PollingSchedule
+
+MAX_CONCURRENT_SNAPSHOT_COPIES = int(
+    os.getenv('MAX_CONCURRENT_SNAPSHOT_COPIES', '20'))
+COPY_QUOTA_RECOUNT_SECONDS = 5
+COPY_QUOTA_MAX_RETRIES = 5
+COPY_IN_PROGRESS_STATUSES = ('creating', 'copying', 'pending')
+COPY_QUOTA_ERROR_CODES = ('SnapshotQuotaExceeded', 'Throttling',
+                          'ThrottlingException', 'RequestLimitExceeded')
+
+logger = logging.getLogger()
+
+
+class CopyNotAdmitted(DeadlineExceeded):
+    pass
+
+
+class CopyQuotaScheduler(object):
+    """
+    Bounded concurrency gate in front of copy_db_snapshot. One scheduler is
+    shared by every thread of the process; copies waiting for a slot are
+    admitted in the order they asked for one.
+    """
+
+    def __init__(self, limit=MAX_CONCURRENT_SNAPSHOT_COPIES,
+                 recount_interval=COPY_QUOTA_RECOUNT_SECONDS,
+                 clock=time.time, sleep=None):
+        """
+        :param limit: copies allowed in progress at once
+        :param recount_interval: seconds a count read from RDS is trusted
+        before a full queue reads it again
+        :param clock: function returning the current time, replaceable for
+        tests
+        :param sleep: function used to sleep while the queue is full,
+        replaceable for tests. By default the queue waits on its condition,
+        so a released slot wakes it at once
+        """
+        self.limit = limit
+        self.recount_interval = recount_interval
+        self.clock = clock
+        self.sleep = sleep
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._started = set()
+        self._observed = set()
+        self._counted_at = None
+
+    def in_flight(self):
+        """
+        :return: number of copies counted as in progress
+        """
+        with self._condition:
+            return len(self._observed | self._started)
+
+    def count(self, rds):
+        """
+        Reads the manual snapshots in progress from RDS. Copies started here
+        that RDS lists from now on are counted from the listing only. The
+        listing is read without holding the lock, so the other threads can
+        release and wait meanwhile.
+        :param rds: the Boto3 client used to interrogate AWS RDS services
+        :return: number of copies counted as in progress
+        """
+        observed, listed = set(), set()
+        for snapshot in iterate_snapshots(rds, SnapshotType='manual'):
+            listed.add(snapshot['DBSnapshotIdentifier'])
+            if snapshot.get('Status') in COPY_IN_PROGRESS_STATUSES:
+                observed.add(snapshot['DBSnapshotIdentifier'])
+        with self._condition:
+            self._observed = observed
+            self._started -= listed
+            self._counted_at = self.clock()
+            self._condition.notify_all()
+            return len(self._observed | self._started)
+
+    def admit(self, rds, snapshot_id, schedule=None):
+        """
+        Blocks until the copy to snapshot_id may start
+        :param rds: the Boto3 client used to count the copies in progress
+        :param snapshot_id: identifier of the snapshot the copy creates
+        :param schedule: PollingSchedule spacing the recounts of a full
+        queue and bounding the wait by the Lambda deadline
+        :raises CopyNotAdmitted: if no slot frees up in time
+        """
+        schedule = schedule or PollingSchedule()
+        if self.sleep:
+            schedule.sleep = lambda seconds: self._unlocked(self.sleep,
+                                                            seconds)
+        else:
+            schedule.sleep = lambda seconds: self._wait_for_room(
+                snapshot_id, seconds)
+        with self._condition:
+            self._queue.append(snapshot_id)
+            try:
+                while not self._has_room_for(rds, snapshot_id):
+                    logger.info('Copy to {} queued, {} of {} copies in '
+                                'progress'.format(snapshot_id,
+                                                  len(self._observed |
+                                                      self._started),
+                                                  self.limit))
+                    self._wait(snapshot_id, schedule)
+                self._started.add(snapshot_id)
+            finally:
+                self._queue.remove(snapshot_id)
+                self._condition.notify_all()
+
+    def release(self, snapshot_id):
+        """
+        Frees the slot of a copy that is no longer in progress
+        :param snapshot_id: identifier of the snapshot the copy created
+        """
+        with self._condition:
+            self._started.discard(snapshot_id)
+            self._observed.discard(snapshot_id)
+            self._condition.notify_all()
+
+    def copy(self, rds, context=None, **arguments):
+        """
+        Calls copy_db_snapshot once a slot is free. A quota or throttling
+        error puts the copy back in the queue after a backoff, up to
+        COPY_QUOTA_MAX_RETRIES times.
+        :param rds: the Boto3 client used to interrogate AWS RDS services
+        :param context: the Lambda context bounding the wait for a slot
+        :param arguments: copy_db_snapshot arguments
+        :return: the copy_db_snapshot response
+        :raises CopyNotAdmitted: if no slot frees up in time
+        """
+        snapshot_id = arguments['TargetDBSnapshotIdentifier']
+        schedule = PollingSchedule(context,
+                                   initial_interval=self.recount_interval)
+        retries = 0
+        while True:
+            self.admit(rds, snapshot_id, schedule)
+            try:
+                return rds.copy_db_snapshot(**arguments)
+            except ClientError as e:
+                self.release(snapshot_id)
+                if e.response['Error']['Code'] not in \
+                        COPY_QUOTA_ERROR_CODES or \
+                        retries >= COPY_QUOTA_MAX_RETRIES:
+                    raise
+                retries += 1
+                logger.warn('Copy to {} refused by RDS ({}), queued again'
+                            .format(snapshot_id,
+                                    e.response['Error']['Code']))
+                with self._condition:
+                    self._counted_at = None
+                    self._wait(snapshot_id, schedule)
+
+    def _unlocked(self, function, *arguments):
+        self._condition.release()
+        try:
+            return function(*arguments)
+        finally:
+            self._condition.acquire()
+
+    def _wait_for_room(self, snapshot_id, seconds):
+        """
+        Waits on the condition for the interval of the schedule. The other
+        threads notify it on every release and admission, a wake-up only
+        ends the wait once the copy may have a slot, so the wait counts as
+        one attempt of the schedule whatever the number of wake-ups.
+        """
+        due = self.clock() + seconds
+        while not self._may_have_room(snapshot_id):
+            left = due - self.clock()
+            if left <= 0 or not self._condition.wait(left):
+                return
+
+    def _may_have_room(self, snapshot_id):
+        return bool(self._queue) and self._queue[0] == snapshot_id and \
+            len(self._observed | self._started) < self.limit
+
+    def _has_room_for(self, rds, snapshot_id):
+        if self._queue[0] != snapshot_id:
+            return False
+        in_flight = len(self._observed | self._started)
+        if self._counted_at is None or \
+                (in_flight >= self.limit and
+                 self.clock() - self._counted_at >= self.recount_interval):
+            self._unlocked(self.count, rds)
+            in_flight = len(self._observed | self._started)
+        return in_flight < self.limit
+
+    def _wait(self, snapshot_id, schedule):
+        try:
+            schedule.wait()
+        except DeadlineExceeded as e:
+            raise CopyNotAdmitted('Copy to {} not admitted: {}'
+                                  .format(snapshot_id, str(e)))
@@ -1,15 +1,34 @@
 from __future__ import print_function
 
+import argparse
 import json
 import logging
 import os
 import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
-from boto3 import client
 from botocore.exceptions import ClientError
 
+from rdsclients import ClientRegistry, client
+from rdscontinuation import PHASE_COPY, PHASE_WAIT, PIPELINE_COPY, \
+    continue_later, continuations_enabled, invoker_from_environment, \
+    notification_records, read_continuations
+from rdscopyquota import CopyNotAdmitted, CopyQuotaScheduler
+from rdsdeletion import delete_snapshots
+from rdsinventory import (SnapshotInventory, iterate_db_instances,
+                          iterate_snapshots, newest_snapshot)
+from rdsledger import COPIED, IN_PROGRESS, SHARED, ledger_from_environment
+from rdsmetrics import ApiMetrics, metered_handler, record_copy, \
+    record_estimate
+from rdsplan import COPY, plan_backups
+from rdspolling import DeadlineExceeded
+from rdstracing import traced_handler, tracer_from_environment
+from rdswaiter import SnapshotCopyFailed, WaiterRegistry
+
 """
 This Lambda function, when deployed using the AWS SAM template
 'rds_copy_snap_template.yaml', will be part of the 'RDS Snapshot Copy Stack'.
@@ -17,14 +36,61 @@ When run with default AWS Lambda payload, this function will make a manual
 copy of the most recent automated snapshot for one or more RDS instances.
 It then shares the snapshot with a 'restricted' Failsafe account, sends an
 SNS notification to the subscription Topic.
+
+With FAILSAFE_COMPLETION_MODE set to 'event' the function returns as soon as
+the copy has been started. Sharing and notifying then happen when RDS
+publishes the 'manual snapshot created' event of the failsafe snapshot to the
+copy topic. In the default 'poll' mode the same event completes copies whose
+wait was handed off because the function was about to time out.
+
+Every instance of an SNS batch is backed up, up to MAX_PARALLEL_BACKUPS of
+them at a time, and every copy waits for a slot of the account-wide copy
+quota. Copies wait on one shared SnapshotWaiter, which describes all the
+copies in progress at once, see rdswaiter. The scheduled event of the
+template runs a fleet scan instead: every instance tagged Failsafe=true is
+found in one pass, and the actions of the whole run are planned from one
+listing of the snapshots of the account before any is applied, see rdsplan.
+Run the module with --dry-run to print the plan without applying it.
+
+With FAILSAFE_LEDGER set, the newest automated snapshot of an instance is
+claimed in the idempotency ledger before any work, so repeated events for it
+return at once, see rdsledger.
+
+RDS copies a snapshot incrementally when the previous copy of the same
+instance still exists. With FAILSAFE_COPY_MODE set to 'incremental' the old
+failsafe snapshots are kept while the new one is copied, and only deleted
+once it is available, just before it is shared. In the default 'full' mode
+they are deleted before the copy.
+
+With CONTINUATION_MODE set, a copy that outlasts the function, or that
+cannot get a copy quota slot in time, is resumed by a new invocation of the
+function instead: the state of the backup is sent with the continuation and
+the next invocation waits for the copy, or copies again, see rdscontinuation.
 """
 
 FAILSAFE_SNAPSHOT_PREFIX = 'failsafe-'
+FAILSAFE_TAG_KEY = 'Failsafe'
 SNS_RDS_SAVE_TOPIC = 'reptileinx_save_failsafe_snapshot_sns_topic'
+SNS_RDS_SAVE_TOPIC_ARN = os.getenv('SNS_RDS_SAVE_TOPIC_ARN', '')
+SNS_TOPIC_ARN_CACHE_TTL_SECONDS = int(
+    os.getenv('SNS_TOPIC_ARN_CACHE_TTL_SECONDS', '3600'))
 AWS_DEFAULT_REGION = 'ap-southeast-2'
 FAILSAFE_ACCOUNT_ID = os.getenv('FAILSAFE_ACCOUNT_ID', '2352525252332')
 MANUAL_SNAPSHOT_EXISTS_MESSAGE = 'Manual snapshot already exists ' \
                                     'for the automated snapshot {}'
+BACKUP_COMPLETED_EVENT_ID = 'RDS-EVENT-0002'
+MANUAL_SNAPSHOT_CREATED_EVENT_ID = 'RDS-EVENT-0042'
+SNAPSHOT_EVENT_SOURCE = 'db-snapshot'
+COMPLETION_MODE_POLL = 'poll'
+COMPLETION_MODE_EVENT = 'event'
+FAILSAFE_COMPLETION_MODE = os.getenv('FAILSAFE_COMPLETION_MODE',
+                                     COMPLETION_MODE_POLL)
+PENDING_COMPLETION_TAG = 'FailsafePendingCompletion'
+COPY_MODE_FULL = 'full'
+COPY_MODE_INCREMENTAL = 'incremental'
+FAILSAFE_COPY_MODE = os.getenv('FAILSAFE_COPY_MODE', COPY_MODE_FULL)
+MAX_PARALLEL_BACKUPS = int(os.getenv('MAX_PARALLEL_BACKUPS', '4'))
+TAG_CACHE_TTL_SECONDS = int(os.getenv('TAG_CACHE_TTL_SECONDS', '900'))
 
 
 def _get_aedt_timezone():
@@ -45,7 +111,32 @@ class ClientException(Exception):
     pass
 
 
-def create_failsafe_manual_snapshot(rds, instance):
+api_metrics = ApiMetrics()
+clients = ClientRegistry(lambda *args, **kwargs: client(*args, **kwargs),
+                         on_create=api_metrics.instrument)
+_db_instance_tags = {}
+_sns_topic_arns = {}
+_sns_topic_arns_lock = threading.Lock()
+copy_quota = CopyQuotaScheduler()
+tracer = tracer_from_environment()
+ledger = ledger_from_environment()
+snapshot_waiters = WaiterRegistry()
+continuation_invoker = None
+
+
+def new_client(service_name, role_arn=None):
+    """
+    Returns the Boto3 client of the service from the container-wide
+    registry, so warm invocations and the parallel backups share it
+    :param service_name: e.g. 'rds' or 'sns'
+    :param role_arn: role to assume, the Lambda role when None
+    :return: the Boto3 client
+    """
+    return clients.get(service_name, AWS_DEFAULT_REGION, role_arn)
+
+
+def create_failsafe_manual_snapshot(rds, instance, inventory=None,
+                                    context=None):
     """
     Checks if the database instance has a recent automated snapshot created.
     Creates a copy of the automated snapshot to a manual snapshot.
@@ -55,37 +146,38 @@ def create_failsafe_manual_snapshot(rds, instance):
 
     :param rds: instantiated boto3 object
     :param instance: name of database instance from which to copy snapshot
+    :param inventory: SnapshotInventory of the invocation, a new one is
+    created when not provided
+    :param context: the Lambda context bounding the wait for the copy
     :return:
         - None: if a copy of the automated snapshot has been created already
         - Snapshot: dictionary payload of the snapshot successfully copied
     """
-
+    if inventory is None:
+        inventory = SnapshotInventory(rds)
     logger.info('Creating manual copy of the most recent automated '
                 'snapshot of database instance - {}'.format(instance))
     name_of_newest_automated_snapshot = \
-        get_name_of_newest_automated_snapshot(instance, rds)
+        get_name_of_newest_automated_snapshot(instance, rds, inventory)
     name_of_created_failsafe_snapshot = \
         create_name_of_failsafe_snapshot(
                                           name_of_newest_automated_snapshot,
                                           FAILSAFE_SNAPSHOT_PREFIX)
-    manual_snapshots = get_snapshots(rds, instance, 'manual')
-    for manual_snapshot in manual_snapshots:
-        if manual_snapshot['DBSnapshotIdentifier'] == \
-                name_of_created_failsafe_snapshot:
-            logger.warn(MANUAL_SNAPSHOT_EXISTS_MESSAGE.format(
-                        name_of_newest_automated_snapshot))
-            return name_of_created_failsafe_snapshot
-    else:
-        return perform_copy_automated_snapshot(
-                                        instance,
-                                        name_of_created_failsafe_snapshot,
-                                        name_of_newest_automated_snapshot, rds)
+    if inventory.find(instance, 'manual', name_of_created_failsafe_snapshot):
+        logger.warn(MANUAL_SNAPSHOT_EXISTS_MESSAGE.format(
+                    name_of_newest_automated_snapshot))
+        return name_of_created_failsafe_snapshot
+    return perform_copy_automated_snapshot(
+                                    instance,
+                                    name_of_created_failsafe_snapshot,
+                                    name_of_newest_automated_snapshot, rds,
+                                    inventory, context)
 
 
 def perform_copy_automated_snapshot(
                                 instance, name_of_created_failsafe_snapshot,
                                 name_of_newest_automated_snapshot,
-                                rds):
+                                rds, inventory=None, context=None):
     """
     Where the actual copying of the automated snapshot actually happens.
     If the copy successfully completes the automated_snapshot_copied flag is
@@ -100,17 +192,57 @@ def perform_copy_automated_snapshot(
     snapshot being copied
     :param rds: the Boto3 client with the help of which we interrogate
     AWS RDS services
+    :param inventory: SnapshotInventory updated with the copied snapshot
+    :param context: the Lambda context bounding the wait for a copy quota
+    slot and for the copy. When the function is about to time out the
+    completion of the copy is continued in a new invocation, or handed off
+    to MANUAL_SNAPSHOT_CREATED_EVENT_ID when continuations are off
     :return: Name of Failsafe snapshot or empty string
+    :raises CopyNotAdmitted: if the copy quota stays full until the deadline
     """
     if name_of_newest_automated_snapshot:
-        response = rds.copy_db_snapshot(
-            SourceDBSnapshotIdentifier=name_of_newest_automated_snapshot,
-            TargetDBSnapshotIdentifier=name_of_created_failsafe_snapshot
-        )
-        wait_until_failsafe_snapshot_is_available(
+        started = time.time()
+        with tracer.span('copy', instance=instance,
+                         source_snapshot=name_of_newest_automated_snapshot,
+                         snapshot=name_of_created_failsafe_snapshot,
+                         copy_mode=FAILSAFE_COPY_MODE) as span:
+            response = copy_quota.copy(
+                rds, context,
+                SourceDBSnapshotIdentifier=name_of_newest_automated_snapshot,
+                TargetDBSnapshotIdentifier=name_of_created_failsafe_snapshot
+            )
+            span.set_attribute('allocated_storage', response.get(
+                'DBSnapshot', {}).get('AllocatedStorage'))
+        if inventory is None:
+            inventory = SnapshotInventory(rds)
+        inventory.record_copy(response)
+        if FAILSAFE_COMPLETION_MODE == COMPLETION_MODE_EVENT:
+            logger.info('Copy of {} to {} started, it completes on {}'
+                        .format(name_of_newest_automated_snapshot,
+                                name_of_created_failsafe_snapshot,
+                                MANUAL_SNAPSHOT_CREATED_EVENT_ID))
+        else:
+            try:
+                with tracer.span('wait', instance=instance,
+                                 snapshot=name_of_created_failsafe_snapshot):
+                    wait_until_failsafe_snapshot_is_available(
                                 rds,
-                                instance, name_of_created_failsafe_snapshot)
-        logger.info('Snapshot {} copied to {}'.format(
+                                instance, name_of_created_failsafe_snapshot,
+                                inventory, context)
+            except DeadlineExceeded as e:
+                if not continue_backup(context, instance, PHASE_WAIT, 1,
+                                       name_of_created_failsafe_snapshot,
+                                       e.started):
+                    hand_off_failsafe_snapshot(
+                        rds, response.get('DBSnapshot', {}), str(e))
+                return name_of_created_failsafe_snapshot
+            except SnapshotCopyFailed:
+                copy_quota.release(name_of_created_failsafe_snapshot)
+                raise
+            copy_quota.release(name_of_created_failsafe_snapshot)
+            record_copy(api_metrics, response.get('DBSnapshot', {}),
+                        time.time() - started, FAILSAFE_COPY_MODE)
+            logger.info('Snapshot {} copied to {}'.format(
                                         name_of_newest_automated_snapshot,
                                         name_of_created_failsafe_snapshot))
         return response.get('DBSnapshot', {}).get('DBSnapshotIdentifier', '')
@@ -123,9 +255,24 @@ def create_name_of_failsafe_snapshot(name_of_newest_automated_snapshot,
     return name_of_created_failsafe_snapshot
 
 
-def get_name_of_newest_automated_snapshot(instance, rds):
-    automated_snapshots = get_snapshots(rds, instance, 'automated')
-    newest_automated_snapshot = automated_snapshots[-1]
+def name_of_source_snapshot(name_of_failsafe_snapshot):
+    """
+    :param name_of_failsafe_snapshot: name given by
+    create_name_of_failsafe_snapshot
+    :return: name of the automated snapshot the failsafe snapshot is a copy
+    of, the key of its ledger entry
+    """
+    return 'rds:' + name_of_failsafe_snapshot[len(FAILSAFE_SNAPSHOT_PREFIX):]
+
+
+def get_name_of_newest_automated_snapshot(instance, rds, inventory=None):
+    automated_snapshots = inventory.snapshots(instance, 'automated') \
+        if inventory else iterate_snapshots(rds,
+                                            SnapshotType='automated',
+                                            DBInstanceIdentifier=instance,
+                                            IncludeShared=True)
+    newest_automated_snapshot = newest_snapshot(automated_snapshots,
+                                                get_snapshot_date)
     name_of_newest_automated_snapshot = \
         newest_automated_snapshot['DBSnapshotIdentifier']
     return name_of_newest_automated_snapshot
@@ -152,19 +299,26 @@ def send_sns_to_failsafe_account(instance, name_of_created_failsafe_snapshot):
                     'Instance': instance,
                     'FailsafeSnapshotID': name_of_created_failsafe_snapshot}
         logger.warn('message sent: {}'.format(failsafe_notification_payload))
-        sns = client('sns', region_name=AWS_DEFAULT_REGION)
-        sns.publish(
-            TargetArn=failsafe_sns_save_topic_arn,
-            Message=json.dumps({'default': json.dumps(
-                        failsafe_notification_payload)}),
-            MessageStructure='json')
+        sns = new_client('sns')
+        try:
+            sns.publish(
+                TargetArn=failsafe_sns_save_topic_arn,
+                Message=json.dumps({'default': json.dumps(
+                            failsafe_notification_payload)}),
+                MessageStructure='json')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NotFound':
+                with _sns_topic_arns_lock:
+                    _sns_topic_arns.pop(SNS_RDS_SAVE_TOPIC, None)
+            raise
 
 
-def share_failsafe_snapshot(rds, name_of_failsafe_snapshot):
+def share_failsafe_snapshot(rds, name_of_failsafe_snapshot, inventory=None):
     """
     Shares the Failsafe snapshot with the Backup account
     :param rds: the Boto3 client using which we interrogate AWS RDS services
     :param name_of_failsafe_snapshot: name of Failsafe Snapshot to be shared
+    :param inventory: SnapshotInventory updated with the shared attributes
     :return: None
     """
     if FAILSAFE_ACCOUNT_ID:
@@ -174,18 +328,23 @@ def share_failsafe_snapshot(rds, name_of_failsafe_snapshot):
         logger.warn('Security Notice: DB Snapshot {0}'
                     'will remain shared to {1} until when snapshot is deleted'
                     .format(name_of_failsafe_snapshot, FAILSAFE_ACCOUNT_ID))
-        rds.modify_db_snapshot_attribute(
+        response = rds.modify_db_snapshot_attribute(
             DBSnapshotIdentifier=name_of_failsafe_snapshot,
             AttributeName='restore',
             ValuesToAdd=[
                 FAILSAFE_ACCOUNT_ID
             ]
         )
+        if inventory is not None:
+            inventory.record_modify(response)
 
 
 def wait_until_failsafe_snapshot_is_available(rds,
                                               instance,
-                                              failsafe_snapshot):
+                                              failsafe_snapshot,
+                                              inventory=None,
+                                              context=None,
+                                              started=None):
     """
     A function that allows the lambda function to wait for long running events
     to complete. This allows us to have more control on the overall workflow of
@@ -193,25 +352,59 @@ def wait_until_failsafe_snapshot_is_available(rds,
     :param rds: the Boto3 client used to interrogate AWS RDS services
     :param instance: name of database instance to copy snapshot from
     :param failsafe_snapshot: name of the Failsafe snapshot being created
+    :param inventory: SnapshotInventory updated with the available snapshot
+    :param context: the Lambda context, polling backs off until the function
+    is about to time out
+    :param started: the time the copy was started, when the wait was
+    continued from an earlier invocation
     :return: None
+    :raises DeadlineExceeded: if the copy is not available in time
+    :raises SnapshotCopyFailed: if the copy failed or the snapshot vanished
     """
+    if inventory is None:
+        inventory = SnapshotInventory(rds)
     logger.info('Waiting for copy of {} to complete.'
                 .format(failsafe_snapshot))
-    available = False
-    while not available:
-        time.sleep(10)
-        manual_snapshots = get_snapshots(rds, instance, 'manual')
-        for manual_snapshot in manual_snapshots:
-            if manual_snapshot['DBSnapshotIdentifier'] == failsafe_snapshot:
-                logger.info('{}: {}...'
-                            .format(manual_snapshot['DBSnapshotIdentifier'],
-                                    manual_snapshot['Status']))
-                if manual_snapshot['Status'] == 'available':
-                    available = True
-                    break
-
-
-def delete_old_failsafe_manual_snapshots(rds, instance):
+    waiter = snapshot_waiters.get(rds)
+    snapshot = waiter.wait(
+        failsafe_snapshot, context,
+        until_deadline=continuations_enabled(continuation_invoker),
+        started=started)
+    inventory.record_copy({'DBSnapshot': snapshot})
+    record_estimate(api_metrics, waiter.estimator.outcome(failsafe_snapshot))
+
+
+def hand_off_failsafe_snapshot(rds, failsafe_snapshot, reason):
+    """
+    Tags a failsafe snapshot whose copy outlasted the wait, so that sharing
+    and notifying happen on its MANUAL_SNAPSHOT_CREATED_EVENT_ID instead
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param failsafe_snapshot: the copy_db_snapshot payload of the snapshot
+    :param reason: why the wait was given up
+    :return: None
+    """
+    logger.warn('{}. Handing off sharing of {} to {}'
+                .format(reason, failsafe_snapshot.get('DBSnapshotIdentifier'),
+                        MANUAL_SNAPSHOT_CREATED_EVENT_ID))
+    if failsafe_snapshot.get('DBSnapshotArn'):
+        rds.add_tags_to_resource(
+            ResourceName=failsafe_snapshot['DBSnapshotArn'],
+            Tags=[{'Key': PENDING_COMPLETION_TAG, 'Value': 'true'}])
+
+
+def completion_was_handed_off(rds, failsafe_snapshot):
+    """
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param failsafe_snapshot: payload of the failsafe snapshot
+    :return: True if hand_off_failsafe_snapshot tagged the snapshot
+    """
+    tags = rds.list_tags_for_resource(
+        ResourceName=failsafe_snapshot['DBSnapshotArn']).get('TagList', [])
+    return {'Key': PENDING_COMPLETION_TAG, 'Value': 'true'} in tags
+
+
+def delete_old_failsafe_manual_snapshots(rds, instance, inventory=None,
+                                         keep=None):
     """
     Deletes any previously created failsafe manual snapshots. Failsafe manual
     snapshot here being a copy of the automated snapshot that has been shared
@@ -220,11 +413,17 @@ def delete_old_failsafe_manual_snapshots(rds, instance):
 
     :param rds: the Boto3 client used to interrogate AWS RDS services
     :param instance: name of database instance to copy snapshot from
-    :return: None
+    :param inventory: SnapshotInventory the deleted snapshots are removed from
+    :param keep: name of a failsafe snapshot not to delete, e.g. the one
+    superseding the others
+    :return: DeletionSummary of the deletions
     """
-    logger.info('Preparing deletion of previously created manual snapshots'
+    if inventory is None:
+        inventory = SnapshotInventory(rds)
+    logger.info('Preparing deletion of previously created manual snapshots '
                 'for DB instance - {}'.format(instance))
-    manual_snapshots = get_snapshots(rds, instance, 'manual')
+    manual_snapshots = inventory.snapshots(instance, 'manual')
+    failsafe_snapshot_ids = []
     for manual_snapshot in manual_snapshots:
         snapshot_id_prefix_is_not_failsafe = \
             manual_snapshot['DBSnapshotIdentifier'][:9] != 'failsafe-'
@@ -232,10 +431,34 @@ def delete_old_failsafe_manual_snapshots(rds, instance):
             logger.info('Ignoring manual snapshot {}'
                         .format(manual_snapshot['DBSnapshotIdentifier']))
             continue
+        if manual_snapshot['DBSnapshotIdentifier'] == keep:
+            continue
         logger.info('Deleting previously created manual snapshot - {}'
                     .format(manual_snapshot['DBSnapshotIdentifier']))
-        rds.delete_db_snapshot(
-                DBSnapshotIdentifier=manual_snapshot['DBSnapshotIdentifier'])
+        failsafe_snapshot_ids.append(manual_snapshot['DBSnapshotIdentifier'])
+    return delete_snapshots(rds, failsafe_snapshot_ids, inventory)
+
+
+def delete_superseded_failsafe_snapshots(rds, instance,
+                                         name_of_failsafe_snapshot,
+                                         inventory=None):
+    """
+    Deletes the failsafe snapshots of the instance older than its new one,
+    once the new one is available. Used in place of the deletion before the
+    copy in incremental mode, so RDS copies from the previous copy.
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param instance: name of the database instance
+    :param name_of_failsafe_snapshot: the available failsafe snapshot
+    superseding the others
+    :param inventory: SnapshotInventory the deleted snapshots are removed from
+    :return: DeletionSummary of the deletions
+    """
+    with tracer.span('delete_old', instance=instance,
+                     snapshot=name_of_failsafe_snapshot) as span:
+        summary = delete_old_failsafe_manual_snapshots(
+            rds, instance, inventory, keep=name_of_failsafe_snapshot)
+        span.set_attribute('deleted', len(summary.deleted))
+    return summary
 
 
 def get_snapshot_date(snapshot):
@@ -253,105 +476,812 @@ def get_snapshot_date(snapshot):
 def get_snapshots(rds, instance, snapshot_type):
     """
     Gets a sorted list automated or manual snapshots depepnding on the
-    snapshot_type value
+    snapshot_type value. Every page of the listing is read, use
+    iterate_snapshots instead when the whole sorted list is not required.
     :param rds: the Boto3 client used to interrogate AWS RDS services
     :param instance: the specific instance to get snapshots from
     :param snapshot_type: can be 'automated' or 'manual'
     :return: sorted list of snapshots
     """
-    # TODO: refactor call this api once
-    if instance:
-        snapshots = rds.describe_db_snapshots(
-            SnapshotType=snapshot_type,
-            DBInstanceIdentifier=instance,
-            IncludeShared=True)['DBSnapshots']
-    else:
-        snapshots = rds.describe_db_snapshots(
-            SnapshotType=snapshot_type,
-            IncludeShared=True)['DBSnapshots']
-    if snapshots is not None:
-        sorted_snapshots = sorted(snapshots, key=get_snapshot_date)
-    return sorted_snapshots
+    snapshots = iterate_snapshots(rds,
+                                  SnapshotType=snapshot_type,
+                                  DBInstanceIdentifier=instance,
+                                  IncludeShared=True)
+    return sorted(snapshots, key=get_snapshot_date)
 
 
 def get_subscription_sns_topic_arn():
     """
-    Helper function to get the SNS Topic arn.
-    :return: sns topic arn
+    Helper function to get the SNS Topic arn. SNS_RDS_SAVE_TOPIC_ARN is used
+    when it is set, otherwise the topic named SNS_RDS_SAVE_TOPIC is looked
+    up and its arn kept for SNS_TOPIC_ARN_CACHE_TTL_SECONDS across warm
+    invocations. The parallel backups look the topic up under a lock, so a
+    cold cache is filled by a single list_topics scan.
+    :return: sns topic arn, or None if the topic does not exist
     """
-    sns = client('sns', region_name=AWS_DEFAULT_REGION)
-    sns_topic_list = sns.list_topics().get('Topics', [])
-    for sns_topic in sns_topic_list:
-        if not re.search(SNS_RDS_SAVE_TOPIC, sns_topic['TopicArn']):
-            continue
-        else:
-            failsafe_sns_topic_arn = sns_topic['TopicArn']
+    if SNS_RDS_SAVE_TOPIC_ARN:
+        return SNS_RDS_SAVE_TOPIC_ARN
+    with _sns_topic_arns_lock:
+        expiry, failsafe_sns_topic_arn = \
+            _sns_topic_arns.get(SNS_RDS_SAVE_TOPIC, (0, None))
+        if expiry >= time.time():
+            return failsafe_sns_topic_arn
+        failsafe_sns_topic_arn = find_sns_topic_arn(new_client('sns'),
+                                                    SNS_RDS_SAVE_TOPIC)
+        if failsafe_sns_topic_arn:
             logger.info('Setting failsafe topic arn to - {}'
                         .format(failsafe_sns_topic_arn))
+            _sns_topic_arns[SNS_RDS_SAVE_TOPIC] = \
+                (time.time() + SNS_TOPIC_ARN_CACHE_TTL_SECONDS,
+                 failsafe_sns_topic_arn)
             return failsafe_sns_topic_arn
     logger.error('Initial setup required. Failsafe SNS topic {} not found.'
                  .format(SNS_RDS_SAVE_TOPIC))
 
 
+def find_sns_topic_arn(sns, topic_name):
+    """
+    Looks a topic up by name, following the NextToken of list_topics from
+    page to page
+    :param sns: the Boto3 client used to interrogate AWS SNS services
+    :param topic_name: name of the topic, the last part of its arn
+    :return: arn of the topic, or None if it does not exist
+    """
+    arguments = {}
+    while True:
+        response = sns.list_topics(**arguments)
+        for sns_topic in response.get('Topics', []):
+            if sns_topic['TopicArn'].split(':')[-1] == topic_name:
+                return sns_topic['TopicArn']
+        if not response.get('NextToken'):
+            return None
+        arguments['NextToken'] = response['NextToken']
+
+
+def read_rds_event_message(record):
+    """
+    Helper function to read the RDS event notification of an SNS record.
+    SNS delivers the message as a JSON string, test events carry it as a
+    dictionary.
+    :param record: SNS record of the event
+    :return: dictionary of the RDS event
+    """
+    message = record['Sns']['Message']
+    return json.loads(message) if isinstance(message, str) else message
+
+
+def read_rds_event_id(record):
+    """
+    :param record: SNS record of the event
+    :return: the RDS event id e.g. RDS-EVENT-0002
+    """
+    event_id_raw = read_rds_event_message(record)['Event ID']
+    return re.findall(r'#(.*)', event_id_raw)[0]
+
+
 def event_guard(event):
-    for record in event['Records']:
+    """
+    Filters out the RDS events the function does not back up from, record
+    by record, so the suitable records of a batch are still backed up. The
+    other creation events of the snapshot subscription, e.g.
+    RDS-EVENT-0091 for an automated snapshot, are routine and only logged.
+    :param event: SNS event with one or more RDS notifications
+    :return: a skipped backup_result for every instance of the batch with
+    no event other than one not suitable for backup
+    """
+    backed_up = get_db_instances_from_notification(event)
+    skipped = []
+    for record in notification_records(event):
         if record['EventSource'] == 'aws:sns' and record['Sns']['Message']:
-            event_id_raw = json.loads(
-                            json.dumps(record['Sns']['Message']))['Event ID']
-            event_id = re.findall(r'#(.*)', event_id_raw)[0].encode('ascii')
+            event_id = read_rds_event_id(record)
             logger.info('received event {} from RDS'.format(event_id))
-            if event_id != 'RDS-EVENT-0002':
-                raise ClientException('received an event'
-                                      ' not suitable for backup...')
+            if event_id in (BACKUP_COMPLETED_EVENT_ID,
+                            MANUAL_SNAPSHOT_CREATED_EVENT_ID):
+                continue
+            message = read_rds_event_message(record)
+            if message.get('Event Source') == SNAPSHOT_EVENT_SOURCE:
+                logger.info('Ignoring snapshot event {}'.format(event_id))
+                continue
+            instance = message.get('Source ID')
+            logger.warn('Skipping event {} of {}, it is not suitable for '
+                        'backup'.format(event_id, instance))
+            if instance not in backed_up and instance not in skipped:
+                skipped.append(instance)
+    return [backup_result(instance, 'skipped') for instance in skipped]
 
 
-def run_rds_snapshot_backup(instance):
+def failsafe_snapshot_is_pending(inventory, instance,
+                                 name_of_failsafe_snapshot):
+    """
+    Helper function to tell whether the copy of the failsafe snapshot is
+    still running, in which case sharing has to wait for
+    MANUAL_SNAPSHOT_CREATED_EVENT_ID
+    :param inventory: SnapshotInventory of the invocation
+    :param instance: DB instance of the failsafe snapshot
+    :param name_of_failsafe_snapshot: name of the Failsafe snapshot
+    :return: True if the snapshot is known and not available yet
+    """
+    snapshot = inventory.find(instance, 'manual', name_of_failsafe_snapshot)
+    return bool(snapshot) and snapshot['Status'] != 'available'
+
+
+def complete_failsafe_manual_snapshot(name_of_failsafe_snapshot):
+    """
+    Shares the failsafe snapshot and notifies the Failsafe account once RDS
+    reports that its copy has been created. The pending work is keyed by the
+    snapshot id carried in the event, the instance is read from the snapshot.
+    In poll mode only snapshots handed off by hand_off_failsafe_snapshot are
+    completed here.
+    :param name_of_failsafe_snapshot: Source ID of the snapshot created event
+    :return: None
+    """
+    if not name_of_failsafe_snapshot.startswith(FAILSAFE_SNAPSHOT_PREFIX):
+        logger.info('Ignoring manual snapshot {}'
+                    .format(name_of_failsafe_snapshot))
+        return
+    source_snapshot = name_of_source_snapshot(name_of_failsafe_snapshot)
+    entry = ledger.get(source_snapshot) if ledger is not None else None
+    if entry and entry['State'] == SHARED:
+        logger.info('Failsafe snapshot {} is shared already'
+                    .format(name_of_failsafe_snapshot))
+        return
+    try:
+        rds = new_client('rds')
+        inventory = SnapshotInventory(rds)
+        failsafe_snapshot = inventory.refresh_snapshot(
+                                                name_of_failsafe_snapshot)
+        if not failsafe_snapshot or \
+                failsafe_snapshot['Status'] != 'available':
+            logger.warn('Failsafe snapshot {} is not available, not sharing'
+                        .format(name_of_failsafe_snapshot))
+            return
+        handed_off = FAILSAFE_COMPLETION_MODE != COMPLETION_MODE_EVENT
+        if handed_off and \
+                not completion_was_handed_off(rds, failsafe_snapshot):
+            logger.info('Ignoring {} for {}, completion mode is {}'
+                        .format(MANUAL_SNAPSHOT_CREATED_EVENT_ID,
+                                name_of_failsafe_snapshot,
+                                FAILSAFE_COMPLETION_MODE))
+            return
+        if entry and entry['State'] == IN_PROGRESS:
+            record_copy(api_metrics, failsafe_snapshot,
+                        time.time() - entry['UpdatedAt'], FAILSAFE_COPY_MODE)
+        if FAILSAFE_COPY_MODE == COPY_MODE_INCREMENTAL:
+            delete_superseded_failsafe_snapshots(
+                rds, failsafe_snapshot['DBInstanceIdentifier'],
+                name_of_failsafe_snapshot, inventory)
+        share_failsafe_snapshot(rds, name_of_failsafe_snapshot, inventory)
+        send_sns_to_failsafe_account(
+                                failsafe_snapshot['DBInstanceIdentifier'],
+                                name_of_failsafe_snapshot)
+        if ledger is not None:
+            ledger.advance(source_snapshot, SHARED,
+                           Instance=failsafe_snapshot['DBInstanceIdentifier'],
+                           FailsafeSnapshotID=name_of_failsafe_snapshot)
+        if handed_off:
+            rds.remove_tags_from_resource(
+                ResourceName=failsafe_snapshot['DBSnapshotArn'],
+                TagKeys=[PENDING_COMPLETION_TAG])
+    except ClientError as e:
+        logger.error(str(e))
+
+
+def backup_result(instance, status, failsafe_snapshot=None, error=None):
+    """
+    Helper function building the outcome of the backup of one instance
+    :param instance: the backed up DB instance
+    :param status: 'completed', 'pending', 'skipped', 'duplicate' or
+    'failed'
+    :param failsafe_snapshot: name of the Failsafe snapshot, if any
+    :param error: message of the error the backup failed with
+    :return: dictionary of the result
+    """
+    result = {'Instance': instance, 'Status': status}
+    if failsafe_snapshot:
+        result['FailsafeSnapshotID'] = failsafe_snapshot
+    if error:
+        result['Error'] = error
+    return result
+
+
+def run_rds_snapshot_backup(instance, context=None, rds=None):
     """
     The function that AWS Lambda service invokes when executing the code in
     this module.
     :param instance: instance that triggered the Copy SNS Topic
-    :return: true if an automated snapshot was copied, shared and a
-    notification was sent to an SNS Topic
+    :param context: the Lambda context bounding the wait for the copy
+    :param rds: the Boto3 client to use, a new one is created when not
+    provided
+    :return: backup_result of the instance, 'completed' if an automated
+    snapshot was copied, shared and a notification was sent to an SNS Topic
     """
     if instance:
-        try:
-            rds = client('rds', region_name=AWS_DEFAULT_REGION)
-            delete_old_failsafe_manual_snapshots(rds, instance)
-            name_of_created_failsafe_snapshot = \
-                create_failsafe_manual_snapshot(rds, instance)
-            if name_of_created_failsafe_snapshot:
-                share_failsafe_snapshot(rds, name_of_created_failsafe_snapshot)
-                send_sns_to_failsafe_account(instance,
-                                             name_of_created_failsafe_snapshot)
-        except ClientError as e:
-            logger.error(str(e))
+        with tracer.span('backup', instance=instance) as span:
+            result = back_up_instance(instance, context, rds)
+            span.set_attribute('status', result['Status'])
+            return result
     else:
         raise ClientException('No instances tagged for RDS failsafe'
                               'backup have been found...')
 
 
+def back_up_instance(instance, context=None, rds=None, attempt=0):
+    """
+    Runs the phases of the backup of one instance: delete the old failsafe
+    snapshots, copy the newest automated snapshot, wait for the copy, share
+    it and notify the Failsafe account. In incremental mode the old failsafe
+    snapshots are deleted once the copy is available instead. With the
+    ledger on, the newest automated snapshot is claimed first: a repeated
+    event for it returns at once, and a backup whose copy completed resumes
+    at sharing.
+    :param instance: name of the DB instance
+    :param context: the Lambda context bounding the wait for the copy
+    :param rds: the Boto3 client to use, a new one is created when not
+    provided
+    :param attempt: number of the continuations of the copy so far
+    :return: backup_result of the instance
+    """
+    claimed_snapshot, previous_entry, copied = None, None, False
+    try:
+        rds = rds or new_client('rds')
+        inventory = SnapshotInventory(rds)
+        if ledger is not None:
+            source_snapshot = get_name_of_newest_automated_snapshot(
+                instance, rds, inventory)
+            claimed, previous_entry = ledger.claim(
+                source_snapshot, resumable=(COPIED,), Instance=instance,
+                FailsafeSnapshotID=create_name_of_failsafe_snapshot(
+                    source_snapshot, FAILSAFE_SNAPSHOT_PREFIX))
+            if not claimed:
+                logger.info('Backup of {} is {} already, ignoring the '
+                            'repeated event'.format(source_snapshot,
+                                                    previous_entry['State']))
+                return backup_result(instance, 'duplicate',
+                                     previous_entry.get('FailsafeSnapshotID'))
+            claimed_snapshot = source_snapshot
+        if previous_entry and previous_entry['State'] == COPIED:
+            name_of_created_failsafe_snapshot = \
+                previous_entry['FailsafeSnapshotID']
+            logger.info('Resuming backup of {} at sharing'
+                        .format(name_of_created_failsafe_snapshot))
+        else:
+            if FAILSAFE_COPY_MODE != COPY_MODE_INCREMENTAL:
+                with tracer.span('delete_old', instance=instance) as span:
+                    summary = delete_old_failsafe_manual_snapshots(
+                        rds, instance, inventory)
+                    span.set_attribute('deleted', len(summary.deleted))
+                check_deletions(summary.failed)
+            name_of_created_failsafe_snapshot = \
+                create_failsafe_manual_snapshot(rds, instance, inventory,
+                                                context)
+        if name_of_created_failsafe_snapshot and \
+                failsafe_snapshot_is_pending(
+                                inventory, instance,
+                                name_of_created_failsafe_snapshot):
+            logger.info('Sharing of {} deferred until its copy completes'
+                        .format(name_of_created_failsafe_snapshot))
+            return backup_result(instance, 'pending',
+                                 name_of_created_failsafe_snapshot)
+        elif name_of_created_failsafe_snapshot:
+            copied = True
+            share_failsafe_backup(rds, instance,
+                                  name_of_created_failsafe_snapshot,
+                                  inventory, claimed_snapshot)
+            return backup_result(instance, 'completed',
+                                 name_of_created_failsafe_snapshot)
+        if claimed_snapshot:
+            ledger.release(claimed_snapshot)
+        return backup_result(instance, 'skipped')
+    except CopyNotAdmitted as e:
+        if claimed_snapshot:
+            ledger.release(claimed_snapshot)
+        if continue_backup(context, instance, PHASE_COPY, attempt + 1):
+            logger.warn('{}. Copy for {} is left to a new invocation'
+                        .format(str(e), instance))
+            return backup_result(instance, 'pending')
+        logger.error(str(e))
+        return backup_result(instance, 'failed', error=str(e))
+    except (ClientError, ClientException, SnapshotCopyFailed) as e:
+        logger.error(str(e))
+        settle_claim(claimed_snapshot, copied)
+        return backup_result(instance, 'failed', error=str(e))
+    except Exception:
+        settle_claim(claimed_snapshot, copied)
+        raise
+
+
+def check_deletions(failed):
+    """
+    Fails a backup whose failsafe snapshots could not all be deleted before
+    the copy, rather than leave them shared while the backup succeeds
+    :param failed: the failed deletions of a DeletionSummary, reasons by
+    snapshot id
+    :raises ClientException: if any deletion failed
+    """
+    if failed:
+        raise ClientException('Deletion of {} failed'.format(', '.join(
+            '{} ({})'.format(snapshot_id, failed[snapshot_id])
+            for snapshot_id in sorted(failed))))
+
+
+def settle_claim(claimed_snapshot, copied=False):
+    """
+    Settles the ledger entry of a backup that stopped on an error, so that
+    the next event for its automated snapshot is not ignored as a duplicate:
+    a backup whose copy completed resumes at sharing, any other starts over
+    :param claimed_snapshot: the automated snapshot claimed in the ledger, or
+    None when the ledger is off
+    :param copied: whether the failsafe snapshot was copied
+    """
+    if claimed_snapshot and copied:
+        ledger.advance(claimed_snapshot, COPIED)
+    elif claimed_snapshot:
+        ledger.release(claimed_snapshot)
+
+
+def share_failsafe_backup(rds, instance, name_of_failsafe_snapshot,
+                          inventory, claimed_snapshot=None, superseded=None):
+    """
+    Runs the phases of the backup of one instance that follow the copy:
+    delete the superseded failsafe snapshots in incremental mode, share the
+    failsafe snapshot and notify the Failsafe account
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param instance: name of the DB instance
+    :param name_of_failsafe_snapshot: name of the available failsafe
+    snapshot
+    :param inventory: SnapshotInventory of the invocation
+    :param claimed_snapshot: the automated snapshot claimed in the ledger,
+    advanced as the phases complete
+    :param superseded: identifiers of the failsafe snapshots to delete
+    before sharing, e.g. from a BackupPlan. In incremental mode they are
+    read from the listing of the instance when None
+    :return: None
+    """
+    if claimed_snapshot:
+        ledger.advance(claimed_snapshot, COPIED)
+    if superseded:
+        with tracer.span('delete_old', instance=instance,
+                         snapshot=name_of_failsafe_snapshot) as span:
+            summary = delete_snapshots(rds, superseded, inventory)
+            span.set_attribute('deleted', len(summary.deleted))
+    elif superseded is None and FAILSAFE_COPY_MODE == COPY_MODE_INCREMENTAL:
+        delete_superseded_failsafe_snapshots(
+            rds, instance, name_of_failsafe_snapshot, inventory)
+    with tracer.span('share', instance=instance,
+                     snapshot=name_of_failsafe_snapshot):
+        share_failsafe_snapshot(rds, name_of_failsafe_snapshot, inventory)
+    with tracer.span('notify', instance=instance,
+                     snapshot=name_of_failsafe_snapshot):
+        send_sns_to_failsafe_account(instance, name_of_failsafe_snapshot)
+    if claimed_snapshot:
+        ledger.advance(claimed_snapshot, SHARED)
+
+
+def completed_phases(phase):
+    """
+    :param phase: the phase a backup is resumed at
+    :return: list of the phases of the backup done before it
+    """
+    phases = ['copy'] if FAILSAFE_COPY_MODE == COPY_MODE_INCREMENTAL \
+        else ['delete_old', 'copy']
+    return phases if phase == PHASE_WAIT else phases[:-1]
+
+
+def continue_backup(context, instance, phase, attempt,
+                    name_of_failsafe_snapshot=None, copy_started=None):
+    """
+    Leaves the rest of the backup of an instance to a new invocation of the
+    function, see rdscontinuation
+    :param context: the Lambda context, naming the function to invoke
+    :param instance: name of the DB instance
+    :param phase: PHASE_COPY to copy again, PHASE_WAIT to wait for the copy
+    :param attempt: number of the continuations of the phase, this one
+    included
+    :param name_of_failsafe_snapshot: name of the failsafe snapshot being
+    copied, if any
+    :param copy_started: the time the copy was started, if known, so the
+    duration the next invocation learns is the whole of the copy
+    :return: True if the continuation was sent, False when continuations
+    are off or the phase was continued too often
+    """
+    state = {'Instance': instance, 'CompletedPhases': completed_phases(phase)}
+    if name_of_failsafe_snapshot:
+        state['FailsafeSnapshotID'] = name_of_failsafe_snapshot
+    if copy_started is not None:
+        state['CopyStartedAt'] = copy_started
+    invoker = continuation_invoker or \
+        invoker_from_environment(new_client, context)
+    return continue_later(invoker, PIPELINE_COPY, phase, attempt, **state)
+
+
+def resume_backup(state, context=None):
+    """
+    Resumes the backup of an instance at the phase of its continuation
+    :param state: the state read from the continuation
+    :param context: the Lambda context bounding the wait for the copy
+    :return: backup_result of the instance
+    """
+    instance = state['Instance']
+    with tracer.span('backup', instance=instance, phase=state['Phase'],
+                     attempt=state['Attempt']) as span:
+        if state['Phase'] == PHASE_WAIT:
+            result = finish_backup(instance, state['FailsafeSnapshotID'],
+                                   context, state['Attempt'],
+                                   state.get('CopyStartedAt'))
+        else:
+            result = back_up_instance(instance, context,
+                                      attempt=state['Attempt'])
+        span.set_attribute('status', result['Status'])
+        return result
+
+
+def finish_backup(instance, name_of_failsafe_snapshot, context=None,
+                  attempt=0, copy_started=None):
+    """
+    Waits for the copy of a continued backup, then shares it and notifies
+    the Failsafe account
+    :param instance: name of the DB instance
+    :param name_of_failsafe_snapshot: name of the failsafe snapshot being
+    copied
+    :param context: the Lambda context bounding the wait for the copy
+    :param attempt: number of the continuations of the wait so far
+    :param copy_started: the time the copy was started, if known
+    :return: backup_result of the instance
+    """
+    source_snapshot = name_of_source_snapshot(name_of_failsafe_snapshot)
+    claimed_snapshot = source_snapshot if ledger is not None else None
+    copied = False
+    try:
+        rds = new_client('rds')
+        inventory = SnapshotInventory(rds)
+        try:
+            with tracer.span('wait', instance=instance,
+                             snapshot=name_of_failsafe_snapshot):
+                wait_until_failsafe_snapshot_is_available(
+                    rds, instance, name_of_failsafe_snapshot, inventory,
+                    context, copy_started)
+        except DeadlineExceeded as e:
+            if not continue_backup(context, instance, PHASE_WAIT,
+                                   attempt + 1, name_of_failsafe_snapshot,
+                                   e.started or copy_started):
+                hand_off_failsafe_snapshot(
+                    rds, inventory.find(instance, 'manual',
+                                        name_of_failsafe_snapshot) or {},
+                    str(e))
+            return backup_result(instance, 'pending',
+                                 name_of_failsafe_snapshot)
+        copy_quota.release(name_of_failsafe_snapshot)
+        copied = True
+        share_failsafe_backup(rds, instance, name_of_failsafe_snapshot,
+                              inventory, claimed_snapshot)
+        return backup_result(instance, 'completed', name_of_failsafe_snapshot)
+    except (ClientError, SnapshotCopyFailed) as e:
+        logger.error(str(e))
+        copy_quota.release(name_of_failsafe_snapshot)
+        settle_claim(claimed_snapshot, copied)
+        return backup_result(instance, 'failed', name_of_failsafe_snapshot,
+                             str(e))
+    except Exception:
+        copy_quota.release(name_of_failsafe_snapshot)
+        settle_claim(claimed_snapshot, copied)
+        raise
+
+
+def run_rds_snapshot_backups(instances, context=None, rds=None):
+    """
+    Backs up every instance on a thread pool of at most MAX_PARALLEL_BACKUPS
+    workers sharing one RDS client. The failure of one instance does not
+    stop the others.
+    :param instances: names of the DB instances to back up
+    :param context: the Lambda context bounding the wait for the copies
+    :param rds: the Boto3 client to share, a new one is created when not
+    provided
+    :return: list of backup_result, in the order of instances
+    """
+    if not instances:
+        raise ClientException('No instances tagged for RDS failsafe '
+                              'backup have been found...')
+    rds = rds or new_client('rds')
+    workers = max(1, min(MAX_PARALLEL_BACKUPS, len(instances)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        backups = [executor.submit(run_rds_snapshot_backup,
+                                   instance, context, rds)
+                   for instance in instances]
+    results = []
+    for instance, backup in zip(instances, backups):
+        if backup.exception():
+            logger.error('Backup of {} failed: {!r}'
+                         .format(instance, backup.exception()))
+            results.append(backup_result(instance, 'failed',
+                                         error=str(backup.exception())))
+        else:
+            results.append(backup.result())
+    return results
+
+
+def run_fleet_backup(context=None, rds=None, instances=None,
+                     dry_run=False):
+    """
+    Backs up the fleet from one plan of the whole run, see rdsplan
+    :param context: the Lambda context bounding the wait for the copies
+    :param rds: the Boto3 client to use, a new one is created when not
+    provided
+    :param instances: names of the DB instances to back up, every instance
+    tagged for Failsafe backup when None
+    :param dry_run: only compute the plan, nothing is deleted, copied,
+    shared or notified
+    :return: list of backup_result in the order of the instances, or the
+    lines of the plan on a dry run
+    """
+    rds = rds or new_client('rds')
+    if instances is None:
+        instances = get_db_instances_by_tags(rds, [])
+    if not instances:
+        raise ClientException('No instances tagged for RDS failsafe '
+                              'backup have been found...')
+    inventory = SnapshotInventory(rds)
+    with tracer.span('plan', instances=len(instances)) as span:
+        plan = plan_backups(
+            instances, inventory,
+            lambda name: create_name_of_failsafe_snapshot(
+                name, FAILSAFE_SNAPSHOT_PREFIX),
+            FAILSAFE_SNAPSHOT_PREFIX,
+            FAILSAFE_COPY_MODE == COPY_MODE_INCREMENTAL)
+        span.set_attribute('actions', sum(len(actions) for actions in
+                                          plan.actions.values()))
+    logger.info('Backup plan: {}'.format(plan))
+    if dry_run:
+        return plan.describe()
+    return apply_backup_plan(rds, plan, inventory, context)
+
+
+def apply_backup_plan(rds, plan, inventory, context=None):
+    """
+    Applies a BackupPlan. The planned instances are claimed in the ledger
+    first, the deletions planned before the copies of every instance then
+    run in one bulk delete_snapshots run, and each instance is copied,
+    shared and notified on a thread pool of at most MAX_PARALLEL_BACKUPS
+    workers. The failure of one instance does not stop the others.
+    :param rds: the Boto3 client to share
+    :param plan: the BackupPlan of the run
+    :param inventory: SnapshotInventory the plan was computed from
+    :param context: the Lambda context bounding the wait for the copies
+    :return: list of backup_result, in the order of plan.instances
+    """
+    results = dict((instance, backup_result(instance, 'skipped'))
+                   for instance in plan.skipped)
+    claims = OrderedDict()
+    for instance, actions in plan.actions.items():
+        copy = [action for action in actions if action.kind == COPY]
+        source_snapshot = copy[0].source if copy else \
+            name_of_source_snapshot(actions[-1].snapshot)
+        if ledger is None:
+            claims[instance] = None
+            continue
+        claimed, entry = ledger.claim(
+            source_snapshot, resumable=(COPIED,), Instance=instance,
+            FailsafeSnapshotID=actions[-1].snapshot)
+        if claimed:
+            claims[instance] = source_snapshot
+        else:
+            logger.info('Backup of {} is {} already, ignoring it'
+                        .format(source_snapshot, entry['State']))
+            results[instance] = backup_result(
+                instance, 'duplicate', entry.get('FailsafeSnapshotID'))
+    with tracer.span('delete_old', instances=len(claims)) as span:
+        summary = delete_snapshots(
+            rds, [snapshot_id for instance in claims
+                  for snapshot_id in plan.deletes_before_copy(instance)],
+            inventory, context)
+        span.set_attribute('deleted', len(summary.deleted))
+    for instance in list(claims):
+        failed = dict((snapshot_id, summary.failed[snapshot_id])
+                      for snapshot_id in plan.deletes_before_copy(instance)
+                      if snapshot_id in summary.failed)
+        try:
+            check_deletions(failed)
+        except ClientException as e:
+            logger.error(str(e))
+            settle_claim(claims.pop(instance))
+            results[instance] = backup_result(instance, 'failed',
+                                              error=str(e))
+    if claims:
+        workers = max(1, min(MAX_PARALLEL_BACKUPS, len(claims)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            backups = [(instance, executor.submit(
+                apply_instance_plan, rds, plan, instance, inventory, context,
+                claimed_snapshot))
+                for instance, claimed_snapshot in claims.items()]
+        for instance, backup in backups:
+            if backup.exception():
+                logger.error('Backup of {} failed: {!r}'
+                             .format(instance, backup.exception()))
+                results[instance] = backup_result(
+                    instance, 'failed', error=str(backup.exception()))
+            else:
+                results[instance] = backup.result()
+    return [results[instance] for instance in plan.instances]
+
+
+def apply_instance_plan(rds, plan, instance, inventory, context=None,
+                        claimed_snapshot=None):
+    """
+    Copies, shares and notifies one instance of a BackupPlan, once the
+    deletions planned before its copy are done
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param plan: the BackupPlan of the run
+    :param instance: name of the DB instance
+    :param inventory: SnapshotInventory the plan was computed from
+    :param context: the Lambda context bounding the wait for the copy
+    :param claimed_snapshot: the automated snapshot claimed in the ledger
+    :return: backup_result of the instance
+    """
+    actions = plan.actions[instance]
+    name_of_failsafe_snapshot = actions[-1].snapshot
+    copied = False
+    with tracer.span('backup', instance=instance) as span:
+        try:
+            copy = [action for action in actions if action.kind == COPY]
+            if copy:
+                perform_copy_automated_snapshot(
+                    instance, name_of_failsafe_snapshot, copy[0].source, rds,
+                    inventory, context)
+                copied_snapshot = inventory.find(
+                    '', 'manual', name_of_failsafe_snapshot)
+                if copied_snapshot and \
+                        copied_snapshot['Status'] != 'available':
+                    span.set_attribute('status', 'pending')
+                    return backup_result(instance, 'pending',
+                                         name_of_failsafe_snapshot)
+            copied = True
+            share_failsafe_backup(rds, instance, name_of_failsafe_snapshot,
+                                  inventory, claimed_snapshot,
+                                  plan.deletes_after_copy(instance))
+            span.set_attribute('status', 'completed')
+            return backup_result(instance, 'completed',
+                                 name_of_failsafe_snapshot)
+        except CopyNotAdmitted as e:
+            if claimed_snapshot:
+                ledger.release(claimed_snapshot)
+            if continue_backup(context, instance, PHASE_COPY, 1):
+                logger.warn('{}. Copy for {} is left to a new invocation'
+                            .format(str(e), instance))
+                return backup_result(instance, 'pending')
+            logger.error(str(e))
+            return backup_result(instance, 'failed', error=str(e))
+        except (ClientError, SnapshotCopyFailed) as e:
+            logger.error(str(e))
+            settle_claim(claimed_snapshot, copied)
+            return backup_result(instance, 'failed', error=str(e))
+        except Exception:
+            settle_claim(claimed_snapshot, copied)
+            raise
+
+
+def get_db_instance_tags(rds, db_instance):
+    """
+    Tags of a DB instance. describe_db_instances returns them in TagList,
+    otherwise list_tags_for_resource is called and its answer kept for
+    TAG_CACHE_TTL_SECONDS across warm invocations.
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param db_instance: payload of the DB instance from describe_db_instances
+    :return: list of tags
+    """
+    if 'TagList' in db_instance:
+        return db_instance['TagList']
+    db_instance_arn = db_instance['DBInstanceArn']
+    expiry, tags = _db_instance_tags.get(db_instance_arn, (0, None))
+    if expiry < time.time():
+        tags = rds.list_tags_for_resource(
+            ResourceName=db_instance_arn).get('TagList', [])
+        _db_instance_tags[db_instance_arn] = \
+            (time.time() + TAG_CACHE_TTL_SECONDS, tags)
+    return tags
+
+
+def is_tagged_for_failsafe(tags):
+    """
+    :param tags: tags of a DB instance
+    :return: True if the instance carries the Failsafe=true tag, in any case
+    """
+    return any(tag['Key'].lower() == FAILSAFE_TAG_KEY.lower() and
+               tag['Value'].lower() == 'true' for tag in tags)
+
+
+def get_db_instances_by_tags(rds, db_instance_list):
+    """
+    Finds every DB instance tagged for Failsafe backup in one paginated pass
+    over describe_db_instances
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param db_instance_list: list the names of the tagged instances are
+    appended to
+    :return: db_instance_list
+    """
+    for db_instance in iterate_db_instances(rds):
+        if is_tagged_for_failsafe(get_db_instance_tags(rds, db_instance)):
+            logger.info('Found database with Failsafe tag {}'
+                        .format(db_instance['DBInstanceIdentifier']))
+            db_instance_list.append(db_instance['DBInstanceIdentifier'])
+    return db_instance_list
+
+
+def is_scheduled_event(event):
+    """
+    :param event: event the handler was invoked with
+    :return: True for the CloudWatch scheduled event of the Timer
+    """
+    return isinstance(event, dict) and \
+        event.get('detail-type') == 'Scheduled Event'
+
+
 def get_db_instances_from_notification(event):
-    for record in event['Records']:
-        db_instance = \
-            json.loads(json.dumps(record['Sns']['Message']))['Source ID']
-        return db_instance
+    """
+    Reads the instances of every backup completed record of the event
+    :param event: SNS event with one or more RDS notifications
+    :return: list of distinct instance names, in the order received
+    """
+    db_instances = []
+    for record in notification_records(event):
+        if read_rds_event_id(record) != BACKUP_COMPLETED_EVENT_ID:
+            continue
+        db_instance = read_rds_event_message(record)['Source ID']
+        if db_instance not in db_instances:
+            db_instances.append(db_instance)
+    return db_instances
+
+
+def get_created_snapshots_from_notification(event):
+    return [read_rds_event_message(record)['Source ID']
+            for record in notification_records(event)
+            if read_rds_event_id(record) == MANUAL_SNAPSHOT_CREATED_EVENT_ID]
 
 
+@metered_handler(api_metrics, 'rdscopysnapshots')
+@traced_handler(tracer, 'rdscopysnapshots')
 def handler(event, context):
     """
     The function that AWS Lambda service invokes when executing the code.
     :param event: used to to pass in event data to the handler.
-    An RDS notification will trigger this process
-    :param context: we are not providing any runtime information to the handler
-    :return: true if an automated snapshot was copied, shared and a
-    notification was sent to an SNS Topic
+    An RDS notification will trigger this process: a backup completed event
+    starts the copy, a manual snapshot created event completes it. The
+    scheduled event backs up every instance tagged for Failsafe backup.
+    :param context: the Lambda context, used to stop waiting for the copy
+    before the function times out
+    A continuation sent by an earlier invocation resumes its backup, the
+    notifications batched with it are processed as well. An instance whose
+    events are not suitable for backup is reported as skipped.
+    :return: list with the backup_result of every instance in the event
     """
-    event_guard(event)
-    db_instance = get_db_instances_from_notification(event)
-    run_rds_snapshot_backup(db_instance)
+    continuations = read_continuations(event, PIPELINE_COPY)
+    results = [resume_backup(state, context) for state in continuations]
+    if continuations and not notification_records(event):
+        return results
+    if is_scheduled_event(event):
+        return run_fleet_backup(context)
+    results += event_guard(event)
+    created_snapshots = get_created_snapshots_from_notification(event)
+    for name_of_failsafe_snapshot in created_snapshots:
+        complete_failsafe_manual_snapshot(name_of_failsafe_snapshot)
+    db_instances = get_db_instances_from_notification(event)
+    if not db_instances:
+        return results
+    return results + run_rds_snapshot_backups(db_instances, context)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Back up the RDS instances tagged for Failsafe backup')
+    parser.add_argument('instances', nargs='*',
+                        help='instances to back up instead of the tagged '
+                             'ones')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the plan of the run without applying it')
+    options = parser.parse_args(arguments)
+    result = run_fleet_backup(instances=options.instances or None,
+                              dry_run=options.dry_run)
+    print('\n'.join(result) if options.dry_run
+          else json.dumps(result, indent=2))
 
 
 if __name__ == "__main__":
-    event = []
-    context = []
-    handler(event, context)
+    main()
@@ -0,0 +1,124 @@
+"""
+    Bulk snapshot deletion shared by the rdscopysnapshots and
+    rdssavesnapshot Lambda functions.
+
+    When retention catches up, e.g. after a change of the retention policy,
+    thousands of snapshots can be due at once. delete_snapshots deletes them
+    on a thread pool of MAX_PARALLEL_DELETES workers. A throttled delete is
+    retried with exponential backoff and jitter, a snapshot that is already
+    gone or busy is skipped, and the run ends with a DeletionSummary of what
+    was deleted, skipped and failed instead of stopping at the first error.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from rdspolling import DeadlineExceeded, PollingSchedule
+
+MAX_PARALLEL_DELETES = int(os.getenv('MAX_PARALLEL_DELETES', '8'))
+DELETE_MAX_ATTEMPTS = 5
+DELETE_RETRY_INITIAL_INTERVAL_SECONDS = 1
+DELETE_RETRY_MAX_INTERVAL_SECONDS = 20
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException',
+                          'RequestLimitExceeded')
+SKIPPED_ERROR_CODES = ('DBSnapshotNotFound', 'InvalidDBSnapshotState')
+
+logger = logging.getLogger()
+
+
+class DeletionSummary(object):
+    """
+    Outcome of a delete_snapshots run
+    """
+
+    def __init__(self):
+        self.deleted = []
+        self.skipped = {}
+        self.failed = {}
+
+    def as_dict(self):
+        """
+        :return: counts of deleted, skipped and failed snapshots
+        """
+        return {'Deleted': len(self.deleted),
+                'Skipped': len(self.skipped),
+                'Failed': len(self.failed)}
+
+    def __repr__(self):
+        return '{} deleted, {} skipped, {} failed'.format(
+            len(self.deleted), len(self.skipped), len(self.failed))
+
+
+def delete_snapshot(rds, snapshot_id, context=None, sleep=None):
+    """
+    Deletes one snapshot, retrying while RDS throttles the call
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param snapshot_id: identifier of the snapshot to delete
+    :param context: the Lambda context bounding the retries
+    :param sleep: function used to sleep between retries, replaceable for
+    tests. time.sleep when None
+    :return: tuple of 'deleted', 'skipped' or 'failed' and the reason
+    """
+    schedule = PollingSchedule(
+        context,
+        initial_interval=DELETE_RETRY_INITIAL_INTERVAL_SECONDS,
+        max_interval=DELETE_RETRY_MAX_INTERVAL_SECONDS,
+        sleep=sleep)
+    while True:
+        try:
+            rds.delete_db_snapshot(DBSnapshotIdentifier=snapshot_id)
+            return 'deleted', None
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in SKIPPED_ERROR_CODES:
+                return 'skipped', code
+            if code not in THROTTLING_ERROR_CODES or \
+                    schedule.attempts + 1 >= DELETE_MAX_ATTEMPTS:
+                return 'failed', str(e)
+        try:
+            schedule.wait()
+        except DeadlineExceeded as e:
+            return 'failed', str(e)
+
+
+def delete_snapshots(rds, snapshot_ids, inventory=None, context=None,
+                     max_workers=MAX_PARALLEL_DELETES, sleep=None):
+    """
+    Deletes snapshots in parallel and reports the outcome of each one
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param snapshot_ids: identifiers of the snapshots to delete
+    :param inventory: SnapshotInventory the deleted and missing snapshots
+    are removed from
+    :param context: the Lambda context bounding the retries
+    :param max_workers: upper bound of the deletes in flight
+    :param sleep: function used to sleep between retries, replaceable for
+    tests. time.sleep when None
+    :return: DeletionSummary of the run
+    """
+    summary = DeletionSummary()
+    snapshot_ids = list(snapshot_ids)
+    if not snapshot_ids:
+        return summary
+    workers = max(1, min(max_workers, len(snapshot_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(
+            lambda snapshot_id: delete_snapshot(rds, snapshot_id, context,
+                                                sleep),
+            snapshot_ids))
+    for snapshot_id, (status, reason) in zip(snapshot_ids, outcomes):
+        if status == 'deleted':
+            summary.deleted.append(snapshot_id)
+        elif status == 'skipped':
+            summary.skipped[snapshot_id] = reason
+        else:
+            logger.error('Deletion of {} failed: {}'
+                         .format(snapshot_id, reason))
+            summary.failed[snapshot_id] = reason
+        if inventory is not None and \
+                (status == 'deleted' or reason == 'DBSnapshotNotFound'):
+            inventory.record_delete(snapshot_id)
+    logger.info('Deletion of {} snapshots: {}'
+                .format(len(snapshot_ids), summary))
+    return summary
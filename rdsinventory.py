@@ -0,0 +1,317 @@
+"""
+    Snapshot inventory helpers shared by the rdscopysnapshots and
+    rdssavesnapshot Lambda functions.
+
+    describe_db_snapshots returns at most MaxRecords snapshots per call and a
+    Marker when there are more to come. The helpers here follow the Marker
+    and stream the listing back one page at a time, so callers can select or
+    sort on top of the stream without holding every page in memory.
+
+    SnapshotInventory caches the listings read during one Lambda invocation
+    and keeps them current from the responses of our own copy, delete and
+    modify calls, so each (instance, snapshot type) listing is read once.
+    The inventory is shared by the worker threads of a batch, so its
+    listings are read and updated under a lock.
+
+    Snapshots shared with the account are listed under their ARN.
+    SharedSnapshotIndex keys them by the parsed snapshot id and source
+    account, so a shared snapshot is found in constant time, by the exact id
+    rather than by a pattern that also matches the ids it is a prefix of.
+"""
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+from botocore.exceptions import ClientError
+
+DESCRIBE_DB_SNAPSHOTS_PAGE_SIZE = 100
+DESCRIBE_DB_INSTANCES_PAGE_SIZE = 100
+
+logger = logging.getLogger()
+
+
+def iterate_snapshot_pages(rds, **filters):
+    """
+    Generator over the pages of a describe_db_snapshots listing. The Marker
+    returned by each call is passed to the next one until RDS stops
+    returning it.
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param filters: describe_db_snapshots arguments e.g. SnapshotType,
+    DBInstanceIdentifier, IncludeShared. Arguments with an empty value are
+    not sent to RDS
+    :return: generator of lists of snapshots, one list per page
+    """
+    arguments = dict((key, value) for key, value in filters.items()
+                     if value is not None and value != '')
+    arguments.setdefault('MaxRecords', DESCRIBE_DB_SNAPSHOTS_PAGE_SIZE)
+    while True:
+        response = rds.describe_db_snapshots(**arguments)
+        yield response.get('DBSnapshots') or []
+        marker = response.get('Marker')
+        if not marker:
+            return
+        arguments['Marker'] = marker
+
+
+def iterate_snapshots(rds, **filters):
+    """
+    Generator over every snapshot of a describe_db_snapshots listing
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param filters: describe_db_snapshots arguments, see
+    iterate_snapshot_pages
+    :return: generator of snapshots
+    """
+    for page in iterate_snapshot_pages(rds, **filters):
+        for snapshot in page:
+            yield snapshot
+
+
+def iterate_db_instances(rds, **filters):
+    """
+    Generator over every DB instance of a describe_db_instances listing,
+    following the Marker from page to page
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param filters: describe_db_instances arguments e.g. Filters
+    :return: generator of DB instances
+    """
+    arguments = dict(filters)
+    arguments.setdefault('MaxRecords', DESCRIBE_DB_INSTANCES_PAGE_SIZE)
+    while True:
+        response = rds.describe_db_instances(**arguments)
+        for db_instance in response.get('DBInstances') or []:
+            yield db_instance
+        marker = response.get('Marker')
+        if not marker:
+            return
+        arguments['Marker'] = marker
+
+
+def find_snapshot(snapshots, snapshot_id):
+    """
+    Selects a snapshot by its identifier, stopping at the first match
+    :param snapshots: iterable of snapshots e.g. from iterate_snapshots
+    :param snapshot_id: the DBSnapshotIdentifier being looked for
+    :return: the snapshot, or None if it is not in the listing
+    """
+    for snapshot in snapshots:
+        if snapshot['DBSnapshotIdentifier'] == snapshot_id:
+            return snapshot
+    return None
+
+
+def newest_snapshot(snapshots, snapshot_date):
+    """
+    Selects the most recent snapshot of a listing in a single pass
+    :param snapshots: iterable of snapshots e.g. from iterate_snapshots
+    :param snapshot_date: function returning the date a snapshot is
+    ordered by
+    :return: the newest snapshot, or None if the listing is empty
+    """
+    newest, newest_date = None, None
+    for snapshot in snapshots:
+        date = snapshot_date(snapshot)
+        if newest is None or date >= newest_date:
+            newest, newest_date = snapshot, date
+    return newest
+
+
+def parse_snapshot_arn(snapshot_identifier):
+    """
+    Splits the ARN of a snapshot, e.g.
+    arn:aws:rds:ap-southeast-2:129000003686:snapshot:failsafe-db-2017-11-26
+    :param snapshot_identifier: the ARN, or the identifier of a snapshot of
+    the account
+    :return: tuple of the account id, None for a plain identifier, and the
+    snapshot id
+    """
+    parts = snapshot_identifier.split(':')
+    if len(parts) == 7 and parts[0] == 'arn' and parts[5] == 'snapshot':
+        return parts[4], parts[6]
+    return None, snapshot_identifier
+
+
+class SharedSnapshotIndex(object):
+    """
+    Snapshots shared with the account keyed by (snapshot id, source
+    account), built in one pass over a shared listing
+    """
+
+    def __init__(self, snapshots):
+        """
+        :param snapshots: iterable of shared snapshots, listed by ARN
+        """
+        self._snapshots = {}
+        self._accounts = defaultdict(list)
+        for snapshot in snapshots:
+            account, snapshot_id = parse_snapshot_arn(
+                snapshot['DBSnapshotIdentifier'])
+            if (snapshot_id, account) not in self._snapshots:
+                self._accounts[snapshot_id].append(account)
+            self._snapshots[(snapshot_id, account)] = snapshot
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def find(self, snapshot_id, source_account=None):
+        """
+        Looks a shared snapshot up by id
+        :param snapshot_id: the snapshot id, or its ARN which also gives the
+        source account
+        :param source_account: account that shared the snapshot, needed only
+        when several accounts share snapshots of the same id
+        :return: the snapshot, or None if it is not shared or ambiguous
+        """
+        account, snapshot_id = parse_snapshot_arn(snapshot_id)
+        source_account = source_account or account
+        if source_account:
+            return self._snapshots.get((snapshot_id, source_account))
+        accounts = self._accounts.get(snapshot_id, [])
+        if len(accounts) > 1:
+            logger.warn('Snapshot {} is shared by accounts {}, the source '
+                        'account is required'
+                        .format(snapshot_id, ', '.join(accounts)))
+            return None
+        return self._snapshots[(snapshot_id, accounts[0])] if accounts \
+            else None
+
+
+class SnapshotInventory(object):
+    """
+    Per-invocation cache of snapshot listings keyed by
+    (instance, snapshot type). Create one per handler invocation and pass it
+    through the pipeline; it must not outlive the invocation as snapshots
+    created or deleted by others are only seen on the next read.
+    """
+
+    def __init__(self, rds):
+        self.rds = rds
+        self._listings = {}
+        self._attributes = {}
+        self._shared_index = None
+        self._lock = threading.RLock()
+
+    def snapshots(self, instance, snapshot_type):
+        """
+        Snapshots of the instance and type, read from RDS on first use only
+        :param instance: the specific instance, or '' for every instance
+        :param snapshot_type: 'automated', 'manual' or 'shared'
+        :return: list of snapshots in listing order
+        """
+        with self._lock:
+            return list(self._listing(instance, snapshot_type).values())
+
+    def find(self, instance, snapshot_type, snapshot_id):
+        """
+        Looks a snapshot up by identifier in a cached listing
+        :return: the snapshot, or None if it is not in the listing
+        """
+        with self._lock:
+            return self._listing(instance, snapshot_type).get(snapshot_id)
+
+    def shared_index(self):
+        """
+        Index of the snapshots shared with the account, built from the
+        shared listing on first use
+        :return: SharedSnapshotIndex
+        """
+        with self._lock:
+            if self._shared_index is None:
+                self._shared_index = SharedSnapshotIndex(
+                    self.snapshots('', 'shared'))
+            return self._shared_index
+
+    def refresh_snapshot(self, snapshot_id):
+        """
+        Re-reads a single snapshot, e.g. while waiting on a copy, and updates
+        the cached listings it belongs to
+        :param snapshot_id: the DBSnapshotIdentifier to describe
+        :return: the current snapshot, or None if RDS does not know it
+        """
+        try:
+            snapshots = self.rds.describe_db_snapshots(
+                DBSnapshotIdentifier=snapshot_id).get('DBSnapshots') or []
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'DBSnapshotNotFound':
+                raise
+            snapshots = []
+        with self._lock:
+            if not snapshots:
+                self._forget(snapshot_id)
+                return None
+            self._remember(snapshots[0])
+        return snapshots[0]
+
+    def record_copy(self, response):
+        """
+        Adds the snapshot returned by copy_db_snapshot to the cached listings
+        :param response: the copy_db_snapshot response
+        :return: the copied snapshot
+        """
+        snapshot = response.get('DBSnapshot', {})
+        if snapshot.get('DBSnapshotIdentifier'):
+            with self._lock:
+                self._remember(snapshot)
+        return snapshot
+
+    def record_delete(self, snapshot_id):
+        """
+        Removes a snapshot deleted by delete_db_snapshot from the listings
+        :param snapshot_id: identifier of the deleted snapshot
+        """
+        with self._lock:
+            self._forget(snapshot_id)
+
+    def record_modify(self, response):
+        """
+        Keeps the attributes returned by modify_db_snapshot_attribute
+        :param response: the modify_db_snapshot_attribute response
+        """
+        result = response.get('DBSnapshotAttributesResult', {})
+        if result.get('DBSnapshotIdentifier'):
+            with self._lock:
+                self._attributes[result['DBSnapshotIdentifier']] = \
+                    result.get('DBSnapshotAttributes', [])
+
+    def attributes(self, snapshot_id):
+        """
+        :return: the last attributes we set on the snapshot, or None
+        """
+        return self._attributes.get(snapshot_id)
+
+    def _listing(self, instance, snapshot_type):
+        key = (instance or '', snapshot_type.lower())
+        if key not in self._listings:
+            logger.info('Reading {} snapshots of {}'
+                        .format(key[1], key[0] or 'all instances'))
+            self._listings[key] = OrderedDict(
+                (snapshot['DBSnapshotIdentifier'], snapshot)
+                for snapshot in iterate_snapshots(
+                    self.rds,
+                    SnapshotType=snapshot_type,
+                    DBInstanceIdentifier=instance,
+                    IncludeShared=True))
+        return self._listings[key]
+
+    def _remember(self, snapshot):
+        snapshot_id = snapshot['DBSnapshotIdentifier']
+        for (instance, snapshot_type), listing in self._listings.items():
+            if snapshot_id in listing:
+                listing[snapshot_id] = snapshot
+            elif _belongs_to_listing(snapshot, instance, snapshot_type):
+                listing[snapshot_id] = snapshot
+            else:
+                continue
+            if snapshot_type == 'shared':
+                self._shared_index = None
+
+    def _forget(self, snapshot_id):
+        for (_, snapshot_type), listing in self._listings.items():
+            if listing.pop(snapshot_id, None) is not None and \
+                    snapshot_type == 'shared':
+                self._shared_index = None
+
+
+def _belongs_to_listing(snapshot, instance, snapshot_type):
+    if instance and snapshot.get('DBInstanceIdentifier') != instance:
+        return False
+    return snapshot.get('SnapshotType', 'manual').lower() == snapshot_type
@@ -0,0 +1,109 @@
+"""
+    Idempotency ledger shared by the rdscopysnapshots and rdssavesnapshot
+    Lambda functions.
+
+    SNS delivers at least once and RDS can report more than one backup per
+    window, so the same snapshot can be backed up or saved twice. Before any
+    work, a function claims the snapshot in the ledger with a conditional
+    put. A repeated event finds the entry of the first one and returns at
+    once; it does not delete and copy the snapshot again.
+
+    Entries are keyed by the source snapshot id and record the state of its
+    copy: in_progress, copied and shared on the copy side, in_progress and
+    saved on the save side. An in_progress entry older than
+    LEDGER_LEASE_SECONDS is treated as the claim of an invocation that died,
+    and can be claimed again. The ledger is kept in the store named by
+    FAILSAFE_LEDGER (see rdsstate), and is off when it is empty.
+"""
+import logging
+import os
+import time
+
+from rdsstate import open_store
+
+FAILSAFE_LEDGER = os.getenv('FAILSAFE_LEDGER', '')
+LEDGER_LEASE_SECONDS = int(os.getenv('LEDGER_LEASE_SECONDS', '21600'))
+IN_PROGRESS = 'in_progress'
+COPIED = 'copied'
+SHARED = 'shared'
+SAVED = 'saved'
+
+logger = logging.getLogger()
+
+
+class IdempotencyLedger(object):
+    """
+    State of the copy of every source snapshot, claimed with conditional
+    puts so two invocations never work on the same snapshot
+    """
+
+    def __init__(self, store, lease_seconds=LEDGER_LEASE_SECONDS,
+                 clock=time.time):
+        """
+        :param store: store of the entries, see rdsstate
+        :param lease_seconds: age after which an in_progress entry can be
+        claimed again
+        :param clock: function returning the current time, replaceable for
+        tests
+        """
+        self.store = store
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+
+    def claim(self, snapshot_id, resumable=(), **fields):
+        """
+        Claims the copy of a snapshot, e.g. before copying it
+        :param snapshot_id: the source snapshot id
+        :param resumable: states of an entry the claim takes over, so the
+        work resumes from there
+        :param fields: attributes of the entry e.g. FailsafeSnapshotID
+        :return: tuple of True if the snapshot was claimed, and the entry
+        found in the ledger, None if there was none
+        """
+        entry = self.store.get(snapshot_id)
+        if entry is not None and not self._claimable(entry, resumable):
+            return False, entry
+        claim = dict(entry or {}, **fields)
+        claim.update({'State': IN_PROGRESS, 'UpdatedAt': self.clock()})
+        if self.store.put_if(snapshot_id, claim, entry):
+            return True, entry
+        return False, self.store.get(snapshot_id)
+
+    def advance(self, snapshot_id, state, **fields):
+        """
+        Records the progress of a claimed copy
+        :param snapshot_id: the source snapshot id
+        :param state: the new state e.g. SHARED
+        :param fields: attributes to add to the entry
+        """
+        entry = dict(self.store.get(snapshot_id) or {}, **fields)
+        entry.update({'State': state, 'UpdatedAt': self.clock()})
+        self.store.update({snapshot_id: entry})
+
+    def release(self, snapshot_id):
+        """
+        Drops the claim of a copy that failed, so a retry starts over
+        :param snapshot_id: the source snapshot id
+        """
+        self.store.update(removed=[snapshot_id])
+
+    def get(self, snapshot_id):
+        """
+        :return: the entry of the snapshot, None if it was never claimed
+        """
+        return self.store.get(snapshot_id)
+
+    def _claimable(self, entry, resumable):
+        if entry.get('State') in resumable:
+            return True
+        return entry.get('State') == IN_PROGRESS and \
+            entry.get('UpdatedAt', 0) + self.lease_seconds <= self.clock()
+
+
+def ledger_from_environment():
+    """
+    :return: IdempotencyLedger kept in FAILSAFE_LEDGER, None when it is not
+    set
+    """
+    store = open_store(FAILSAFE_LEDGER, 'ledger')
+    return IdempotencyLedger(store) if store is not None else None
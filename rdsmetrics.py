@@ -0,0 +1,252 @@
+"""
+    AWS API call metrics shared by the rdscopysnapshots and rdssavesnapshot
+    Lambda functions.
+
+    ApiMetrics hooks into the botocore events of every client the
+    ClientRegistry creates and counts, per operation, the calls, the retries
+    botocore made, the throttled attempts, the errors and the latency of the
+    calls. metered_handler resets the counts when a handler starts and,
+    whatever the outcome, prints them as one CloudWatch Embedded Metric
+    Format line when it ends, so CloudWatch turns the log line into metrics
+    without any extra service.
+
+    The same line carries the metrics the pipelines measure themselves:
+    record_copy adds the duration and the allocated size of every snapshot
+    copy, so full and incremental copies can be compared, and
+    record_estimate the predicted and actual durations of the waits on
+    copies.
+"""
+from __future__ import print_function
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'FailsafeRdsBackup')
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException',
+                          'RequestLimitExceeded', 'TooManyRequestsException')
+COUNT_METRICS = ('Calls', 'Retries', 'Throttles', 'Errors')
+LATENCY_METRICS = ('LatencyTotal', 'LatencyMax')
+GIB = 1024 ** 3
+_STARTED = 'api_metrics_started'
+
+
+class ApiMetrics(object):
+    """
+    Per-operation API call metrics of one handler invocation. Clients are
+    instrumented once and feed whichever invocation is running; updates
+    come from the worker threads too, so they are serialised.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        :param clock: function returning the current time, replaceable for
+        tests
+        """
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._operations = defaultdict(lambda: defaultdict(float))
+        self._values = defaultdict(list)
+        self._units = {}
+        self._properties = {}
+
+    def instrument(self, service_client):
+        """
+        Registers the botocore event hooks of the metrics on a client.
+        Objects without botocore events, e.g. test doubles, are left as
+        they are.
+        :param service_client: the Boto3 client
+        :return: the client
+        """
+        events = getattr(getattr(service_client, 'meta', None), 'events',
+                         None)
+        if events is None or not hasattr(events, 'register'):
+            return service_client
+        events.register('before-call.*.*', self._before_call)
+        events.register('needs-retry.*.*', self._needs_retry)
+        events.register('after-call.*.*', self._after_call)
+        events.register('after-call-error.*.*', self._after_call_error)
+        return service_client
+
+    def reset(self):
+        """
+        Forgets the metrics of the previous invocation
+        """
+        with self._lock:
+            self._operations.clear()
+            self._values.clear()
+            self._properties.clear()
+
+    def operations(self):
+        """
+        :return: dict of the metrics of each operation called so far
+        """
+        with self._lock:
+            return dict((operation, dict(metrics))
+                        for operation, metrics in self._operations.items())
+
+    def record(self, name, value, unit='None', **properties):
+        """
+        Adds a value of a metric measured by the pipeline itself, e.g. the
+        duration of a copy. The values of one invocation are emitted as a
+        list.
+        :param name: name of the metric
+        :param value: the measured value
+        :param unit: CloudWatch unit of the metric e.g. 'Seconds'
+        :param properties: values added to the record to filter on in
+        CloudWatch Logs Insights, e.g. CopyMode
+        """
+        with self._lock:
+            self._values[name].append(value)
+            self._units[name] = unit
+            self._properties.update(properties)
+
+    def values(self):
+        """
+        :return: dict of the values recorded so far for each metric
+        """
+        with self._lock:
+            return dict((name, list(values))
+                        for name, values in self._values.items())
+
+    def emf_record(self, function_name):
+        """
+        :param function_name: value of the Function dimension
+        :return: the metrics as a CloudWatch Embedded Metric Format record
+        """
+        operations = self.operations()
+        values = self.values()
+        record = {'Function': function_name}
+        with self._lock:
+            record.update(self._properties)
+        definitions = []
+        for operation in sorted(operations):
+            for name in COUNT_METRICS + LATENCY_METRICS:
+                metric = '{}.{}'.format(operation, name)
+                record[metric] = round(operations[operation].get(name, 0), 1)
+                definitions.append({
+                    'Name': metric,
+                    'Unit': 'Count' if name in COUNT_METRICS
+                    else 'Milliseconds'})
+        for name in sorted(values):
+            record[name] = values[name]
+            definitions.append({'Name': name, 'Unit': self._units[name]})
+        record['_aws'] = {
+            'Timestamp': int(self.clock() * 1000),
+            'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE,
+                                   'Dimensions': [['Function']],
+                                   'Metrics': definitions}]}
+        return record
+
+    def emit(self, function_name):
+        """
+        Prints the metrics as one EMF line. Lambda forwards stdout to
+        CloudWatch Logs as is, where the logging module would prefix it.
+        :param function_name: value of the Function dimension
+        """
+        print(json.dumps(self.emf_record(function_name), sort_keys=True))
+
+    def _add(self, operation, name, value=1):
+        with self._lock:
+            metrics = self._operations[operation]
+            if name == 'LatencyMax':
+                metrics[name] = max(metrics[name], value)
+            else:
+                metrics[name] += value
+
+    def _before_call(self, model, context, **kwargs):
+        context[_STARTED] = self.clock()
+        self._add(model.name, 'Calls')
+
+    def _needs_retry(self, operation, response=None, **kwargs):
+        if response and _error_code(response[1]) in THROTTLING_ERROR_CODES:
+            self._add(operation.name, 'Throttles')
+
+    def _after_call(self, model, parsed, context, **kwargs):
+        if _error_code(parsed):
+            self._add(model.name, 'Errors')
+        self._finish(model.name, context, parsed)
+
+    def _after_call_error(self, context, exception=None, **kwargs):
+        operation = _operation_name(kwargs.get('event_name', ''))
+        self._add(operation, 'Errors')
+        self._finish(operation, context,
+                     getattr(exception, 'response', None) or {})
+
+    def _finish(self, operation, context, parsed):
+        retries = (parsed or {}).get('ResponseMetadata', {}) \
+            .get('RetryAttempts', 0)
+        if retries:
+            self._add(operation, 'Retries', retries)
+        started = context.pop(_STARTED, None)
+        if started is not None:
+            latency = (self.clock() - started) * 1000.0
+            self._add(operation, 'LatencyTotal', latency)
+            self._add(operation, 'LatencyMax', latency)
+
+
+def record_copy(metrics, snapshot, duration, mode):
+    """
+    Records the duration and the allocated size of a finished snapshot copy.
+    RDS does not report the bytes a copy transferred, so the allocated
+    storage of the snapshot is the size recorded.
+    :param metrics: ApiMetrics of the pipeline
+    :param snapshot: payload of the copied snapshot
+    :param duration: seconds from the start of the copy to its availability
+    :param mode: the copy mode, 'full' or 'incremental'
+    """
+    metrics.record('CopyDuration', round(duration, 1), 'Seconds',
+                   CopyMode=mode)
+    if snapshot.get('AllocatedStorage') is not None:
+        metrics.record('CopyAllocatedBytes',
+                       snapshot['AllocatedStorage'] * GIB, 'Bytes')
+
+
+def record_estimate(metrics, outcome):
+    """
+    Records how long a wait on a copy was predicted to take and how long it
+    took, see rdsprogress
+    :param metrics: ApiMetrics of the pipeline
+    :param outcome: dict of the Predicted and Actual durations in seconds,
+    nothing is recorded for None
+    """
+    if not outcome:
+        return
+    metrics.record('CopyActualDuration', round(outcome['Actual'], 1),
+                   'Seconds')
+    if outcome['Predicted'] is not None:
+        metrics.record('CopyPredictedDuration',
+                       round(outcome['Predicted'], 1), 'Seconds')
+
+
+def metered_handler(metrics, function_name):
+    """
+    Decorates a Lambda handler to emit its API metrics as it ends
+    :param metrics: ApiMetrics fed by the clients of the handler
+    :param function_name: value of the Function dimension, the name in the
+    Lambda context takes precedence
+    :return: the decorator
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def metered(event, context):
+            metrics.reset()
+            try:
+                return handler(event, context)
+            finally:
+                name = getattr(context, 'function_name', None)
+                metrics.emit(name if isinstance(name, str)
+                             else function_name)
+        return metered
+    return decorator
+
+
+def _error_code(parsed):
+    return ((parsed or {}).get('Error') or {}).get('Code')
+
+
+def _operation_name(event_name):
+    return event_name.split('.')[-1] or 'Unknown'
@@ -0,0 +1,194 @@
+"""
+    Action plan of a fleet backup run of rdscopysnapshots, computed from one
+    snapshot inventory before anything is written.
+
+    plan_backups reads the automated and the manual snapshots of the whole
+    account once, instead of once per instance, and decides for every
+    instance which failsafe snapshots to delete, which automated snapshot
+    to copy, and which failsafe snapshot to share and notify the Failsafe
+    account of. The plan is then applied by rdscopysnapshots, which deletes
+    in one bulk run and copies on its thread pool, or only printed on a dry
+    run.
+
+    For every instance:
+        - the newest available automated snapshot is the one backed up, an
+          instance without one is skipped
+        - a failsafe snapshot of it that is still being copied skips the
+          instance, an available one is shared and notified again rather
+          than copied again
+        - the other failsafe snapshots of the instance are deleted, before
+          the copy in 'full' copy mode and after it in 'incremental' mode
+"""
+from collections import OrderedDict, defaultdict, namedtuple
+
+from rdsinventory import newest_snapshot
+
+DELETE = 'delete'
+COPY = 'copy'
+SHARE = 'share'
+NOTIFY = 'notify'
+
+Action = namedtuple('Action', ['kind', 'instance', 'snapshot', 'source'])
+
+
+class BackupPlan(object):
+    """
+    Actions of a run, in the order they are applied for each instance
+    """
+
+    def __init__(self, incremental=False):
+        """
+        :param incremental: whether the plan was computed for incremental
+        copies, see FAILSAFE_COPY_MODE
+        """
+        self.incremental = incremental
+        self.actions = OrderedDict()
+        self.skipped = OrderedDict()
+        self._instances = []
+
+    def add(self, kind, instance, snapshot, source=None):
+        """
+        Appends an action to the actions of the instance
+        :param kind: DELETE, COPY, SHARE or NOTIFY
+        :param instance: name of the DB instance
+        :param snapshot: the failsafe snapshot the action applies to
+        :param source: the automated snapshot a COPY is made from
+        """
+        if instance not in self.actions:
+            self._instances.append(instance)
+        self.actions.setdefault(instance, []).append(
+            Action(kind, instance, snapshot, source))
+
+    def skip(self, instance, reason):
+        """
+        Records an instance the run has nothing to do for
+        """
+        self._instances.append(instance)
+        self.skipped[instance] = reason
+
+    @property
+    def instances(self):
+        """
+        :return: names of the planned and the skipped instances, in the
+        order they were planned
+        """
+        return list(self._instances)
+
+    def of_kind(self, kind, instances=None):
+        """
+        :param kind: DELETE, COPY, SHARE or NOTIFY
+        :param instances: instances the actions are selected from, all of
+        them when None
+        :return: list of the actions of the kind
+        """
+        return [action for instance, actions in self.actions.items()
+                if instances is None or instance in instances
+                for action in actions if action.kind == kind]
+
+    def deletes_before_copy(self, instance):
+        """
+        :return: identifiers of the snapshots of the instance deleted before
+        its copy, or deleted at once when it is not copied
+        """
+        actions = self.actions.get(instance, [])
+        kinds = [action.kind for action in actions]
+        copy_at = kinds.index(COPY) if COPY in kinds else len(actions)
+        return [action.snapshot for action in actions[:copy_at]
+                if action.kind == DELETE]
+
+    def deletes_after_copy(self, instance):
+        """
+        :return: identifiers of the snapshots of the instance deleted once
+        its copy is available
+        """
+        actions = self.actions.get(instance, [])
+        kinds = [action.kind for action in actions]
+        if COPY not in kinds:
+            return []
+        return [action.snapshot for action in actions[kinds.index(COPY):]
+                if action.kind == DELETE]
+
+    def as_dict(self):
+        """
+        :return: counts of the actions of every kind and of skipped instances
+        """
+        counts = OrderedDict((name, len(self.of_kind(kind)))
+                             for name, kind in (('Deletes', DELETE),
+                                                ('Copies', COPY),
+                                                ('Shares', SHARE),
+                                                ('Notifications', NOTIFY)))
+        counts['Skipped'] = len(self.skipped)
+        return counts
+
+    def describe(self):
+        """
+        :return: lines of text listing every action, e.g. for a dry run
+        """
+        lines = []
+        for actions in self.actions.values():
+            for action in actions:
+                line = '{:<7} {:<30} {}'.format(action.kind, action.instance,
+                                                action.snapshot)
+                if action.source:
+                    line += ' from {}'.format(action.source)
+                lines.append(line)
+        for instance, reason in self.skipped.items():
+            lines.append('{:<7} {:<30} {}'.format('skip', instance, reason))
+        return lines
+
+    def __repr__(self):
+        return ', '.join('{} {}'.format(count, name.lower())
+                         for name, count in self.as_dict().items())
+
+
+def plan_backups(instances, inventory, name_of_failsafe_snapshot, prefix,
+                 incremental=False):
+    """
+    Computes the actions of the backup of every instance
+    :param instances: names of the DB instances to back up
+    :param inventory: SnapshotInventory the account-wide listings are read
+    from
+    :param name_of_failsafe_snapshot: function returning the name of the
+    failsafe snapshot of an automated snapshot
+    :param prefix: prefix of the names of the failsafe snapshots, see
+    FAILSAFE_SNAPSHOT_PREFIX
+    :param incremental: whether the copies are incremental, in which case
+    the superseded failsafe snapshots are deleted after the copy, see
+    FAILSAFE_COPY_MODE
+    :return: BackupPlan of the run
+    """
+    automated = defaultdict(list)
+    for snapshot in inventory.snapshots('', 'automated'):
+        if snapshot.get('Status') == 'available':
+            automated[snapshot.get('DBInstanceIdentifier')].append(snapshot)
+    failsafe = defaultdict(list)
+    for snapshot in inventory.snapshots('', 'manual'):
+        if snapshot['DBSnapshotIdentifier'].startswith(prefix):
+            failsafe[snapshot.get('DBInstanceIdentifier')].append(snapshot)
+    plan = BackupPlan(incremental)
+    for instance in instances:
+        source = newest_snapshot(
+            automated[instance],
+            lambda snapshot: snapshot['SnapshotCreateTime'])
+        if source is None:
+            plan.skip(instance, 'No available automated snapshot')
+            continue
+        name = name_of_failsafe_snapshot(source['DBSnapshotIdentifier'])
+        existing = [snapshot for snapshot in failsafe[instance]
+                    if snapshot['DBSnapshotIdentifier'] == name]
+        if existing and existing[0].get('Status') != 'available':
+            plan.skip(instance, 'Copy of {} in progress'.format(name))
+            continue
+        superseded = [snapshot['DBSnapshotIdentifier']
+                      for snapshot in failsafe[instance]
+                      if snapshot['DBSnapshotIdentifier'] != name]
+        deleted_first = not incremental or existing
+        for snapshot_id in superseded if deleted_first else []:
+            plan.add(DELETE, instance, snapshot_id)
+        if not existing:
+            plan.add(COPY, instance, name, source['DBSnapshotIdentifier'])
+        for snapshot_id in [] if deleted_first else superseded:
+            plan.add(DELETE, instance, snapshot_id)
+        plan.add(SHARE, instance, name)
+        plan.add(NOTIFY, instance, name)
+    return plan
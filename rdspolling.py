@@ -0,0 +1,110 @@
+"""
+    Polling helpers shared by the rdscopysnapshots and rdssavesnapshot Lambda
+    functions.
+
+    Waiting on a snapshot copy backs off exponentially with jitter and keeps
+    an eye on the time the Lambda function has left. When the next sleep
+    would run into the function timeout DeadlineExceeded is raised, so the
+    caller can hand off the remaining work instead of being killed mid-loop.
+"""
+import random
+import time
+
+POLL_INITIAL_INTERVAL_SECONDS = 5
+POLL_MAX_INTERVAL_SECONDS = 60
+POLL_BACKOFF_MULTIPLIER = 2
+DEADLINE_SAFETY_MARGIN_SECONDS = 15
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the function is about to time out. started is the time the
+    copy waited on was started, when SnapshotWaiter knows it, so the wait
+    can be continued with it.
+    """
+    started = None
+
+
+class PollingSchedule(object):
+    """
+    Exponential backoff with jitter bounded by the Lambda deadline.
+    Sleeps grow from initial_interval by multiplier up to max_interval, each
+    one drawn between half and the whole of the current interval.
+    """
+
+    def __init__(self, context=None,
+                 initial_interval=POLL_INITIAL_INTERVAL_SECONDS,
+                 max_interval=POLL_MAX_INTERVAL_SECONDS,
+                 multiplier=POLL_BACKOFF_MULTIPLIER,
+                 safety_margin=DEADLINE_SAFETY_MARGIN_SECONDS,
+                 sleep=None):
+        """
+        :param context: the Lambda context object, the schedule has no
+        deadline when it is None
+        :param initial_interval: seconds of the first sleep
+        :param max_interval: upper bound of a single sleep in seconds
+        :param multiplier: growth factor of the interval after every sleep
+        :param safety_margin: seconds kept free before the deadline to hand
+        off the remaining work
+        :param sleep: function used to sleep, replaceable for tests, e.g.
+        by the virtual clock of rdssimulator. time.sleep when None
+        """
+        self.context = context
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.safety_margin = safety_margin
+        self.sleep = sleep or time.sleep
+        self.attempts = 0
+
+    def remaining_seconds(self):
+        """
+        :return: seconds left before the Lambda timeout, or None when the
+        schedule is not bound to a Lambda context
+        """
+        remaining = getattr(self.context, 'get_remaining_time_in_millis',
+                            None)
+        return remaining() / 1000.0 if remaining else None
+
+    def next_interval(self):
+        """
+        :return: seconds to sleep before the next poll
+        """
+        interval = min(self.max_interval,
+                       self.initial_interval *
+                       self.multiplier ** self.attempts)
+        return random.uniform(interval / 2.0, interval)
+
+    def wait(self, interval=None):
+        """
+        Sleeps until the next poll is due
+        :param interval: seconds to sleep instead of the backoff interval,
+        e.g. until a copy is predicted to complete
+        :raises DeadlineExceeded: if sleeping would leave less than the
+        safety margin before the Lambda timeout
+        """
+        if interval is None:
+            interval = self.next_interval()
+        remaining = self.remaining_seconds()
+        if remaining is not None and \
+                remaining - interval < self.safety_margin:
+            raise DeadlineExceeded(
+                'Deadline reached after {} polls, {:.1f}s left'
+                .format(self.attempts, remaining))
+        self.sleep(interval)
+        self.attempts += 1
+
+
+def poll_until(check, schedule):
+    """
+    Calls check after every wait of the schedule until it returns a value
+    :param check: function returning a truthy value when polling is done
+    :param schedule: PollingSchedule driving the waits
+    :return: the value returned by check
+    :raises DeadlineExceeded: when the schedule runs out of time
+    """
+    while True:
+        schedule.wait()
+        result = check()
+        if result:
+            return result
@@ -0,0 +1,183 @@
+"""
+    Completion estimates of the snapshot copies, used by rdswaiter to sleep
+    until a copy is due to complete rather than poll it at a fixed pace.
+
+    CopyProgressEstimator fits the copy rate of a snapshot to its recent
+    PercentProgress samples, read from the describes the waiter makes
+    anyway. Before two samples show progress, the rate of the past copies
+    of the same instance, in seconds per GiB of AllocatedStorage, predicts
+    the duration of the copy instead. The rates are kept in the store named
+    by COPY_HISTORY (see rdsstate), or for the life of the container when it
+    is empty.
+
+    The duration predicted first and the duration observed are kept for
+    every completed copy, so the accuracy of the estimates can be reported
+    as metrics, see rdsmetrics.record_estimate.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from rdsstate import MemoryStore, open_store
+
+COPY_HISTORY = os.getenv('COPY_HISTORY', '')
+ETA_PROGRESS_SAMPLES = int(os.getenv('ETA_PROGRESS_SAMPLES', '5'))
+ETA_HISTORY_WEIGHT = 0.5
+
+
+class CopyProgressEstimator(object):
+    """
+    Predicts the time left until the copies in progress complete
+    """
+
+    def __init__(self, history=None, samples=ETA_PROGRESS_SAMPLES,
+                 clock=time.time):
+        """
+        :param history: store of the copy rate of every instance, see
+        rdsstate, a MemoryStore when None
+        :param samples: number of the recent progress samples the rate of a
+        copy is fitted to
+        :param clock: function returning the current time, replaceable for
+        tests
+        """
+        self.history = history if history is not None else MemoryStore()
+        self.samples = samples
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._copies = {}
+        self._outcomes = {}
+
+    def start(self, snapshot_id, started=None):
+        """
+        Registers a copy, its duration is measured from now
+        :param snapshot_id: the identifier of the snapshot being copied
+        :param started: the time the copy was started, when it was started
+        before this wait e.g. by the invocation a wait was continued from
+        """
+        with self._lock:
+            self._copies.setdefault(snapshot_id, {
+                'started': started if started is not None else self.clock(),
+                'samples': deque(maxlen=self.samples),
+                'instance': None,
+                'allocated_storage': None,
+                'predicted': None})
+
+    def observe(self, snapshot):
+        """
+        Adds the progress of a copy read from a describe
+        :param snapshot: the described snapshot
+        """
+        now = self.clock()
+        with self._lock:
+            copy = self._copies.get(snapshot['DBSnapshotIdentifier'])
+            if copy is None:
+                return
+            copy['instance'] = snapshot.get('DBInstanceIdentifier')
+            copy['allocated_storage'] = snapshot.get('AllocatedStorage')
+            if snapshot.get('PercentProgress') is not None:
+                copy['samples'].append((now,
+                                        float(snapshot['PercentProgress'])))
+            if copy['predicted'] is None:
+                remaining = self._remaining(copy, now)
+                if remaining is not None:
+                    copy['predicted'] = now + remaining - copy['started']
+
+    def remaining(self, snapshot_id):
+        """
+        :param snapshot_id: the identifier of the snapshot being copied
+        :return: seconds until the copy is predicted to complete, None
+        without progress samples or history to go by
+        """
+        with self._lock:
+            copy = self._copies.get(snapshot_id)
+            return self._remaining(copy, self.clock()) if copy else None
+
+    def complete(self, snapshot):
+        """
+        Records a completed copy and learns the copy rate of its instance
+        :param snapshot: the available snapshot
+        :return: dict of the Predicted and Actual durations of the copy in
+        seconds, Predicted is None when no estimate was made
+        """
+        now = self.clock()
+        with self._lock:
+            copy = self._copies.pop(snapshot['DBSnapshotIdentifier'], None)
+            if copy is None:
+                return None
+            actual = now - copy['started']
+            instance = snapshot.get('DBInstanceIdentifier') or \
+                copy['instance']
+            allocated_storage = snapshot.get('AllocatedStorage') or \
+                copy['allocated_storage']
+            if instance and allocated_storage:
+                key = 'rate:{}'.format(instance)
+                rate = actual / allocated_storage
+                previous = self.history.get(key)
+                if previous is not None:
+                    rate = ETA_HISTORY_WEIGHT * rate + \
+                        (1 - ETA_HISTORY_WEIGHT) * previous
+                self.history.update({key: rate})
+            outcome = {'Predicted': copy['predicted'], 'Actual': actual}
+            self._outcomes[snapshot['DBSnapshotIdentifier']] = outcome
+            return outcome
+
+    def started(self, snapshot_id):
+        """
+        :return: the time the copy of the snapshot was started, None when it
+        is not registered
+        """
+        with self._lock:
+            copy = self._copies.get(snapshot_id)
+            return copy['started'] if copy else None
+
+    def forget(self, snapshot_id):
+        """
+        Drops a copy that is no longer waited on
+        """
+        with self._lock:
+            self._copies.pop(snapshot_id, None)
+
+    def outcome(self, snapshot_id):
+        """
+        :return: the dict complete returned for the snapshot, once
+        """
+        with self._lock:
+            return self._outcomes.pop(snapshot_id, None)
+
+    def _remaining(self, copy, now):
+        rate = _progress_rate(copy['samples'])
+        if rate:
+            last_sampled, progress = copy['samples'][-1]
+            return max(0.0, (100.0 - progress) / rate - (now - last_sampled))
+        if copy['instance'] and copy['allocated_storage']:
+            seconds_per_gib = self.history.get(
+                'rate:{}'.format(copy['instance']))
+            if seconds_per_gib is not None:
+                return max(0.0, copy['started'] +
+                           seconds_per_gib * copy['allocated_storage'] - now)
+        return None
+
+
+def _progress_rate(samples):
+    """
+    Least squares slope of the progress samples
+    :return: percent per second, None unless the samples show progress
+    """
+    if len(samples) < 2:
+        return None
+    mean_time = sum(sampled for sampled, _ in samples) / len(samples)
+    mean_progress = sum(progress for _, progress in samples) / len(samples)
+    variance = sum((sampled - mean_time) ** 2 for sampled, _ in samples)
+    if not variance:
+        return None
+    slope = sum((sampled - mean_time) * (progress - mean_progress)
+                for sampled, progress in samples) / variance
+    return slope if slope > 0 else None
+
+
+def estimator_from_environment():
+    """
+    :return: CopyProgressEstimator learning from the store of COPY_HISTORY
+    """
+    return CopyProgressEstimator(open_store(COPY_HISTORY, 'copy_history'))
@@ -0,0 +1,302 @@
+"""
+    Grandfather-father-son retention of the failsafe snapshots of the
+    Failsafe account, run by rdssavesnapshot on its own schedule rather than
+    after every save.
+
+    The manual snapshots of the whole account are read in one paginated
+    listing and grouped by instance. For every instance, RetentionPolicy
+    keeps the newest available failsafe snapshot of each of the last
+    RETENTION_DAILY days, RETENTION_WEEKLY ISO weeks, RETENTION_MONTHLY
+    months and RETENTION_YEARLY years. The other available failsafe
+    snapshots of every instance are then deleted in one bulk run. Snapshots
+    still being copied, and manual snapshots not named failsafe-*, are never
+    deleted.
+
+    The keep-set of an instance only changes when a snapshot is added to it.
+    When RETENTION_STATE names a store (see rdsstate), RetentionManifest
+    keeps the newest snapshot seen and, for every kept snapshot, the time it
+    is due to leave the keep-set if snapshots keep coming. A run still reads
+    the listing, since RDS cannot list only the snapshots created since a
+    date, but only evaluates the instances with a new snapshot or a snapshot
+    due to expire.
+"""
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from rdsdeletion import delete_snapshots
+from rdsinventory import SnapshotInventory
+from rdsstate import open_store
+
+FAILSAFE_SNAPSHOT_PREFIX = 'failsafe-'
+RETENTION_DAILY = int(os.getenv('RETENTION_DAILY', '7'))
+RETENTION_WEEKLY = int(os.getenv('RETENTION_WEEKLY', '4'))
+RETENTION_MONTHLY = int(os.getenv('RETENTION_MONTHLY', '12'))
+RETENTION_YEARLY = int(os.getenv('RETENTION_YEARLY', '3'))
+RETENTION_STATE = os.getenv('RETENTION_STATE', '')
+RETENTION_REVIEW_INTERVAL_SECONDS = 24 * 60 * 60
+
+logger = logging.getLogger()
+
+
+def _day(created):
+    return created.date()
+
+
+def _week(created):
+    return tuple(created.isocalendar()[:2])
+
+
+def _month(created):
+    return created.year, created.month
+
+
+def _year(created):
+    return created.year
+
+
+def _period_end(created, name, count):
+    day = datetime(created.year, created.month, created.day,
+                   tzinfo=created.tzinfo)
+    if name == 'daily':
+        return day + timedelta(days=count)
+    if name == 'weekly':
+        return day + timedelta(days=7 * count - created.weekday())
+    if name == 'monthly':
+        months = created.year * 12 + created.month - 1 + count
+        return day.replace(year=months // 12, month=months % 12 + 1, day=1)
+    return day.replace(year=created.year + count, month=1, day=1)
+
+
+def _timestamp(created):
+    return created.timestamp()
+
+
+class RetentionPolicy(object):
+    """
+    Number of daily, weekly, monthly and yearly snapshots kept per instance
+    """
+
+    def __init__(self, daily=RETENTION_DAILY, weekly=RETENTION_WEEKLY,
+                 monthly=RETENTION_MONTHLY, yearly=RETENTION_YEARLY):
+        """
+        :raises ValueError: if no daily snapshot is kept, the newest
+        snapshot of an instance must never be deleted
+        """
+        if daily < 1:
+            raise ValueError('At least one daily snapshot must be kept')
+        self.periods = (('daily', daily, _day),
+                        ('weekly', weekly, _week),
+                        ('monthly', monthly, _month),
+                        ('yearly', yearly, _year))
+
+    def keep(self, snapshots):
+        """
+        Computes the keep-set of one instance
+        :param snapshots: available snapshots of the instance, in any order
+        :return: dict of the identifiers of the kept snapshots to the names
+        of the periods keeping them
+        """
+        newest_first = sorted(snapshots,
+                              key=lambda snapshot:
+                              snapshot['SnapshotCreateTime'],
+                              reverse=True)
+        kept = defaultdict(list)
+        for name, count, period_of in self.periods:
+            periods = set()
+            for snapshot in newest_first:
+                if len(periods) >= count:
+                    break
+                period = period_of(snapshot['SnapshotCreateTime'])
+                if period not in periods:
+                    periods.add(period)
+                    kept[snapshot['DBSnapshotIdentifier']].append(name)
+        return dict(kept)
+
+    def expiry(self, snapshot, periods):
+        """
+        Estimates when a kept snapshot leaves the keep-set, assuming a
+        snapshot is taken every day from now on
+        :param snapshot: the kept snapshot
+        :param periods: names of the periods keeping it
+        :return: the time of the expiry, in seconds since the epoch
+        """
+        created = snapshot['SnapshotCreateTime']
+        return max(_timestamp(_period_end(created, name, count))
+                   for name, count, _ in self.periods if name in periods)
+
+    def __repr__(self):
+        return ', '.join('{} {}'.format(count, name)
+                         for name, count, _ in self.periods)
+
+
+class RetentionManifest(object):
+    """
+    State of the retention between runs: the newest snapshot seen and the
+    time each kept snapshot is due for review
+    """
+
+    REVIEW_PREFIX = 'review:'
+
+    def __init__(self, store, policy, clock=time.time):
+        """
+        :param store: the store of the state, see rdsstate
+        :param policy: RetentionPolicy of the run; a manifest recorded
+        under another policy is reviewed in full
+        :param clock: function returning the current time, replaceable for
+        tests
+        """
+        self.store = store
+        self.policy = repr(policy)
+        self.now = clock()
+        state = store.items()
+        self.high_water_mark = state.get('high_water_mark', 0)
+        self._stale = state.get('policy') != self.policy
+        self.review_at = {} if self._stale else dict(
+            (key[len(self.REVIEW_PREFIX):], value)
+            for key, value in state.items()
+            if key.startswith(self.REVIEW_PREFIX))
+        self._reviewed = set()
+        self._removed = set()
+
+    def needs_review(self, snapshots):
+        """
+        :param snapshots: available failsafe snapshots of one instance
+        :return: True if one of them is new or due to expire
+        """
+        return any(self.review_at.get(snapshot['DBSnapshotIdentifier'],
+                                      0) <= self.now
+                   for snapshot in snapshots)
+
+    def record(self, snapshots, keep, policy):
+        """
+        Records the review of the snapshots of one instance
+        :param snapshots: available failsafe snapshots of the instance
+        :param keep: keep-set computed by the policy
+        :param policy: RetentionPolicy the keep-set was computed with
+        """
+        for snapshot in snapshots:
+            snapshot_id = snapshot['DBSnapshotIdentifier']
+            self.high_water_mark = max(
+                self.high_water_mark,
+                _timestamp(snapshot['SnapshotCreateTime']))
+            if snapshot_id in keep:
+                self.review_at[snapshot_id] = max(
+                    policy.expiry(snapshot, keep[snapshot_id]),
+                    self.now + RETENTION_REVIEW_INTERVAL_SECONDS)
+                self._reviewed.add(snapshot_id)
+            else:
+                self.forget(snapshot_id)
+
+    def forget(self, snapshot_id):
+        """
+        Drops a snapshot that expired or is no longer listed
+        """
+        if self.review_at.pop(snapshot_id, None) is not None:
+            self._removed.add(snapshot_id)
+        self._reviewed.discard(snapshot_id)
+
+    def new_snapshots(self, snapshots):
+        """
+        :return: number of the snapshots newer than the newest one seen
+        """
+        return sum(1 for snapshot in snapshots
+                   if _timestamp(snapshot['SnapshotCreateTime']) >
+                   self.high_water_mark)
+
+    def save(self):
+        """
+        Writes the changes of the run to the store
+        """
+        values = dict((self.REVIEW_PREFIX + snapshot_id,
+                       self.review_at[snapshot_id])
+                      for snapshot_id in self._reviewed)
+        values.update({'high_water_mark': self.high_water_mark,
+                       'policy': self.policy})
+        removed = [self.REVIEW_PREFIX + snapshot_id
+                   for snapshot_id in self._removed]
+        if self._stale:
+            removed = [key for key in self.store.items()
+                       if key.startswith(self.REVIEW_PREFIX) and
+                       key[len(self.REVIEW_PREFIX):] not in self.review_at]
+        self.store.update(values, removed)
+
+
+def plan_retention(snapshots, policy, manifest=None):
+    """
+    Splits the failsafe snapshots of the account into kept and expired
+    snapshots, instance by instance
+    :param snapshots: manual snapshots of the account, in any order
+    :param policy: RetentionPolicy applied to every instance
+    :param manifest: RetentionManifest of the previous runs, the instances
+    without a new snapshot or a snapshot due to expire are then skipped
+    :return: tuple of the dict of the kept snapshot identifiers to their
+    periods, and the list of the expired snapshot identifiers
+    """
+    by_instance = defaultdict(list)
+    for snapshot in snapshots:
+        if snapshot['DBSnapshotIdentifier'].startswith(
+                FAILSAFE_SNAPSHOT_PREFIX) and \
+                snapshot.get('Status') == 'available':
+            by_instance[snapshot.get('DBInstanceIdentifier')].append(snapshot)
+    kept, expired = {}, []
+    for instance in sorted(by_instance, key=str):
+        if manifest is not None and \
+                not manifest.needs_review(by_instance[instance]):
+            continue
+        keep = policy.keep(by_instance[instance])
+        kept.update(keep)
+        expired.extend(snapshot['DBSnapshotIdentifier']
+                       for snapshot in by_instance[instance]
+                       if snapshot['DBSnapshotIdentifier'] not in keep)
+        if manifest is not None:
+            manifest.record(by_instance[instance], keep, policy)
+    return kept, expired
+
+
+def apply_retention(rds, policy=None, inventory=None, context=None,
+                    store=None, clock=time.time):
+    """
+    Applies the retention policy to every instance of the account
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param policy: RetentionPolicy, the policy of the environment when
+    not provided
+    :param inventory: SnapshotInventory the listing is read from, a new one
+    is created when not provided
+    :param context: the Lambda context bounding the retries of throttled
+    deletions
+    :param store: store of the RetentionManifest, every instance is
+    evaluated on every run when None
+    :param clock: function returning the current time, replaceable for
+    tests
+    :return: DeletionSummary of the deletions
+    """
+    policy = policy or RetentionPolicy()
+    inventory = inventory or SnapshotInventory(rds)
+    snapshots = inventory.snapshots('', 'manual')
+    manifest = RetentionManifest(store, policy, clock) \
+        if store is not None else None
+    if manifest is not None:
+        logger.info('{} failsafe snapshots created since the last retention'
+                    .format(manifest.new_snapshots(snapshots)))
+        listed = set(snapshot['DBSnapshotIdentifier']
+                     for snapshot in snapshots)
+        for snapshot_id in list(manifest.review_at):
+            if snapshot_id not in listed:
+                manifest.forget(snapshot_id)
+    kept, expired = plan_retention(snapshots, policy, manifest)
+    logger.info('Retention of {}: keeping {} failsafe snapshots, deleting {}'
+                .format(policy, len(kept), len(expired)))
+    summary = delete_snapshots(rds, expired, inventory, context)
+    if manifest is not None:
+        manifest.save()
+    return summary
+
+
+def retention_store():
+    """
+    :return: the store of RETENTION_STATE, None when it is not set
+    """
+    return open_store(RETENTION_STATE, 'retention')
@@ -8,23 +8,63 @@
 
     FAILSAFE_TAG: this tag has to put on the target DB for its snapshots
     to be backed up to the Failsafe Account
+
+    Every record of an SNS batch is saved as its own job, once per
+    FailsafeSnapshotID, up to MAX_PARALLEL_SAVES of them at a time, and the
+    copies wait on one shared SnapshotWaiter, see rdswaiter. The
+    retention of the failsafe snapshots runs for the whole account on the
+    scheduled event of the template instead, see rdsretention.
+
+    With FAILSAFE_LEDGER set, each FailsafeSnapshotID is claimed in the
+    idempotency ledger before it is saved, so a repeated notification
+    returns at once instead of deleting and copying the saved snapshot
+    again, see rdsledger.
+
+    With FAILSAFE_COPY_MODE set to 'incremental', an available local copy of
+    the FailsafeSnapshotID is kept and reported as saved rather than deleted
+    and copied again, and the retention always keeps the newest copy of an
+    instance, so RDS copies the next snapshot incrementally.
+
+    With CONTINUATION_MODE set, a copy that outlasts the function, or that
+    cannot get a copy quota slot in time, is resumed by a new invocation of
+    the function: it waits for the copy, or copies again, see
+    rdscontinuation.
 """
 from __future__ import print_function
 
 import json
 import logging
-import re
+import os
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import tzinfo, timedelta, datetime
 
-from boto3 import client
 from botocore.exceptions import ClientError
 
+from rdsclients import ClientRegistry, client
+from rdscontinuation import PHASE_COPY, PHASE_WAIT, PIPELINE_SAVE, \
+    continue_later, continuations_enabled, invoker_from_environment, \
+    notification_records, read_continuations
+from rdscopyquota import CopyNotAdmitted, CopyQuotaScheduler
+from rdsinventory import SnapshotInventory, iterate_snapshots, \
+    parse_snapshot_arn
+from rdsledger import SAVED, ledger_from_environment
+from rdsmetrics import ApiMetrics, metered_handler, record_copy, \
+    record_estimate
+from rdspolling import DeadlineExceeded
+from rdsretention import apply_retention, retention_store
+from rdstracing import traced_handler, tracer_from_environment
+from rdswaiter import SnapshotCopyFailed, WaiterRegistry
+
 SERVICE_CONNECTION_DEFAULT_REGION = "ap-southeast-2"
 FAILSAFE_TAG = 'failsafe'
-SNAPSHOT_RETENTION_PERIOD_IN_DAYS = 31
 ZERO = timedelta(0)  # Handle timezones correctly
 TESTING_HACK = False
+MAX_PARALLEL_SAVES = int(os.getenv('MAX_PARALLEL_SAVES', '4'))
+COPY_MODE_FULL = 'full'
+COPY_MODE_INCREMENTAL = 'incremental'
+FAILSAFE_COPY_MODE = os.getenv('FAILSAFE_COPY_MODE', COPY_MODE_FULL)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -50,6 +90,26 @@ class UTC(tzinfo):
 
 
 utc = UTC()
+api_metrics = ApiMetrics()
+clients = ClientRegistry(lambda *args, **kwargs: client(*args, **kwargs),
+                         on_create=api_metrics.instrument)
+copy_quota = CopyQuotaScheduler()
+tracer = tracer_from_environment()
+ledger = ledger_from_environment()
+snapshot_waiters = WaiterRegistry()
+continuation_invoker = None
+
+
+def new_client(service_name, role_arn=None):
+    """
+    Returns the Boto3 client of the service from the container-wide
+    registry, so warm invocations reuse it
+    :param service_name: e.g. 'rds'
+    :param role_arn: role to assume, the Lambda role when None
+    :return: the Boto3 client
+    """
+    return clients.get(service_name, SERVICE_CONNECTION_DEFAULT_REGION,
+                       role_arn)
 
 
 def terminate_copy_manual_failsafe_snapshot():
@@ -59,7 +119,9 @@ def terminate_copy_manual_failsafe_snapshot():
 
 def copy_manual_failsafe_snapshot_and_save(rds,
                                            instance,
-                                           failsafe_snapshot_id):
+                                           failsafe_snapshot_id,
+                                           inventory=None,
+                                           context=None):
     """
     Function discovers the shared snapshot and copies it to the failsafe
     snasphot
@@ -67,61 +129,70 @@ def copy_manual_failsafe_snapshot_and_save(rds,
     :param instance: rds db snapshot we save to the failsafe account
     :param failsafe_snapshot_id: the identifier of the
     failsafe snapshot to be created
-    :return:
+    :param inventory: SnapshotInventory of the invocation, a new one is
+    created when not provided
+    :param context: the Lambda context bounding the wait for the copy
+    :return: payload of the copied snapshot, None if it was not copied
     """
+    if inventory is None:
+        inventory = SnapshotInventory(rds)
     logger.info('Making local copy of {} in Failsafe account'
                 .format(failsafe_snapshot_id))
     manual_snapshots = get_snapshots(rds,
                                      db_instance_id=instance,
-                                     snapshot_type='manual')
-    shared_snapshots = get_snapshots(rds,
-                                     db_instance_id='',
-                                     snapshot_type='shared')
-    if not shared_snapshots:
-        terminate_copy_manual_failsafe_snapshot()
-
-    shared_snapshot_id = ''.join(
-        [shared_snapshot['DBSnapshotIdentifier']
-            for shared_snapshot in shared_snapshots
-         for shared_snapshot_arn in [re.search(
-                                    failsafe_snapshot_id,
-                                    shared_snapshot['DBSnapshotIdentifier'])]
-         if shared_snapshot_arn])
-
-    snapshot_copied = [
-        data_of_copied_snapshot(failsafe_snapshot_id,
-                                instance,
-                                manual_snapshots,
-                                rds,
-                                shared_snapshot_id)
-        if match_shared_snapshot_requiring_copy(failsafe_snapshot_id,
-                                                shared_snapshot_id) else None]
-
-    if not snapshot_copied.pop():
+                                     snapshot_type='manual',
+                                     inventory=inventory)
+    shared_snapshot = find_shared_snapshot(failsafe_snapshot_id, inventory)
+    failsafe_snapshot_id = parse_snapshot_arn(failsafe_snapshot_id)[1]
+
+    snapshot_copied = data_of_copied_snapshot(
+        failsafe_snapshot_id,
+        instance,
+        manual_snapshots,
+        rds,
+        shared_snapshot['DBSnapshotIdentifier'],
+        inventory,
+        context) if shared_snapshot else None
+
+    if not snapshot_copied:
         logger.error('Shared snapshot with id ...:snapshot:{} failed to copy.'
                      .format(failsafe_snapshot_id))
+    return snapshot_copied
 
 
 def data_of_copied_snapshot(failsafe_snapshot_id,
                             instance,
                             manual_snapshots,
                             rds,
-                            shared_snapshot_id):
+                            shared_snapshot_id,
+                            inventory=None,
+                            context=None):
     logger.info('Failsafe Snapshot {} matched successfully'
                 .format(shared_snapshot_id))
-    delete_duplicate_snapshots(failsafe_snapshot_id,
-                               manual_snapshots, rds)
+    local_copy = available_local_copy(failsafe_snapshot_id, manual_snapshots)
+    if local_copy and FAILSAFE_COPY_MODE == COPY_MODE_INCREMENTAL:
+        logger.info('Local copy of {} is available already, keeping it'
+                    .format(failsafe_snapshot_id))
+        return {'DBSnapshot': local_copy}
+    with tracer.span('delete_duplicate', instance=instance,
+                     snapshot=failsafe_snapshot_id):
+        delete_duplicate_snapshots(failsafe_snapshot_id,
+                                   manual_snapshots, rds, inventory)
     snapshot_copied = copy_failsafe_snapshot(failsafe_snapshot_id,
                                              instance,
                                              rds,
-                                             shared_snapshot_id)
+                                             shared_snapshot_id,
+                                             inventory,
+                                             context)
     return snapshot_copied
 
 
 def copy_failsafe_snapshot(failsafe_snapshot_id,
                            instance,
                            rds,
-                           shared_snapshot_id):
+                           shared_snapshot_id,
+                           inventory=None,
+                           context=None):
     """
     Performs copy of the shared manual snapshot to the failsafe manual
     snapshot and saves it
@@ -132,19 +203,46 @@ def copy_failsafe_snapshot(failsafe_snapshot_id,
     :param rds: the Boto3 client with the help of which we interrogate
     AWS RDS services
     :param shared_snapshot_id: the identifier of the snapshot being copied
+    :param inventory: SnapshotInventory updated with the copied snapshot
+    :param context: the Lambda context bounding the wait for a copy quota
+    slot and for the copy
     :return: payload of the copied snapshot
+    :raises CopyNotAdmitted: if the copy quota stays full until the deadline
     """
-    response = rds.copy_db_snapshot(
-        SourceDBSnapshotIdentifier=shared_snapshot_id,
-        TargetDBSnapshotIdentifier=failsafe_snapshot_id
-    )
-    wait_until_snapshot_is_available(rds, instance, failsafe_snapshot_id)
+    if inventory is None:
+        inventory = SnapshotInventory(rds)
+    started = time.time()
+    with tracer.span('copy', instance=instance,
+                     source_snapshot=shared_snapshot_id,
+                     snapshot=failsafe_snapshot_id,
+                     copy_mode=FAILSAFE_COPY_MODE) as span:
+        response = copy_quota.copy(
+            rds, context,
+            SourceDBSnapshotIdentifier=shared_snapshot_id,
+            TargetDBSnapshotIdentifier=failsafe_snapshot_id
+        )
+        span.set_attribute('allocated_storage', response.get(
+            'DBSnapshot', {}).get('AllocatedStorage'))
+    inventory.record_copy(response)
+    try:
+        with tracer.span('wait', instance=instance,
+                         snapshot=failsafe_snapshot_id):
+            wait_until_snapshot_is_available(rds, instance,
+                                             failsafe_snapshot_id,
+                                             inventory, context)
+    except SnapshotCopyFailed:
+        copy_quota.release(failsafe_snapshot_id)
+        raise
+    copy_quota.release(failsafe_snapshot_id)
+    record_copy(api_metrics, response.get('DBSnapshot', {}),
+                time.time() - started, FAILSAFE_COPY_MODE)
     logger.info("Snapshot {} copied to {}"
                 .format(shared_snapshot_id, failsafe_snapshot_id))
     return response
 
 
-def delete_duplicate_snapshots(failsafe_snapshot_id, manual_snapshots, rds):
+def delete_duplicate_snapshots(failsafe_snapshot_id, manual_snapshots, rds,
+                               inventory=None):
     """
     Helper function to delete snapshots whose creation is being repeated.
     The failsafe snapshot already exists but the rdssavesnapshot lambda
@@ -153,37 +251,59 @@ def delete_duplicate_snapshots(failsafe_snapshot_id, manual_snapshots, rds):
     :param manual_snapshots:
     :param rds: the Boto3 client with the help of which we interrogate
     AWS RDS services
+    :param inventory: SnapshotInventory the deleted snapshot is removed from
     :return:
     """
     logger.warn("Initiating duplicate snapshot cleanup...")
     if local_snapshot_deletion_required(failsafe_snapshot_id,
                                         manual_snapshots):
-        perform_delete(failsafe_snapshot_id, rds)
+        perform_delete(failsafe_snapshot_id, rds, inventory)
     logger.info("Duplicate snapshot cleanup successfully complete")
     return
 
 
-def perform_delete(failsafe_snapshot_id, rds):
+def available_local_copy(failsafe_snapshot_id, manual_snapshots):
+    """
+    Helper function finding a local copy of the failsafe snapshot that
+    completed already
+    :param failsafe_snapshot_id: Failsafe snapshot ID that will be created
+    :param manual_snapshots: manual snapshots of the instance
+    :return: the available local copy, None if there is none
+    """
+    for manual_snapshot in manual_snapshots:
+        if manual_snapshot['DBSnapshotIdentifier'] == failsafe_snapshot_id \
+                and manual_snapshot.get('Status') == 'available':
+            return manual_snapshot
+    return None
+
+
+def perform_delete(failsafe_snapshot_id, rds, inventory=None):
     rds.delete_db_snapshot(
         DBSnapshotIdentifier=failsafe_snapshot_id
     )
+    if inventory is not None:
+        inventory.record_delete(failsafe_snapshot_id)
 
 
-def match_shared_snapshot_requiring_copy(failsafe_snapshot_id,
-                                         shared_snapshot_identifier):
+def find_shared_snapshot(failsafe_snapshot_id, inventory):
     """
-    Helper function to find which shared snapshot requires copying using
-    a string matcher
-    :param failsafe_snapshot_id: Failsafe snapshot id from the SNS event
-    :param shared_snapshot_identifier: Shared snapshot id being matched for
-    copy in failsafe account
-    :return: a match object with boolean value of True if there is a match,
-    and None if not.
+    Helper function to find the shared snapshot requiring copy. An ARN is
+    described directly, a snapshot id is looked up in the index of the
+    shared listing, which is read once per invocation
+    :param failsafe_snapshot_id: Failsafe snapshot id, or ARN, from the SNS
+    event
+    :param inventory: SnapshotInventory of the invocation
+    :return: the shared snapshot, or None if it is not shared
+    :raises ClientException: if no snapshot at all is shared with the account
     """
     logger.info("Checking if snapshot {} requires copying"
-                .format(shared_snapshot_identifier))
-    regexp = r".*\:{}".format(re.escape(failsafe_snapshot_id))
-    return re.match(regexp, shared_snapshot_identifier)
+                .format(failsafe_snapshot_id))
+    if parse_snapshot_arn(failsafe_snapshot_id)[0]:
+        return inventory.refresh_snapshot(failsafe_snapshot_id)
+    shared_index = inventory.shared_index()
+    if not shared_index:
+        terminate_copy_manual_failsafe_snapshot()
+    return shared_index.find(failsafe_snapshot_id)
 
 
 def local_snapshot_deletion_required(failsafe_snapshot_id, manual_snapshots):
@@ -206,11 +326,12 @@ def local_snapshot_deletion_required(failsafe_snapshot_id, manual_snapshots):
     if failsafe_snapshot_id_exists.pop():
         logger.warn(
                'Local copy of {} already exists - deleting it before copying'
-               .format(manual_snapshot['DBSnapshotIdentifier']))
+               .format(failsafe_snapshot_id))
         return True
 
 
-def wait_until_snapshot_is_available(rds, instance, snapshot):
+def wait_until_snapshot_is_available(rds, instance, snapshot, inventory=None,
+                                     context=None, started=None):
     """
     A function that allows the lambda function to wait for long running events
     to complete. This allows us to have more control on the overall workflow of
@@ -218,75 +339,25 @@ def wait_until_snapshot_is_available(rds, instance, snapshot):
     :param rds: the Boto3 client used to interrogate AWS RDS services
     :param instance: name of database instance to copy snapshot from
     :param snapshot: name of the Failsafe snapshot being created
+    :param inventory: SnapshotInventory updated with the available snapshot
+    :param context: the Lambda context, polling backs off until the function
+    is about to time out
+    :param started: the time the copy was started, when the wait was
+    continued from an earlier invocation
     :return: None
+    :raises DeadlineExceeded: if the copy is not available in time
+    :raises SnapshotCopyFailed: if the copy failed or the snapshot vanished
     """
+    if inventory is None:
+        inventory = SnapshotInventory(rds)
     logger.info("Waiting for copy of {} to complete.".format(snapshot))
-    available = False
-    while not available:
-        time.sleep(10)
-        manual_snapshots = get_snapshots(rds,
-                                         db_instance_id=instance,
-                                         snapshot_type='manual')
-        for manual_snapshot in manual_snapshots:
-            if manual_snapshot['DBSnapshotIdentifier'] == snapshot:
-                logger.info("{}: {}..."
-                            .format(manual_snapshot['DBSnapshotIdentifier'],
-                                    manual_snapshot['Status']))
-                if manual_snapshot['Status'] == "available":
-                    available = True
-                    break
-
-
-def delete_old_failsafe_manual_snapshots(rds, instance):
-    """
-    Deletes expired snapshots in accordance with the retention policy
-    :param rds: the Boto3 client used interrogate AWS RDS services
-    :param instance:
-    :return:
-    """
-    logger.info("Checking if instance {} has expired snapshots "
-                .format(instance))
-    logger.warn("Manual snapshots older than {} days will be deleted."
-                .format(SNAPSHOT_RETENTION_PERIOD_IN_DAYS))
-    manual_snapshots = get_snapshots(rds,
-                                     db_instance_id=instance,
-                                     snapshot_type='manual')
-    for manual_snapshot in manual_snapshots:
-        if manual_snapshot['Status'] != "available":
-            continue
-        snapshot_age = evaluate_snapshot_age(manual_snapshot)
-        delete_expired_snapshots(manual_snapshot, rds, snapshot_age)
-
-
-def delete_expired_snapshots(manual_snapshot, rds, snapshot_age):
-    """
-    Helper function that deletes expired failsafe snapshots in accordance with
-    the retention policy
-    :param manual_snapshot: expired snapshots to be deleted
-    :param rds: the Boto3 client used to interrogate AWS RDS services
-    :param snapshot_age: evaluated age of the failsafe manual snapshot
-    :return:
-    """
-    if snapshot_age.days >= SNAPSHOT_RETENTION_PERIOD_IN_DAYS:
-        logger.warn("Deleting: {}"
-                    .format(manual_snapshot['DBSnapshotIdentifier']))
-        perform_delete(manual_snapshot['DBSnapshotIdentifier'], rds)
-    else:
-        logger.info("Not deleting snapshot - {} (it is only {} days old)"
-                    .format(manual_snapshot['DBSnapshotIdentifier'],
-                            snapshot_age.days))
-
-
-def evaluate_snapshot_age(manual_snapshot):
-    """
-    Helper function to get age of snapshot as per current date
-    :param manual_snapshot: manual snapshot in failsafe account
-    :return: snapshot age
-    """
-    snapshot_date = manual_snapshot['SnapshotCreateTime']
-    current_date = datetime.now(utc)
-    snapshot_age = current_date - snapshot_date
-    return snapshot_age
+    waiter = snapshot_waiters.get(rds)
+    available_snapshot = waiter.wait(
+        snapshot, context,
+        until_deadline=continuations_enabled(continuation_invoker),
+        started=started)
+    inventory.record_copy({'DBSnapshot': available_snapshot})
+    record_estimate(api_metrics, waiter.estimator.outcome(snapshot))
 
 
 def get_snapshot_date(snapshot):
@@ -308,22 +379,36 @@ def get_snapshots(rds, **options):
     :param options:
      db_instance_id: the specific instance to get snapshots from
      snapshot_type: can be 'manual' or 'shared' snapshot type
+     inventory: SnapshotInventory to read the listing from instead of RDS
     :return: list of snapshots
     """
     instance = options.get('db_instance_id', '')
     snapshot_type = options.get('snapshot_type', '')
+    inventory = options.get('inventory')
+    if inventory is not None:
+        return sorted(inventory.snapshots(instance, snapshot_type),
+                      key=get_snapshot_date)
     return get_snapshots_by_filters(rds,
                                     db_instance_id=instance,
                                     snapshot_type=snapshot_type)
 
 
 def get_snapshots_by_filters(rds, **options):
-    snapshots = rds.describe_db_snapshots(
+    """
+    Reads every page of the snapshot listing matching the filters and sorts
+    it by creation date
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param options:
+     db_instance_id: the specific instance to get snapshots from
+     snapshot_type: can be 'manual' or 'shared' snapshot type
+    :return: sorted list of snapshots
+    """
+    snapshots = iterate_snapshots(
+        rds,
         SnapshotType=options.get('snapshot_type', ''),
         DBInstanceIdentifier=options.get('db_instance_id', ''),
-        IncludeShared=True)['DBSnapshots']
-    return sorted(snapshots, key=get_snapshot_date) if snapshots is not None \
-        else None
+        IncludeShared=True)
+    return sorted(snapshots, key=get_snapshot_date)
 
 
 def read_notification_payload(record, attribute):
@@ -348,6 +433,255 @@ def read_test_notification_payload(record, attribute):
                                        ['Message']))['default'][attribute]
 
 
+def read_save_records(event):
+    """
+    Reads the instance and FailsafeSnapshotID of every SNS record of the
+    event, continuations aside. A snapshot published more than once in the
+    batch is saved once.
+    :param event: the event the handler was invoked with
+    :return: list of (instance, snapshot_id) tuples in the order of the
+    records
+    """
+    saves = OrderedDict()
+    for record in notification_records(event):
+        if record['EventSource'] != 'aws:sns' or not record['Sns']['Message']:
+            continue
+        if TESTING_HACK:
+            instance = read_test_notification_payload(record, 'Instance')
+            snapshot_id = read_test_notification_payload(record,
+                                                         'FailsafeSnapshotID')
+        else:
+            instance = read_notification_payload(record, 'Instance')
+            snapshot_id = read_notification_payload(record,
+                                                    'FailsafeSnapshotID')
+            logger.info('Retrieved Instance: {0} '
+                        'and FailsafeSnapshotID: {1}'
+                        .format(instance, snapshot_id))
+        if snapshot_id in saves:
+            logger.info('Ignoring duplicate record of {}'.format(snapshot_id))
+            continue
+        saves[snapshot_id] = instance
+    return [(instance, snapshot_id)
+            for snapshot_id, instance in saves.items()]
+
+
+def save_result(instance, snapshot_id, status, error=None):
+    """
+    Helper function building the outcome of the save of one record
+    :param instance: the DB instance of the snapshot
+    :param snapshot_id: the FailsafeSnapshotID of the record
+    :param status: 'saved', 'duplicate', 'deferred' or 'failed'
+    :param error: message of the error the save was stopped by
+    :return: dictionary of the result
+    """
+    result = {'Instance': instance,
+              'FailsafeSnapshotID': snapshot_id,
+              'Status': status}
+    if error:
+        result['Error'] = error
+    return result
+
+
+def save_failsafe_snapshot(rds, instance, snapshot_id, inventory=None,
+                           context=None, attempt=0):
+    """
+    Saves the shared snapshot of one record. The errors of the record are
+    reported in its result, so the other records of the batch are saved
+    regardless. With the ledger on, a snapshot saved or being saved by
+    another invocation is not copied again.
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param instance: the DB instance of the snapshot
+    :param snapshot_id: the FailsafeSnapshotID of the record
+    :param inventory: SnapshotInventory shared by the records of the batch
+    :param context: the Lambda context bounding the wait for the copy
+    :param attempt: number of the continuations of the copy so far
+    :return: save_result of the record
+    """
+    if ledger is not None:
+        claimed, entry = ledger.claim(snapshot_id, Instance=instance)
+        if not claimed:
+            logger.info('Snapshot {} is {} already, ignoring the repeated '
+                        'record'.format(snapshot_id, entry['State']))
+            return save_result(instance, snapshot_id, 'duplicate')
+    try:
+        with tracer.span('save', instance=instance, snapshot=snapshot_id):
+            snapshot_copied = copy_manual_failsafe_snapshot_and_save(
+                rds, instance, snapshot_id, inventory, context)
+    except CopyNotAdmitted as e:
+        logger.warn('{}. Copy of {} is left to the next save'
+                    .format(str(e), snapshot_id))
+        release_claim(snapshot_id)
+        return defer_save(context, instance, snapshot_id, PHASE_COPY,
+                          attempt + 1, str(e))
+    except DeadlineExceeded as e:
+        logger.warn('{}. Copy of {} continues in RDS'
+                    .format(str(e), snapshot_id))
+        return defer_save(context, instance, snapshot_id, PHASE_WAIT, 1,
+                          str(e), e.started)
+    except (ClientError, ClientException, SnapshotCopyFailed) as e:
+        logger.error(str(e))
+        release_claim(snapshot_id)
+        return save_result(instance, snapshot_id, 'failed', str(e))
+    except Exception:
+        release_claim(snapshot_id)
+        raise
+    if not snapshot_copied:
+        release_claim(snapshot_id)
+        return save_result(instance, snapshot_id, 'failed',
+                           'Shared snapshot not found')
+    if ledger is not None:
+        ledger.advance(snapshot_id, SAVED)
+    return save_result(instance, snapshot_id, 'saved')
+
+
+def release_claim(snapshot_id):
+    """
+    Drops the ledger claim of a save that did not happen, so the next
+    notification of the snapshot saves it
+    :param snapshot_id: the FailsafeSnapshotID of the record
+    """
+    if ledger is not None:
+        ledger.release(snapshot_id)
+
+
+def continue_save(context, instance, snapshot_id, phase, attempt,
+                  copy_started=None):
+    """
+    Leaves the rest of the save of a record to a new invocation of the
+    function, see rdscontinuation
+    :param context: the Lambda context, naming the function to invoke
+    :param instance: the DB instance of the snapshot
+    :param snapshot_id: the FailsafeSnapshotID of the record
+    :param phase: PHASE_COPY to copy again, PHASE_WAIT to wait for the copy
+    :param attempt: number of the continuations of the phase, this one
+    included
+    :param copy_started: the time the copy was started, if known, so the
+    duration the next invocation learns is the whole of the copy
+    :return: True if the continuation was sent
+    """
+    state = {'Instance': instance, 'FailsafeSnapshotID': snapshot_id,
+             'CompletedPhases': ['copy'] if phase == PHASE_WAIT else []}
+    if copy_started is not None:
+        state['CopyStartedAt'] = copy_started
+    invoker = continuation_invoker or \
+        invoker_from_environment(new_client, context)
+    return continue_later(invoker, PIPELINE_SAVE, phase, attempt, **state)
+
+
+def defer_save(context, instance, snapshot_id, phase, attempt, error,
+               copy_started=None):
+    """
+    Leaves the save of a record to a continuation. When none is sent, with
+    continuations off or after CONTINUATION_MAX_ATTEMPTS, the claim and the
+    copy quota slot of the record are released and the record fails, so
+    the batch raises and SNS delivers it again.
+    :param error: message of the error the save was stopped by
+    :return: save_result of the record, 'deferred' or 'failed'
+    """
+    if continue_save(context, instance, snapshot_id, phase, attempt,
+                     copy_started):
+        return save_result(instance, snapshot_id, 'deferred', error)
+    copy_quota.release(parse_snapshot_arn(snapshot_id)[1])
+    release_claim(snapshot_id)
+    return save_result(instance, snapshot_id, 'failed', error)
+
+
+def resume_save(rds, state, inventory=None, context=None):
+    """
+    Resumes the save of a record at the phase of its continuation. After
+    the wait the record is saved, its claim was kept by the invocation that
+    started the copy.
+    :param rds: the Boto3 client used to interrogate AWS RDS services
+    :param state: the state read from the continuation
+    :param inventory: SnapshotInventory of the invocation
+    :param context: the Lambda context bounding the wait for the copy
+    :return: save_result of the record
+    """
+    instance = state['Instance']
+    snapshot_id = state['FailsafeSnapshotID']
+    if state['Phase'] != PHASE_WAIT:
+        return save_failsafe_snapshot(rds, instance, snapshot_id, inventory,
+                                      context, state['Attempt'])
+    local_snapshot_id = parse_snapshot_arn(snapshot_id)[1]
+    try:
+        with tracer.span('wait', instance=instance,
+                         snapshot=local_snapshot_id):
+            wait_until_snapshot_is_available(rds, instance,
+                                             local_snapshot_id, inventory,
+                                             context,
+                                             state.get('CopyStartedAt'))
+    except DeadlineExceeded as e:
+        logger.warn('{}. Copy of {} continues in RDS'
+                    .format(str(e), snapshot_id))
+        return defer_save(context, instance, snapshot_id, PHASE_WAIT,
+                          state['Attempt'] + 1, str(e),
+                          e.started or state.get('CopyStartedAt'))
+    except (ClientError, SnapshotCopyFailed) as e:
+        logger.error(str(e))
+        copy_quota.release(local_snapshot_id)
+        release_claim(snapshot_id)
+        return save_result(instance, snapshot_id, 'failed', str(e))
+    copy_quota.release(local_snapshot_id)
+    if ledger is not None:
+        ledger.advance(snapshot_id, SAVED)
+    return save_result(instance, snapshot_id, 'saved')
+
+
+def save_failsafe_snapshots(rds, saves, inventory=None, context=None):
+    """
+    Saves every record on a thread pool of at most MAX_PARALLEL_SAVES
+    workers sharing one RDS client and one SnapshotInventory
+    :param rds: the Boto3 client to share
+    :param saves: list of (instance, snapshot_id) tuples
+    :param inventory: SnapshotInventory shared by the records
+    :param context: the Lambda context bounding the wait for the copies
+    :return: list of save_result, in the order of saves
+    """
+    if inventory is None:
+        inventory = SnapshotInventory(rds)
+    workers = max(1, min(MAX_PARALLEL_SAVES, len(saves)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(save_failsafe_snapshot, rds, instance,
+                                snapshot_id, inventory, context)
+                for instance, snapshot_id in saves]
+    results = []
+    for (instance, snapshot_id), job in zip(saves, jobs):
+        if job.exception():
+            logger.error('Save of {} failed: {!r}'
+                         .format(snapshot_id, job.exception()))
+            results.append(save_result(instance, snapshot_id, 'failed',
+                                       str(job.exception())))
+        else:
+            results.append(job.result())
+    return results
+
+
+def is_scheduled_event(event):
+    """
+    :param event: event the handler was invoked with
+    :return: True for the CloudWatch scheduled event of the retention
+    """
+    return isinstance(event, dict) and \
+        event.get('detail-type') == 'Scheduled Event'
+
+
+def run_retention(context=None):
+    """
+    Applies the retention policy to the failsafe snapshots of every
+    instance of the account
+    :param context: the Lambda context bounding the retries of throttled
+    deletions
+    :return: counts of deleted, skipped and failed snapshots
+    """
+    with tracer.span('retention') as span:
+        summary = apply_retention(new_client('rds'), context=context,
+                                  store=retention_store())
+        span.set_attribute('deleted', len(summary.deleted))
+    return summary.as_dict()
+
+
+@metered_handler(api_metrics, 'rdssavesnapshot')
+@traced_handler(tracer, 'rdssavesnapshot')
 def handler(event, context):
     """
     The function that AWS Lambda service invokes when executing the code.
@@ -357,29 +691,31 @@ def handler(event, context):
         'Instance': instance,
         'FailsafeSnapshotID': name_of_created_failsafe_snapshot
     }
+    The scheduled event of the template runs the retention instead, and a
+    continuation sent by an earlier invocation resumes its save, the records
+    batched with it are saved as well.
     :param context: provides runtime information to the handler if required
-    :return:
+    :return: list of save_result, one per FailsafeSnapshotID of the batch,
+    or the counts of the retention run
+    :raises ClientException: once every record is processed, if any of them
+    failed, so the batch is retried
     """
-    rds = client('rds', region_name=SERVICE_CONNECTION_DEFAULT_REGION)
-    for record in event['Records']:
-        if record['EventSource'] == 'aws:sns' and record['Sns']['Message']:
-            if TESTING_HACK:
-                instance = read_test_notification_payload(record, 'Instance')
-                snapshot_id = read_test_notification_payload(
-                                                        record,
-                                                        'FailsafeSnapshotID')
-            else:
-                instance = read_notification_payload(record, 'Instance')
-                snapshot_id = read_notification_payload(record,
-                                                        'FailsafeSnapshotID')
-                logger.info('Retrieved Instance: {0} '
-                            'and FailsafeSnapshotID: {1}'
-                            .format(instance, snapshot_id))
-
-        try:
-            copy_manual_failsafe_snapshot_and_save(rds, instance, snapshot_id)
-            delete_old_failsafe_manual_snapshots(rds, instance)
-        except ClientError as e:
-            logger.error(str(e))
-    else:
-        logger.info('No instances tagged for RDS failsafe backup found...')
+    if is_scheduled_event(event):
+        return run_retention(context)
+    continuations = read_continuations(event, PIPELINE_SAVE)
+    saves = read_save_records(event)
+    if not saves and not continuations:
+        logger.info('No instances tagged for RDS failsafe backup have been '
+                    'found...')
+        return []
+    rds = new_client('rds')
+    inventory = SnapshotInventory(rds)
+    results = [resume_save(rds, state, inventory, context)
+               for state in continuations]
+    if saves:
+        results += save_failsafe_snapshots(rds, saves, inventory, context)
+    failed = [result['FailsafeSnapshotID'] for result in results
+              if result['Status'] == 'failed']
+    if failed:
+        raise ClientException('Save of {} failed'.format(', '.join(failed)))
+    return results
@@ -0,0 +1,819 @@
+"""
+    Local simulator of the RDS and SNS calls of the rdscopysnapshots and
+    rdssavesnapshot Lambda functions, to run hour-long backup scenarios in
+    seconds.
+
+    moto answers every call at once: a copy is available as soon as it
+    starts, nothing is throttled and a listing always shows the latest
+    writes. RdsSimulator models what the functions are built around instead:
+        - a copy stays 'creating' for copy_base_seconds plus
+          copy_seconds_per_gib for every GiB of AllocatedStorage, with a
+          growing PercentProgress. A copy made while an earlier copy of the
+          instance is available is incremental and takes
+          incremental_ratio of that
+        - at most max_concurrent_copies copies are in progress in an account
+          and at most max_manual_snapshots manual snapshots are kept, over
+          either SnapshotQuotaExceeded is raised
+        - calls are rate limited per account by a token bucket of rate calls
+          per second and burst calls. A throttled call is retried with the
+          backoff of botocore's standard retry mode, up to max_attempts
+          attempts, before Throttling is raised
+        - listings are eventually consistent: a new snapshot is listed
+          listing_delay seconds after it is created, a deleted one is listed
+          as 'deleting' for deletion_seconds
+    Time is read from a VirtualClock. Sleeping advances it at once instead
+    of blocking, so a copy of hours completes after a few hundred polls.
+
+    Simulation ties the accounts of a scenario together: a snapshot shared
+    with an account is listed there and copied from by its ARN, and a topic
+    is published to by ARN from any account. install() points the clients,
+    the copy quota and the snapshot waiters of rdscopysnapshots or
+    rdssavesnapshot at one account, and run() invokes a handler with a
+    SimulatedContext whose deadline is read from the clock.
+
+    The Lambda client is not simulated. Continuations are run locally with
+    rdscontinuation.FakeInvoker, see run_continuations().
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from rdsclients import CLIENT_MAX_ATTEMPTS
+from rdscopyquota import CopyQuotaScheduler
+from rdsinventory import parse_snapshot_arn
+from rdsprogress import CopyProgressEstimator
+from rdswaiter import SnapshotWaiter, WaiterRegistry
+
+SIMULATED_REGION = 'ap-southeast-2'
+COPY_BASE_SECONDS = 60
+COPY_SECONDS_PER_GIB = 20
+INCREMENTAL_COPY_RATIO = 0.1
+MAX_CONCURRENT_COPIES = 20
+MAX_MANUAL_SNAPSHOTS = 100
+RDS_CALLS_PER_SECOND = 20
+RDS_BURST_CALLS = 40
+SNS_CALLS_PER_SECOND = 300
+SNS_BURST_CALLS = 300
+LISTING_DELAY_SECONDS = 2
+DELETION_SECONDS = 30
+RETRY_MAX_BACKOFF_SECONDS = 20
+MIN_RECORDS = 20
+MAX_RECORDS = 100
+LAMBDA_TIMEOUT_SECONDS = 900
+
+
+def simulated_error(code, message, operation):
+    """
+    :return: the ClientError botocore raises for an error response
+    """
+    return ClientError({'Error': {'Code': code, 'Message': message},
+                        'ResponseMetadata': {'HTTPStatusCode': 400}},
+                       operation)
+
+
+class VirtualClock(object):
+    """
+    Clock of a simulation. A sleep advances it by its duration at once,
+    whichever thread sleeps, so threads sleeping side by side add up their
+    sleeps: the clock runs ahead of a real one and deadlines come early,
+    never late.
+    """
+
+    def __init__(self, start=None):
+        """
+        :param start: timezone aware datetime the clock starts at, the
+        current minute when None, so the dates the modules read from
+        datetime.now stay close to the clock
+        """
+        self.start = start or datetime.now(timezone.utc).replace(
+            second=0, microsecond=0)
+        self._started_at = self.start.timestamp()
+        self._elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        """
+        :return: the current time in seconds since the epoch, like time.time
+        """
+        with self._lock:
+            return self._started_at + self._elapsed
+
+    def sleep(self, seconds):
+        """
+        Advances the clock, like time.sleep would let it advance
+        :param seconds: duration of the sleep
+        """
+        with self._lock:
+            self._elapsed += max(0.0, seconds)
+
+    def elapsed(self):
+        """
+        :return: seconds since the start of the clock
+        """
+        with self._lock:
+            return self._elapsed
+
+    def now(self):
+        """
+        :return: the current time as a timezone aware datetime
+        """
+        return self.start + timedelta(seconds=self.elapsed())
+
+
+class SimulatedContext(object):
+    """
+    Lambda context of an invocation whose deadline is read from a
+    VirtualClock
+    """
+
+    def __init__(self, clock, timeout_seconds=LAMBDA_TIMEOUT_SECONDS,
+                 invoked_function_arn=None):
+        """
+        :param clock: the VirtualClock of the simulation
+        :param timeout_seconds: timeout of the function
+        :param invoked_function_arn: ARN of the function, e.g. for
+        continuations invoking it again
+        """
+        self.clock = clock
+        self.deadline = clock.time() + timeout_seconds
+        self.invoked_function_arn = invoked_function_arn
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - self.clock.time()) * 1000))
+
+
+class SimulatedService(object):
+    """
+    Rate limit and retries shared by the simulated clients. Every call takes
+    a token from a bucket refilled at rate tokens per second of the clock.
+    """
+
+    def __init__(self, clock, rate, burst, max_attempts=CLIENT_MAX_ATTEMPTS,
+                 lock=None):
+        """
+        :param clock: the VirtualClock of the simulation
+        :param rate: calls per second allowed in the long run
+        :param burst: calls allowed at once after a quiet period
+        :param max_attempts: attempts of a throttled call, the first one
+        included, like the max_attempts of a botocore retry config
+        :param lock: lock guarding the state of the simulation
+        """
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.calls = Counter()
+        self.throttles = Counter()
+        self._lock = lock or threading.RLock()
+        self._tokens = float(burst)
+        self._filled_at = clock.time()
+
+    def _call(self, operation, function, **arguments):
+        attempts = 0
+        while True:
+            with self._lock:
+                self.calls[operation] += 1
+                if self._take_token():
+                    return function(**arguments)
+                self.throttles[operation] += 1
+            attempts += 1
+            if attempts >= self.max_attempts:
+                raise simulated_error('Throttling', 'Rate exceeded',
+                                      operation)
+            self.clock.sleep(min(RETRY_MAX_BACKOFF_SECONDS,
+                                 random.random() * 2 ** attempts))
+
+    def _take_token(self):
+        now = self.clock.time()
+        self._tokens = min(self.burst, self._tokens +
+                           (now - self._filled_at) * self.rate)
+        self._filled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class RdsSimulator(SimulatedService):
+    """
+    The RDS client of one account. It answers the calls of the Lambda
+    functions with the arguments and the response shapes of boto3.
+    """
+
+    def __init__(self, clock, account_id, region=SIMULATED_REGION,
+                 simulation=None,
+                 copy_base_seconds=COPY_BASE_SECONDS,
+                 copy_seconds_per_gib=COPY_SECONDS_PER_GIB,
+                 incremental_ratio=INCREMENTAL_COPY_RATIO,
+                 max_concurrent_copies=MAX_CONCURRENT_COPIES,
+                 max_manual_snapshots=MAX_MANUAL_SNAPSHOTS,
+                 rate=RDS_CALLS_PER_SECOND, burst=RDS_BURST_CALLS,
+                 listing_delay=LISTING_DELAY_SECONDS,
+                 deletion_seconds=DELETION_SECONDS,
+                 max_attempts=CLIENT_MAX_ATTEMPTS):
+        """
+        :param clock: the VirtualClock of the simulation
+        :param account_id: id of the account
+        :param region: region of the ARNs
+        :param simulation: Simulation the snapshots shared with the account
+        are read from, None for an account on its own
+        :param copy_base_seconds: duration of a copy of no storage
+        :param copy_seconds_per_gib: duration of a copy per GiB of
+        AllocatedStorage
+        :param incremental_ratio: share of that duration an incremental copy
+        takes
+        :param max_concurrent_copies: copies allowed in progress at once
+        :param max_manual_snapshots: manual snapshots allowed in the account
+        :param rate: calls per second allowed in the long run
+        :param burst: calls allowed at once after a quiet period
+        :param listing_delay: seconds before a new snapshot is listed
+        :param deletion_seconds: seconds a deleted snapshot stays listed as
+        'deleting'
+        :param max_attempts: attempts of a throttled call
+        """
+        super(RdsSimulator, self).__init__(
+            clock, rate, burst, max_attempts,
+            simulation._lock if simulation is not None else None)
+        self.account_id = account_id
+        self.region = region
+        self.simulation = simulation
+        self.copy_base_seconds = copy_base_seconds
+        self.copy_seconds_per_gib = copy_seconds_per_gib
+        self.incremental_ratio = incremental_ratio
+        self.max_concurrent_copies = max_concurrent_copies
+        self.max_manual_snapshots = max_manual_snapshots
+        self.listing_delay = listing_delay
+        self.deletion_seconds = deletion_seconds
+        self.instances = {}
+        self.snapshots = {}
+
+    def instance_arn(self, instance):
+        return 'arn:aws:rds:{}:{}:db:{}'.format(self.region, self.account_id,
+                                                instance)
+
+    def snapshot_arn(self, snapshot_id):
+        return 'arn:aws:rds:{}:{}:snapshot:{}'.format(
+            self.region, self.account_id, snapshot_id)
+
+    def add_instance(self, instance, allocated_storage=100,
+                     engine='postgres', tags=None):
+        """
+        Creates a DB instance
+        :param instance: name of the instance
+        :param allocated_storage: GiB of storage of the instance
+        :param engine: database engine of the instance
+        :param tags: dictionary of the tags of the instance
+        """
+        with self._lock:
+            self.instances[instance] = {
+                'DBInstanceIdentifier': instance,
+                'DBInstanceArn': self.instance_arn(instance),
+                'DBInstanceStatus': 'available',
+                'Engine': engine,
+                'AllocatedStorage': allocated_storage,
+                'TagList': [{'Key': key, 'Value': value}
+                            for key, value in sorted((tags or {}).items())]}
+
+    def add_snapshot(self, instance, snapshot_id=None,
+                     snapshot_type='automated', created=None):
+        """
+        Creates an available snapshot of an instance, e.g. the automated
+        snapshot of the nightly backup window
+        :param instance: name of the instance, added with add_instance
+        :param snapshot_id: identifier of the snapshot, named like an
+        automated snapshot when None
+        :param snapshot_type: 'automated' or 'manual'
+        :param created: datetime the snapshot was taken at, now when None
+        :return: identifier of the snapshot
+        """
+        created = created or self.clock.now()
+        snapshot_id = snapshot_id or 'rds:{}-{}'.format(
+            instance, created.strftime('%Y-%m-%d-%H-%M'))
+        at = created.timestamp()
+        with self._lock:
+            self.snapshots[snapshot_id] = {
+                'id': snapshot_id,
+                'instance': instance,
+                'type': snapshot_type,
+                'storage': self.instances[instance]['AllocatedStorage'],
+                'engine': self.instances[instance]['Engine'],
+                'created_at': at, 'complete_at': at, 'visible_at': at,
+                'deleted_at': None, 'source': None,
+                'restore': set(), 'tags': []}
+        return snapshot_id
+
+    def status(self, snapshot_id):
+        """
+        :return: status of the snapshot at the current time, None once it
+        is gone
+        """
+        with self._lock:
+            snapshot = self.snapshots.get(snapshot_id)
+            return self._status(snapshot, self.clock.time()) \
+                if snapshot else None
+
+    def describe_db_instances(self, **arguments):
+        return self._call('DescribeDBInstances',
+                          self._describe_db_instances, **arguments)
+
+    def describe_db_snapshots(self, **arguments):
+        return self._call('DescribeDBSnapshots',
+                          self._describe_db_snapshots, **arguments)
+
+    def copy_db_snapshot(self, **arguments):
+        return self._call('CopyDBSnapshot', self._copy_db_snapshot,
+                          **arguments)
+
+    def delete_db_snapshot(self, **arguments):
+        return self._call('DeleteDBSnapshot', self._delete_db_snapshot,
+                          **arguments)
+
+    def modify_db_snapshot_attribute(self, **arguments):
+        return self._call('ModifyDBSnapshotAttribute',
+                          self._modify_db_snapshot_attribute, **arguments)
+
+    def list_tags_for_resource(self, **arguments):
+        return self._call('ListTagsForResource',
+                          self._list_tags_for_resource, **arguments)
+
+    def add_tags_to_resource(self, **arguments):
+        return self._call('AddTagsToResource', self._add_tags_to_resource,
+                          **arguments)
+
+    def remove_tags_from_resource(self, **arguments):
+        return self._call('RemoveTagsFromResource',
+                          self._remove_tags_from_resource, **arguments)
+
+    def _describe_db_instances(self, DBInstanceIdentifier=None, Filters=None,
+                               MaxRecords=MAX_RECORDS, Marker=None):
+        names = sorted(self.instances)
+        if DBInstanceIdentifier:
+            if DBInstanceIdentifier not in self.instances:
+                raise simulated_error(
+                    'DBInstanceNotFound',
+                    'DBInstance {} not found.'.format(DBInstanceIdentifier),
+                    'DescribeDBInstances')
+            names = [DBInstanceIdentifier]
+        for _, values in _filters(Filters, ('db-instance-id',),
+                                     'DescribeDBInstances'):
+            names = [instance for instance in names if instance in values]
+        page, marker = _page(names, MaxRecords, Marker,
+                             'DescribeDBInstances')
+        response = {'DBInstances': [dict(self.instances[instance])
+                                    for instance in page]}
+        if marker:
+            response['Marker'] = marker
+        return response
+
+    def _describe_db_snapshots(self, DBInstanceIdentifier='',
+                               DBSnapshotIdentifier='', SnapshotType='',
+                               IncludeShared=False, Filters=None,
+                               MaxRecords=MAX_RECORDS, Marker=None):
+        now = self.clock.time()
+        if DBSnapshotIdentifier:
+            owner, snapshot = self._find(DBSnapshotIdentifier, now,
+                                         'DescribeDBSnapshots')
+            return {'DBSnapshots': [owner._render(snapshot, now,
+                                                  owner is not self)]}
+        listed = []
+        if SnapshotType != 'shared':
+            listed.extend(self._render(snapshot, now)
+                          for snapshot in self._visible(now)
+                          if snapshot['type'] == (SnapshotType or
+                                                  snapshot['type']))
+        if SnapshotType == 'shared' or (not SnapshotType and IncludeShared):
+            for owner in self._sharing_accounts():
+                listed.extend(owner._render(snapshot, now, True)
+                              for snapshot in owner._visible(now)
+                              if self.account_id in snapshot['restore'])
+        if DBInstanceIdentifier:
+            listed = [snapshot for snapshot in listed
+                      if snapshot['DBInstanceIdentifier'] ==
+                      DBInstanceIdentifier]
+        for _, values in _filters(Filters, ('db-snapshot-id',),
+                                     'DescribeDBSnapshots'):
+            listed = [snapshot for snapshot in listed
+                      if snapshot['DBSnapshotIdentifier'] in values]
+        listed.sort(key=lambda snapshot: (snapshot['SnapshotCreateTime'],
+                                          snapshot['DBSnapshotIdentifier']))
+        page, marker = _page(listed, MaxRecords, Marker,
+                             'DescribeDBSnapshots')
+        response = {'DBSnapshots': page}
+        if marker:
+            response['Marker'] = marker
+        return response
+
+    def _copy_db_snapshot(self, SourceDBSnapshotIdentifier,
+                          TargetDBSnapshotIdentifier, **_):
+        operation = 'CopyDBSnapshot'
+        now = self.clock.time()
+        owner, source = self._find(SourceDBSnapshotIdentifier, now,
+                                   operation)
+        if owner._status(source, now) != 'available':
+            raise simulated_error(
+                'InvalidDBSnapshotState',
+                'Snapshot {} is not available.'
+                .format(SourceDBSnapshotIdentifier), operation)
+        if TargetDBSnapshotIdentifier in self.snapshots and \
+                self._status(self.snapshots[TargetDBSnapshotIdentifier],
+                             now):
+            raise simulated_error(
+                'DBSnapshotAlreadyExists',
+                'Cannot create the snapshot because a snapshot with the '
+                'identifier {} already exists.'
+                .format(TargetDBSnapshotIdentifier), operation)
+        manual = [snapshot for snapshot in self._existing(now)
+                  if snapshot['type'] == 'manual']
+        copying = [snapshot for snapshot in manual
+                   if self._status(snapshot, now) == 'creating']
+        if len(copying) >= self.max_concurrent_copies:
+            raise simulated_error(
+                'SnapshotQuotaExceeded',
+                'Cannot copy the snapshot: {} copies are in progress.'
+                .format(len(copying)), operation)
+        if len(manual) >= self.max_manual_snapshots:
+            raise simulated_error(
+                'SnapshotQuotaExceeded',
+                'Cannot copy the snapshot: the account has {} manual '
+                'snapshots.'.format(len(manual)), operation)
+        incremental = any(snapshot['instance'] == source['instance'] and
+                          self._status(snapshot, now) == 'available'
+                          for snapshot in manual)
+        duration = self.copy_base_seconds + \
+            self.copy_seconds_per_gib * source['storage']
+        if incremental:
+            duration *= self.incremental_ratio
+        snapshot = dict(source, id=TargetDBSnapshotIdentifier, type='manual',
+                        created_at=now, complete_at=now + duration,
+                        visible_at=now + self.listing_delay,
+                        deleted_at=None,
+                        source=owner.snapshot_arn(source['id']),
+                        restore=set(), tags=[])
+        self.snapshots[TargetDBSnapshotIdentifier] = snapshot
+        return {'DBSnapshot': self._render(snapshot, now)}
+
+    def _delete_db_snapshot(self, DBSnapshotIdentifier):
+        operation = 'DeleteDBSnapshot'
+        now = self.clock.time()
+        snapshot = self._own(DBSnapshotIdentifier, now, operation)
+        if snapshot['type'] != 'manual' or \
+                self._status(snapshot, now) != 'available':
+            raise simulated_error(
+                'InvalidDBSnapshotState',
+                'Cannot delete the snapshot {} while it is {}.'
+                .format(DBSnapshotIdentifier, self._status(snapshot, now)),
+                operation)
+        snapshot['deleted_at'] = now
+        return {'DBSnapshot': self._render(snapshot, now)}
+
+    def _modify_db_snapshot_attribute(self, DBSnapshotIdentifier,
+                                      AttributeName, ValuesToAdd=None,
+                                      ValuesToRemove=None):
+        operation = 'ModifyDBSnapshotAttribute'
+        now = self.clock.time()
+        snapshot = self._own(DBSnapshotIdentifier, now, operation)
+        if AttributeName != 'restore' or snapshot['type'] != 'manual' or \
+                self._status(snapshot, now) != 'available':
+            raise simulated_error(
+                'InvalidDBSnapshotState',
+                'Cannot share the snapshot {} while it is {}.'
+                .format(DBSnapshotIdentifier, self._status(snapshot, now)),
+                operation)
+        snapshot['restore'] |= set(str(value)
+                                   for value in ValuesToAdd or [])
+        snapshot['restore'] -= set(str(value)
+                                   for value in ValuesToRemove or [])
+        return {'DBSnapshotAttributesResult': {
+            'DBSnapshotIdentifier': DBSnapshotIdentifier,
+            'DBSnapshotAttributes': [
+                {'AttributeName': 'restore',
+                 'AttributeValues': sorted(snapshot['restore'])}]}}
+
+    def _list_tags_for_resource(self, ResourceName):
+        return {'TagList': [dict(tag) for tag in self._tags(
+            ResourceName, 'ListTagsForResource')]}
+
+    def _add_tags_to_resource(self, ResourceName, Tags):
+        tags = self._tags(ResourceName, 'AddTagsToResource')
+        keys = set(tag['Key'] for tag in Tags)
+        tags[:] = [tag for tag in tags if tag['Key'] not in keys] + \
+            [dict(tag) for tag in Tags]
+        return {}
+
+    def _remove_tags_from_resource(self, ResourceName, TagKeys):
+        tags = self._tags(ResourceName, 'RemoveTagsFromResource')
+        tags[:] = [tag for tag in tags if tag['Key'] not in TagKeys]
+        return {}
+
+    def _tags(self, resource_name, operation):
+        if ':db:' in resource_name:
+            instance = resource_name.split(':db:', 1)[1]
+            if instance not in self.instances:
+                raise simulated_error(
+                    'DBInstanceNotFound',
+                    'DBInstance {} not found.'.format(instance), operation)
+            return self.instances[instance]['TagList']
+        snapshot_id = resource_name.split(':snapshot:', 1)[-1]
+        return self._own(snapshot_id, self.clock.time(), operation)['tags']
+
+    def _find(self, snapshot_identifier, now, operation):
+        account_id, snapshot_id = parse_snapshot_arn(snapshot_identifier)
+        if account_id is None or account_id == self.account_id:
+            return self, self._own(snapshot_id, now, operation)
+        owner = self.simulation.rds(account_id) \
+            if self.simulation is not None else None
+        snapshot = owner.snapshots.get(snapshot_id) if owner else None
+        if snapshot is None or not owner._status(snapshot, now) or \
+                self.account_id not in snapshot['restore']:
+            raise _not_found(snapshot_identifier, operation)
+        return owner, snapshot
+
+    def _own(self, snapshot_id, now, operation):
+        snapshot = self.snapshots.get(snapshot_id)
+        if snapshot is None or not self._status(snapshot, now):
+            raise _not_found(snapshot_id, operation)
+        return snapshot
+
+    def _sharing_accounts(self):
+        if self.simulation is None:
+            return []
+        return [owner for owner in self.simulation.rds_accounts()
+                if owner is not self]
+
+    def _existing(self, now):
+        gone = [snapshot_id for snapshot_id, snapshot in
+                self.snapshots.items() if not self._status(snapshot, now)]
+        for snapshot_id in gone:
+            del self.snapshots[snapshot_id]
+        return list(self.snapshots.values())
+
+    def _visible(self, now):
+        return [snapshot for snapshot in self._existing(now)
+                if snapshot['visible_at'] <= now]
+
+    def _status(self, snapshot, now):
+        if snapshot['deleted_at'] is not None:
+            return 'deleting' \
+                if now < snapshot['deleted_at'] + self.deletion_seconds \
+                else None
+        return 'creating' if now < snapshot['complete_at'] else 'available'
+
+    def _render(self, snapshot, now, shared=False):
+        arn = self.snapshot_arn(snapshot['id'])
+        status = self._status(snapshot, now)
+        duration = snapshot['complete_at'] - snapshot['created_at']
+        progress = 100 if status != 'creating' else \
+            int(100 * (now - snapshot['created_at']) / duration)
+        rendered = {
+            'DBSnapshotIdentifier': arn if shared else snapshot['id'],
+            'DBSnapshotArn': arn,
+            'DBInstanceIdentifier': snapshot['instance'],
+            'SnapshotCreateTime': datetime.fromtimestamp(
+                snapshot['created_at'], timezone.utc),
+            'Engine': snapshot['engine'],
+            'AllocatedStorage': snapshot['storage'],
+            'Status': status,
+            'PercentProgress': progress,
+            'SnapshotType': 'shared' if shared else snapshot['type'],
+            'Encrypted': False}
+        if snapshot['source']:
+            rendered['SourceDBSnapshotIdentifier'] = snapshot['source']
+        return rendered
+
+
+class SnsSimulator(SimulatedService):
+    """
+    The SNS client of one account. Published messages are kept per topic
+    until they are taken as the event of a subscribed function.
+    """
+
+    def __init__(self, clock, account_id, region=SIMULATED_REGION,
+                 simulation=None, rate=SNS_CALLS_PER_SECOND,
+                 burst=SNS_BURST_CALLS, max_attempts=CLIENT_MAX_ATTEMPTS):
+        """
+        :param clock: the VirtualClock of the simulation
+        :param account_id: id of the account
+        :param region: region of the ARNs
+        :param simulation: Simulation the topics of other accounts are
+        published to through, None for an account on its own
+        :param rate: calls per second allowed in the long run
+        :param burst: calls allowed at once after a quiet period
+        :param max_attempts: attempts of a throttled call
+        """
+        super(SnsSimulator, self).__init__(
+            clock, rate, burst, max_attempts,
+            simulation._lock if simulation is not None else None)
+        self.account_id = account_id
+        self.region = region
+        self.simulation = simulation
+        self.topics = {}
+
+    def create_topic(self, **arguments):
+        return self._call('CreateTopic', self._create_topic, **arguments)
+
+    def list_topics(self, **arguments):
+        return self._call('ListTopics', self._list_topics, **arguments)
+
+    def publish(self, **arguments):
+        return self._call('Publish', self._publish, **arguments)
+
+    def take_event(self, topic_arn):
+        """
+        Takes the messages published to a topic so far
+        :param topic_arn: ARN of the topic
+        :return: the SNS event delivering them to a subscribed function
+        """
+        with self._lock:
+            messages, self.topics[topic_arn] = self.topics[topic_arn], []
+        return {'Records': [{'EventSource': 'aws:sns',
+                             'EventSubscriptionArn': topic_arn,
+                             'Sns': dict(message, TopicArn=topic_arn)}
+                            for message in messages]}
+
+    def _create_topic(self, Name):
+        topic_arn = 'arn:aws:sns:{}:{}:{}'.format(self.region,
+                                                  self.account_id, Name)
+        self.topics.setdefault(topic_arn, [])
+        return {'TopicArn': topic_arn}
+
+    def _list_topics(self, NextToken=None):
+        page, token = _page(sorted(self.topics), MAX_RECORDS, NextToken,
+                            'ListTopics')
+        response = {'Topics': [{'TopicArn': topic_arn}
+                               for topic_arn in page]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def _publish(self, Message, TopicArn=None, TargetArn=None,
+                 MessageStructure=None, Subject=None, **_):
+        topic_arn = TopicArn or TargetArn
+        account_id = topic_arn.split(':')[4] if topic_arn.count(':') == 5 \
+            else None
+        owner = self.simulation.sns(account_id) \
+            if self.simulation is not None and account_id else self
+        if topic_arn not in owner.topics:
+            raise simulated_error('NotFound', 'Topic does not exist',
+                                  'Publish')
+        if MessageStructure == 'json':
+            Message = json.loads(Message)['default']
+        message_id = str(uuid.uuid4())
+        owner.topics[topic_arn].append({
+            'MessageId': message_id, 'Message': Message, 'Subject': Subject,
+            'Timestamp': self.clock.now().isoformat()})
+        return {'MessageId': message_id}
+
+
+class Simulation(object):
+    """
+    The accounts of a scenario on one VirtualClock
+    """
+
+    def __init__(self, clock=None, region=SIMULATED_REGION, **options):
+        """
+        :param clock: VirtualClock of the simulation, a new one when None
+        :param region: region of the accounts
+        :param options: RdsSimulator arguments of every account e.g.
+        copy_seconds_per_gib or max_concurrent_copies
+        """
+        self.clock = clock or VirtualClock()
+        self.region = region
+        self.options = options
+        self._lock = threading.RLock()
+        self._rds = {}
+        self._sns = {}
+
+    def rds(self, account_id):
+        """
+        :return: the RdsSimulator of the account, created on first use
+        """
+        with self._lock:
+            if account_id not in self._rds:
+                self._rds[account_id] = RdsSimulator(
+                    self.clock, account_id, self.region, self,
+                    **self.options)
+            return self._rds[account_id]
+
+    def rds_accounts(self):
+        with self._lock:
+            return list(self._rds.values())
+
+    def sns(self, account_id):
+        """
+        :return: the SnsSimulator of the account, created on first use
+        """
+        with self._lock:
+            if account_id not in self._sns:
+                self._sns[account_id] = SnsSimulator(
+                    self.clock, account_id, self.region, self)
+            return self._sns[account_id]
+
+    def client_factory(self, account_id):
+        """
+        :param account_id: the account the clients call
+        :return: function creating a client like boto3.client
+        """
+        def factory(service_name, **_):
+            if service_name == 'rds':
+                return self.rds(account_id)
+            if service_name == 'sns':
+                return self.sns(account_id)
+            raise ValueError('No simulator of {}'.format(service_name))
+        return factory
+
+    def install(self, service, account_id):
+        """
+        Points a Lambda module at an account of the simulation: its clients,
+        copy quota, snapshot waiters and ledger clock
+        :param service: the rdscopysnapshots or rdssavesnapshot module
+        :param account_id: the account the module runs in
+        """
+        service.client = self.client_factory(account_id)
+        service.clients.clear()
+        service.copy_quota = CopyQuotaScheduler(clock=self.clock.time,
+                                                sleep=self.clock.sleep)
+        service.snapshot_waiters = WaiterRegistry(
+            lambda rds: SnapshotWaiter(
+                rds, clock=self.clock.time, sleep=self.clock.sleep,
+                estimator=CopyProgressEstimator(clock=self.clock.time)))
+        if service.ledger is not None:
+            service.ledger.clock = self.clock.time
+        for cache in ('_db_instance_tags', '_sns_topic_arns'):
+            getattr(service, cache, {}).clear()
+
+    @contextmanager
+    def running(self):
+        """
+        Replaces time.time and time.sleep with the clock while the block
+        runs, for the waits and timestamps of the modules that read them
+        directly
+        """
+        saved = time.time, time.sleep
+        time.time, time.sleep = self.clock.time, self.clock.sleep
+        try:
+            yield self.clock
+        finally:
+            time.time, time.sleep = saved
+
+    def run(self, handler, event, timeout_seconds=LAMBDA_TIMEOUT_SECONDS):
+        """
+        Invokes a handler on the clock of the simulation
+        :param handler: the Lambda handler
+        :param event: the event of the invocation
+        :param timeout_seconds: timeout of the function
+        :return: what the handler returned
+        """
+        with self.running():
+            return handler(event, SimulatedContext(self.clock,
+                                                   timeout_seconds))
+
+    def run_continuations(self, invoker, handler,
+                          timeout_seconds=LAMBDA_TIMEOUT_SECONDS, limit=100):
+        """
+        Runs the continuations kept by a FakeInvoker, each in an invocation
+        of its own with a full timeout, until there are none left
+        :param invoker: the rdscontinuation.FakeInvoker of the module
+        :param handler: the Lambda handler
+        :param timeout_seconds: timeout of every invocation
+        :param limit: maximum number of invocations
+        :return: list of what every invocation returned
+        """
+        results = []
+        while invoker.payloads and len(results) < limit:
+            results.append(self.run(handler, invoker.payloads.pop(0),
+                                    timeout_seconds))
+        return results
+
+
+def _filters(filters, supported, operation):
+    for item in filters or []:
+        if item['Name'] not in supported:
+            raise simulated_error(
+                'InvalidParameterValue',
+                'Unrecognized filter name: {}'.format(item['Name']),
+                operation)
+        yield item['Name'], set(item['Values'])
+
+
+def _page(items, max_records, marker, operation):
+    if not MIN_RECORDS <= max_records <= MAX_RECORDS:
+        raise simulated_error(
+            'InvalidParameterValue',
+            'Invalid value {} for MaxRecords. Must be between {} and {}'
+            .format(max_records, MIN_RECORDS, MAX_RECORDS), operation)
+    start = int(marker or 0)
+    end = start + max_records
+    return items[start:end], str(end) if end < len(items) else None
+
+
+def _not_found(snapshot_identifier, operation):
+    return simulated_error(
+        'DBSnapshotNotFound',
+        'DBSnapshot {} not found.'.format(snapshot_identifier), operation)
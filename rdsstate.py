@@ -0,0 +1,234 @@
+"""
+    Persistent key-value state shared by the rdscopysnapshots and
+    rdssavesnapshot Lambda functions, e.g. the retention manifest.
+
+    The callers only use the items, get, update and put_if methods of a
+    store. JsonFileStore and SqliteStore keep the state in a local file and
+    stand in for a DynamoDB table or an S3 object, which can implement the
+    same methods; put_if is the conditional put of DynamoDB. Values are
+    anything the json module serialises.
+
+    open_store picks the store from a location: nothing for an empty
+    location, JsonFileStore for a path ending in .json, SqliteStore for any
+    other path. MemoryStore keeps state for the life of the container only,
+    for callers that work without a durable store. Lambda only keeps /tmp
+    for the life of a container, so a local store is only durable when it is
+    on a mounted file system.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class JsonFileStore(object):
+    """
+    State kept as one JSON object in a file, rewritten on every update
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the JSON file, created on the first update
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def items(self):
+        """
+        :return: dict of every key of the store to its value
+        """
+        with self._lock:
+            return self._read()
+
+    def get(self, key, default=None):
+        """
+        :return: the value of the key, or default when it is not stored
+        """
+        return self.items().get(key, default)
+
+    def update(self, values=None, removed=()):
+        """
+        Stores values and removes keys in one write
+        :param values: dict of the keys to store to their values
+        :param removed: keys to remove
+        """
+        with self._lock:
+            state = self._read()
+            state.update(values or {})
+            for key in removed:
+                state.pop(key, None)
+            self._write(state)
+
+    def put_if(self, key, value, expected=None):
+        """
+        Conditional put: stores the value only if the key holds expected.
+        The check and the write are atomic within the process only.
+        :param key: the key to store
+        :param value: the new value
+        :param expected: the value the key must hold, None when the key must
+        not exist
+        :return: True if the value was stored
+        """
+        with self._lock:
+            state = self._read()
+            if state.get(key) != expected:
+                return False
+            state[key] = value
+            self._write(state)
+            return True
+
+    def _write(self, state):
+        temporary = '{}.{}'.format(self.path, os.getpid())
+        with open(temporary, 'w') as output:
+            json.dump(state, output, sort_keys=True)
+        os.replace(temporary, self.path)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as state:
+            return json.load(state)
+
+
+class MemoryStore(object):
+    """
+    State kept in a dict of the process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def items(self):
+        """
+        :return: dict of every key of the store to its value
+        """
+        with self._lock:
+            return dict(self._state)
+
+    def get(self, key, default=None):
+        """
+        :return: the value of the key, or default when it is not stored
+        """
+        with self._lock:
+            return self._state.get(key, default)
+
+    def update(self, values=None, removed=()):
+        """
+        Stores values and removes keys
+        :param values: dict of the keys to store to their values
+        :param removed: keys to remove
+        """
+        with self._lock:
+            self._state.update(values or {})
+            for key in removed:
+                self._state.pop(key, None)
+
+    def put_if(self, key, value, expected=None):
+        """
+        Conditional put: stores the value only if the key holds expected
+        :return: True if the value was stored
+        """
+        with self._lock:
+            if self._state.get(key) != expected:
+                return False
+            self._state[key] = value
+            return True
+
+
+class SqliteStore(object):
+    """
+    State kept as one row per key in an SQLite table
+    """
+
+    def __init__(self, path, table='state'):
+        """
+        :param path: path of the SQLite database, created when missing
+        :param table: name of the table of the keys
+        """
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS {} '
+                               '(key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+                               .format(self.table))
+
+    def items(self):
+        """
+        :return: dict of every key of the store to its value
+        """
+        with self._lock, self._connect() as connection:
+            return dict((key, json.loads(value)) for key, value in
+                        connection.execute('SELECT key, value FROM {}'
+                                           .format(self.table)))
+
+    def get(self, key, default=None):
+        """
+        :return: the value of the key, or default when it is not stored
+        """
+        with self._lock, self._connect() as connection:
+            row = connection.execute('SELECT value FROM {} WHERE key = ?'
+                                     .format(self.table), (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def update(self, values=None, removed=()):
+        """
+        Stores values and removes keys in one transaction
+        :param values: dict of the keys to store to their values
+        :param removed: keys to remove
+        """
+        with self._lock, self._connect() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)'
+                .format(self.table),
+                [(key, json.dumps(value))
+                 for key, value in (values or {}).items()])
+            connection.executemany('DELETE FROM {} WHERE key = ?'
+                                   .format(self.table),
+                                   [(key,) for key in removed])
+
+    def put_if(self, key, value, expected=None):
+        """
+        Conditional put: stores the value only if the key holds expected.
+        The check and the write run in one immediate transaction, so they
+        are atomic across the processes sharing the database.
+        :param key: the key to store
+        :param value: the new value
+        :param expected: the value the key must hold, None when the key must
+        not exist
+        :return: True if the value was stored
+        """
+        with self._lock, self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT value FROM {} WHERE key = ?'
+                                     .format(self.table), (key,)).fetchone()
+            if (None if row is None else json.loads(row[0])) != expected:
+                return False
+            connection.execute('INSERT OR REPLACE INTO {} (key, value) '
+                               'VALUES (?, ?)'.format(self.table),
+                               (key, json.dumps(value)))
+            return True
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+def open_store(location, table='state'):
+    """
+    :param location: path of the local store, '' when state is not kept
+    :param table: name of the table of an SQLite store
+    :return: JsonFileStore, SqliteStore, or None for an empty location
+    """
+    if not location:
+        return None
+    if location.endswith('.json'):
+        return JsonFileStore(location)
+    return SqliteStore(location, table)
@@ -0,0 +1,189 @@
+"""
+    Phase tracing shared by the rdscopysnapshots and rdssavesnapshot Lambda
+    functions.
+
+    Tracer records a span with start, end, duration, status and attributes
+    (instance, snapshot ids, ...) for every phase of a pipeline. Spans of
+    one handler invocation share a trace id; each span is the child of the
+    span open in its thread, or of the handler span for the first span of a
+    worker thread.
+
+    Finished spans are exported as JSON lines whose fields follow the
+    OpenTelemetry span model (traceId, spanId, parentSpanId, name,
+    startTimeUnixNano, endTimeUnixNano, attributes, status), to stdout or
+    appended to the file named by TRACE_EXPORT. Tracing is off when
+    TRACE_EXPORT is empty, and spans then cost a context manager each.
+"""
+from __future__ import print_function
+
+import binascii
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', '')
+TRACE_EXPORT_STDOUT = 'stdout'
+
+
+class Span(object):
+    """
+    One traced phase
+    """
+
+    def __init__(self, name, trace_id, span_id, parent_span_id, attributes,
+                 start):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes)
+        self.start = start
+        self.end = None
+        self.status = {'code': 'OK'}
+
+    def set_attribute(self, key, value):
+        """
+        Adds an attribute learnt while the phase runs, e.g. a snapshot id
+        """
+        self.attributes[key] = value
+
+    def duration_ms(self):
+        """
+        :return: milliseconds the phase took, None while it is running
+        """
+        return None if self.end is None else (self.end - self.start) * 1000.0
+
+    def as_dict(self):
+        """
+        :return: the span in the field names of the OpenTelemetry span model
+        """
+        return {'traceId': self.trace_id,
+                'spanId': self.span_id,
+                'parentSpanId': self.parent_span_id or '',
+                'name': self.name,
+                'startTimeUnixNano': int(self.start * 1e9),
+                'endTimeUnixNano': int(self.end * 1e9),
+                'durationMs': round(self.duration_ms(), 3),
+                'attributes': self.attributes,
+                'status': self.status}
+
+
+class _NoopSpan(object):
+
+    def set_attribute(self, key, value):
+        pass
+
+
+class JsonLinesExporter(object):
+    """
+    Writes every finished span as one JSON line
+    """
+
+    def __init__(self, destination=TRACE_EXPORT_STDOUT):
+        """
+        :param destination: 'stdout', or the path of the file the spans are
+        appended to
+        """
+        self.destination = destination
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), sort_keys=True, default=str)
+        with self._lock:
+            if self.destination == TRACE_EXPORT_STDOUT:
+                print(line)
+            else:
+                with open(self.destination, 'a') as output:
+                    output.write(line + '\n')
+
+
+class Tracer(object):
+    """
+    Records the spans of the phases of a handler invocation
+    """
+
+    def __init__(self, exporter=None, clock=time.time):
+        """
+        :param exporter: object with an export(span) method, tracing is off
+        when None
+        :param clock: function returning the current time, replaceable for
+        tests
+        """
+        self.exporter = exporter
+        self.clock = clock
+        self.trace_id = None
+        self.root_span_id = None
+        self._local = threading.local()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Traces the phase run in the body of the with statement
+        :param name: name of the phase e.g. 'share'
+        :param attributes: e.g. instance and snapshot ids
+        :return: the Span, to add attributes to
+        """
+        if self.exporter is None:
+            yield _NOOP_SPAN
+            return
+        stack = self._stack()
+        span = Span(name, self.trace_id or _new_id(16), _new_id(8),
+                    stack[-1].span_id if stack else self.root_span_id,
+                    attributes, self.clock())
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = {'code': 'ERROR',
+                           'message': '{}: {}'.format(type(e).__name__, e)}
+            raise
+        finally:
+            stack.pop()
+            span.end = self.clock()
+            self.exporter.export(span)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def tracer_from_environment():
+    """
+    :return: Tracer exporting to TRACE_EXPORT, off when it is empty
+    """
+    return Tracer(JsonLinesExporter(TRACE_EXPORT) if TRACE_EXPORT else None)
+
+
+def traced_handler(tracer, name):
+    """
+    Decorates a Lambda handler to open a new trace for every invocation,
+    whose root span covers the whole handler
+    :param tracer: Tracer of the pipeline
+    :param name: name of the root span
+    :return: the decorator
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def traced(event, context):
+            if tracer.exporter is None:
+                return handler(event, context)
+            tracer.trace_id = _new_id(16)
+            with tracer.span(name) as span:
+                tracer.root_span_id = span.span_id
+                try:
+                    return handler(event, context)
+                finally:
+                    tracer.root_span_id = None
+        return traced
+    return decorator
+
+
+def _new_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
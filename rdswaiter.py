@@ -0,0 +1,260 @@
+"""
+    Snapshot waiter shared by the rdscopysnapshots and rdssavesnapshot
+    Lambda functions.
+
+    Every copy of a run waits on the same SnapshotWaiter instead of polling
+    on its own. A copy registers its target snapshot id and gets a future;
+    one describe_db_snapshots call filtered on the ids of all the registered
+    snapshots is made per tick, whichever waiting thread is due first makes
+    it, and each future completes as its snapshot turns available.
+
+    A snapshot reported failed, or deleted while it was waited on, fails its
+    future at once with SnapshotCopyFailed. So does a snapshot that is not
+    listed after WAITER_MISSING_TICKS ticks: RDS lists a new copy with a
+    short delay, but not that long. Each waiting thread keeps its own
+    PollingSchedule, so DeadlineExceeded is still raised before the Lambda
+    function times out.
+
+    The describes also feed the PercentProgress of the copies to a
+    CopyProgressEstimator (see rdsprogress). Once it can predict when a
+    copy completes, the thread waiting on it sleeps until then instead of
+    backing off, and hands off at once when the copy would outlast the
+    function. When the wait is continued in a new invocation (see
+    rdscontinuation) it sleeps until the deadline instead, so every
+    continuation waits out a whole invocation.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import Future, wait as wait_for_futures
+
+from rdsinventory import iterate_snapshots
+from rdspolling import POLL_INITIAL_INTERVAL_SECONDS, DeadlineExceeded, \
+    PollingSchedule
+from rdsprogress import estimator_from_environment
+
+WAITER_TICK_SECONDS = int(os.getenv('WAITER_TICK_SECONDS',
+                                    str(POLL_INITIAL_INTERVAL_SECONDS)))
+WAITER_MISSING_TICKS = int(os.getenv('WAITER_MISSING_TICKS', '3'))
+SNAPSHOT_FAILED_STATUSES = ('failed', 'deleting', 'deleted')
+
+logger = logging.getLogger()
+
+
+class SnapshotCopyFailed(Exception):
+    pass
+
+
+class SnapshotWaiter(object):
+    """
+    Waits on many snapshots of one account with one describe per tick. The
+    threads waiting on it take turns at making the describe.
+    """
+
+    def __init__(self, rds, tick_interval=WAITER_TICK_SECONDS,
+                 missing_ticks=WAITER_MISSING_TICKS, clock=time.time,
+                 sleep=None, estimator=None):
+        """
+        :param rds: the Boto3 client used to interrogate AWS RDS services
+        :param tick_interval: seconds between two describes
+        :param missing_ticks: ticks a registered snapshot may go unlisted
+        before it is reported as vanished
+        :param clock: function returning the current time, replaceable for
+        tests
+        :param sleep: function used to sleep between polls, replaceable for
+        tests. By default a thread sleeps until its snapshot completes or
+        its next poll is due, whichever comes first
+        :param estimator: CopyProgressEstimator predicting the completion of
+        the copies, the one of the environment when None
+        """
+        self.rds = rds
+        self.tick_interval = tick_interval
+        self.missing_ticks = missing_ticks
+        self.clock = clock
+        self.sleep = sleep
+        self.estimator = estimator if estimator is not None \
+            else estimator_from_environment()
+        self.ticks = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._waiters = {}
+        self._seen = set()
+        self._misses = {}
+        self._ticked_at = None
+
+    def watch(self, snapshot_id, started=None):
+        """
+        Registers a snapshot to wait on
+        :param snapshot_id: the identifier of the snapshot being copied
+        :param started: the time the copy was started, now when None
+        :return: the Future completed with the snapshot once it is available
+        """
+        with self._lock:
+            if snapshot_id not in self._pending:
+                self._pending[snapshot_id] = Future()
+                self._misses[snapshot_id] = 0
+                self.estimator.start(snapshot_id, started)
+            self._waiters[snapshot_id] = \
+                self._waiters.get(snapshot_id, 0) + 1
+            return self._pending[snapshot_id]
+
+    def unwatch(self, snapshot_id):
+        """
+        Stops waiting on a snapshot, e.g. when its wait is handed off. The
+        snapshot stays registered while other threads wait on it.
+        """
+        with self._lock:
+            self._waiters[snapshot_id] = \
+                self._waiters.get(snapshot_id, 1) - 1
+            if self._waiters[snapshot_id] <= 0:
+                self._drop(snapshot_id)
+
+    def pending(self):
+        """
+        :return: identifiers of the snapshots still waited on
+        """
+        with self._lock:
+            return sorted(self._pending)
+
+    def wait(self, snapshot_id, context=None, until_deadline=False,
+             started=None):
+        """
+        Waits until the snapshot is available
+        :param snapshot_id: the identifier of the snapshot being copied
+        :param context: the Lambda context, polling backs off until the
+        function is about to time out
+        :param until_deadline: whether a copy predicted to outlast the
+        function is waited on until the deadline rather than handed off at
+        once, e.g. when the wait is continued in a new invocation
+        :param started: the time the copy was started, when the wait was
+        continued from an earlier invocation
+        :return: the available snapshot
+        :raises DeadlineExceeded: if the snapshot is not available in time,
+        with the time the copy was started
+        :raises SnapshotCopyFailed: if the copy failed or the snapshot
+        vanished
+        """
+        future = self.watch(snapshot_id, started)
+        schedule = PollingSchedule(
+            context, sleep=self.sleep or (
+                lambda seconds: wait_for_futures([future], timeout=seconds)))
+        try:
+            while not future.done():
+                interval = self.predicted_wait(snapshot_id)
+                remaining = schedule.remaining_seconds()
+                if until_deadline and interval is not None and \
+                        remaining is not None:
+                    interval = max(self.tick_interval, min(
+                        interval, remaining - schedule.safety_margin))
+                schedule.wait(interval)
+                if not future.done():
+                    self.tick_if_due()
+        except DeadlineExceeded as e:
+            e.started = self.estimator.started(snapshot_id)
+            self.unwatch(snapshot_id)
+            raise
+        with self._lock:
+            self._waiters.pop(snapshot_id, None)
+        return future.result()
+
+    def predicted_wait(self, snapshot_id):
+        """
+        :param snapshot_id: the identifier of the snapshot being copied
+        :return: seconds until the copy is predicted to complete, at least
+        the tick interval, or None to back off when there is no prediction
+        """
+        remaining = self.estimator.remaining(snapshot_id)
+        return None if remaining is None else max(self.tick_interval,
+                                                  remaining)
+
+    def tick_if_due(self):
+        """
+        Describes the registered snapshots, unless another thread did within
+        the tick interval
+        :return: True if this call made the describe
+        """
+        with self._lock:
+            now = self.clock()
+            if self._ticked_at is not None and \
+                    now - self._ticked_at < self.tick_interval:
+                return False
+            self._ticked_at = now
+        self.tick()
+        return True
+
+    def tick(self):
+        """
+        Describes every registered snapshot in one filtered listing and
+        completes the futures of the snapshots that are done
+        """
+        snapshot_ids = self.pending()
+        if not snapshot_ids:
+            return
+        listed = dict((snapshot['DBSnapshotIdentifier'], snapshot)
+                      for snapshot in iterate_snapshots(
+                          self.rds, Filters=[{'Name': 'db-snapshot-id',
+                                              'Values': snapshot_ids}]))
+        with self._lock:
+            self.ticks += 1
+            for snapshot_id in snapshot_ids:
+                if snapshot_id in self._pending:
+                    self._observe(snapshot_id, listed.get(snapshot_id))
+
+    def _observe(self, snapshot_id, snapshot):
+        future = self._pending[snapshot_id]
+        if snapshot is None:
+            self._misses[snapshot_id] += 1
+            if snapshot_id in self._seen or \
+                    self._misses[snapshot_id] >= self.missing_ticks:
+                self._fail(snapshot_id, 'Snapshot {} vanished while it was '
+                                        'copied'.format(snapshot_id))
+            return
+        self._seen.add(snapshot_id)
+        logger.info('{}: {}...'.format(snapshot_id, snapshot['Status']))
+        if snapshot['Status'] == 'available':
+            self.estimator.complete(snapshot)
+            self._drop(snapshot_id)
+            future.set_result(snapshot)
+        else:
+            self.estimator.observe(snapshot)
+        if snapshot['Status'] in SNAPSHOT_FAILED_STATUSES:
+            self._fail(snapshot_id, 'Copy of snapshot {} is {}'
+                       .format(snapshot_id, snapshot['Status']))
+
+    def _fail(self, snapshot_id, message):
+        future = self._pending[snapshot_id]
+        self._drop(snapshot_id)
+        future.set_exception(SnapshotCopyFailed(message))
+
+    def _drop(self, snapshot_id):
+        self.estimator.forget(snapshot_id)
+        self._pending.pop(snapshot_id, None)
+        self._misses.pop(snapshot_id, None)
+        self._seen.discard(snapshot_id)
+
+
+class WaiterRegistry(object):
+    """
+    One SnapshotWaiter per client, so every copy made with a client of the
+    container-wide registry shares the same waiter
+    """
+
+    def __init__(self, factory=SnapshotWaiter):
+        """
+        :param factory: function creating the waiter of a client
+        """
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._waiters = weakref.WeakKeyDictionary()
+
+    def get(self, rds):
+        """
+        :param rds: the Boto3 client used to interrogate AWS RDS services
+        :return: the SnapshotWaiter of the client
+        """
+        with self._lock:
+            if rds not in self._waiters:
+                self._waiters[rds] = self.factory(rds)
+            return self._waiters[rds]
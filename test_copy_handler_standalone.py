@@ -0,0 +1,594 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from importlib import reload
+
+import pytest
+import sure
+from boto3 import client
+from botocore.exceptions import ClientError, EndpointConnectionError
+from mock import MagicMock
+from moto import mock_rds2, mock_sns, mock_sqs
+
+import rdscopysnapshots as copy_service
+import rdsstate
+from rdscontinuation import FakeInvoker
+from rdsledger import IdempotencyLedger
+from rdsprogress import CopyProgressEstimator
+from rdswaiter import SnapshotWaiter, WaiterRegistry
+
+
+@pytest.fixture(autouse=True)
+def fresh_copy_service():
+    reload(copy_service)
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_EVENT
+    yield
+    reload(copy_service)
+
+
+def describe_db_snapshots(**kwargs):
+    if kwargs.get('SnapshotType') == 'automated':
+        return {'DBSnapshots': [{'DBSnapshotIdentifier': 'rds:failsafe-database-2017-11-26',
+                                 'DBInstanceIdentifier': 'failsafe_database',
+                                 'SnapshotType': 'automated',
+                                 'Status': 'available',
+                                 'SnapshotCreateTime': datetime(2017, 11, 26)}]}
+    return {'DBSnapshots': []}
+
+
+def test_backup_returns_after_copy_is_started():
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = describe_db_snapshots
+    rds.copy_db_snapshot.return_value = {'DBSnapshot': {
+        'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+        'DBInstanceIdentifier': 'failsafe_database',
+        'SnapshotType': 'manual',
+        'Status': 'creating'}}
+    copy_service.client = MagicMock(return_value=rds)
+    copy_service.wait_until_failsafe_snapshot_is_available = MagicMock()
+    copy_service.share_failsafe_snapshot = MagicMock()
+    copy_service.send_sns_to_failsafe_account = MagicMock()
+    copy_service.run_rds_snapshot_backup('failsafe_database')
+    rds.copy_db_snapshot.assert_called_once_with(
+        SourceDBSnapshotIdentifier='rds:failsafe-database-2017-11-26',
+        TargetDBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26')
+    copy_service.wait_until_failsafe_snapshot_is_available.assert_not_called()
+    copy_service.share_failsafe_snapshot.assert_not_called()
+    copy_service.send_sns_to_failsafe_account.assert_not_called()
+
+
+def test_repeated_backup_of_a_snapshot_is_ignored(tmp_path):
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = describe_db_snapshots
+    rds.copy_db_snapshot.return_value = {'DBSnapshot': {
+        'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+        'DBInstanceIdentifier': 'failsafe_database',
+        'SnapshotType': 'manual',
+        'Status': 'creating'}}
+    copy_service.client = MagicMock(return_value=rds)
+    copy_service.ledger = IdempotencyLedger(rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    copy_service.back_up_instance('failsafe_database')['Status'].should.equal('pending')
+    copy_service.back_up_instance('failsafe_database').should.equal({
+        'Instance': 'failsafe_database', 'Status': 'duplicate',
+        'FailsafeSnapshotID': 'failsafe-failsafe-database-2017-11-26'})
+    rds.copy_db_snapshot.assert_called_once()
+    rds.delete_db_snapshot.assert_not_called()
+
+
+def test_backup_interrupted_by_a_connection_error_releases_its_claim(tmp_path):
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = describe_db_snapshots
+    rds.copy_db_snapshot.side_effect = EndpointConnectionError(endpoint_url='https://rds.amazonaws.com')
+    copy_service.client = MagicMock(return_value=rds)
+    copy_service.ledger = IdempotencyLedger(rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    copy_service.back_up_instance.when.called_with('failsafe_database').should.throw(EndpointConnectionError)
+    rds.copy_db_snapshot.side_effect = None
+    rds.copy_db_snapshot.return_value = {'DBSnapshot': {
+        'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+        'DBInstanceIdentifier': 'failsafe_database',
+        'SnapshotType': 'manual',
+        'Status': 'creating'}}
+    copy_service.back_up_instance('failsafe_database')['Status'].should.equal('pending')
+
+
+def test_backup_fails_without_copying_when_the_old_copy_could_not_be_deleted():
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = lambda **kwargs: describe_db_snapshots(**kwargs) \
+        if kwargs.get('SnapshotType') == 'automated' else \
+        {'DBSnapshots': [{'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-25',
+                          'DBInstanceIdentifier': 'failsafe_database',
+                          'SnapshotType': 'manual',
+                          'Status': 'available',
+                          'SnapshotCreateTime': datetime(2017, 11, 25)}]}
+    rds.delete_db_snapshot.side_effect = ClientError({'Error': {'Code': 'AccessDenied'}},
+                                                     'DeleteDBSnapshot')
+    result = copy_service.back_up_instance('failsafe_database', rds=rds)
+    result['Status'].should.equal('failed')
+    result['Error'].should.contain('failsafe-failsafe-database-2017-11-25')
+    rds.copy_db_snapshot.assert_not_called()
+
+
+def test_incremental_copy_deletes_the_previous_copy_once_the_new_one_is_available():
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_POLL
+    copy_service.FAILSAFE_COPY_MODE = copy_service.COPY_MODE_INCREMENTAL
+    rds = MagicMock()
+
+    def describe_with_previous_copy(**kwargs):
+        if kwargs.get('SnapshotType') == 'manual':
+            return {'DBSnapshots': [{'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-25',
+                                     'DBInstanceIdentifier': 'failsafe_database',
+                                     'SnapshotType': 'manual',
+                                     'Status': 'available',
+                                     'SnapshotCreateTime': datetime(2017, 11, 25)}]}
+        return describe_db_snapshots(**kwargs)
+
+    def wait(rds, instance, failsafe_snapshot, inventory, context):
+        rds.delete_db_snapshot.assert_not_called()
+        inventory.record_copy({'DBSnapshot': dict(copied_snapshot, Status='available')})
+
+    copied_snapshot = {'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+                       'DBInstanceIdentifier': 'failsafe_database',
+                       'SnapshotType': 'manual',
+                       'Status': 'creating',
+                       'AllocatedStorage': 20}
+    rds.describe_db_snapshots.side_effect = describe_with_previous_copy
+    rds.copy_db_snapshot.return_value = {'DBSnapshot': copied_snapshot}
+    copy_service.wait_until_failsafe_snapshot_is_available = MagicMock(side_effect=wait)
+    copy_service.share_failsafe_snapshot = MagicMock()
+    copy_service.send_sns_to_failsafe_account = MagicMock()
+    copy_service.back_up_instance('failsafe_database', rds=rds)['Status'].should.equal('completed')
+    rds.delete_db_snapshot.assert_called_once_with(DBSnapshotIdentifier='failsafe-failsafe-database-2017-11-25')
+    copy_service.share_failsafe_snapshot.call_args[0][1].should.equal('failsafe-failsafe-database-2017-11-26')
+    copy_service.api_metrics.values()['CopyAllocatedBytes'].should.equal([20 * 1024 ** 3])
+    copy_service.api_metrics.emf_record('rdscopysnapshots')['CopyMode'].should.equal('incremental')
+
+
+def test_failed_copy_fails_the_backup_without_waiting_for_the_deadline():
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_POLL
+    rds = MagicMock()
+
+    def describe_failed_copy(**kwargs):
+        if kwargs.get('Filters'):
+            return {'DBSnapshots': [{'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+                                     'Status': 'failed'}]}
+        return describe_db_snapshots(**kwargs)
+
+    rds.describe_db_snapshots.side_effect = describe_failed_copy
+    rds.copy_db_snapshot.return_value = {'DBSnapshot': {
+        'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+        'DBInstanceIdentifier': 'failsafe_database',
+        'SnapshotType': 'manual',
+        'Status': 'creating'}}
+    copy_service.snapshot_waiters = WaiterRegistry(lambda rds: SnapshotWaiter(rds, sleep=MagicMock()))
+    copy_service.share_failsafe_snapshot = MagicMock()
+    copy_service.back_up_instance('failsafe_database', rds=rds).should.equal({
+        'Instance': 'failsafe_database', 'Status': 'failed',
+        'Error': 'Copy of snapshot failsafe-failsafe-database-2017-11-26 is failed'})
+    copy_service.share_failsafe_snapshot.assert_not_called()
+    copy_service.copy_quota.in_flight().should.equal(0)
+
+
+@mock_sqs
+@mock_sns
+@mock_rds2
+def test_snapshot_created_event_shares_and_notifies():
+    create_failsafe_snapshot()
+    sns = client('sns', region_name='ap-southeast-2')
+    sqs = client('sqs', region_name='ap-southeast-2')
+    topic_arn = sns.create_topic(Name=copy_service.SNS_RDS_SAVE_TOPIC)['TopicArn']
+    queue_url = sqs.create_queue(QueueName='failsafe-save')['QueueUrl']
+    queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url,
+                                         AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    sns.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn)
+    copy_service.share_failsafe_snapshot = MagicMock()
+
+    copy_service.handler(get_snapshot_created_event('failsafe-failsafe-database-2017-11-26'), None)
+
+    copy_service.share_failsafe_snapshot.call_args[0][1].should.equal('failsafe-failsafe-database-2017-11-26')
+    message = json.loads(sqs.receive_message(QueueUrl=queue_url)['Messages'][0]['Body'])['Message']
+    json.loads(json.loads(message)['default']).should.equal(
+        {'Instance': 'failsafe_database', 'FailsafeSnapshotID': 'failsafe-failsafe-database-2017-11-26'})
+
+
+def test_snapshot_created_event_of_other_snapshots_is_ignored():
+    copy_service.client = MagicMock()
+    copy_service.run_rds_snapshot_backup = MagicMock()
+    copy_service.handler(get_snapshot_created_event('someone-elses-snapshot'), None)
+    copy_service.client.assert_not_called()
+    copy_service.run_rds_snapshot_backup.assert_not_called()
+
+
+def test_other_snapshot_creation_events_are_ignored():
+    copy_service.client = MagicMock()
+    copy_service.run_rds_snapshot_backup = MagicMock()
+    copy_service.handler(get_snapshot_created_event('rds:failsafe-database-2017-11-26', 'RDS-EVENT-0091',
+                                                    'Automated snapshot created'), None).should.equal([])
+    copy_service.client.assert_not_called()
+    copy_service.run_rds_snapshot_backup.assert_not_called()
+
+
+@mock_rds2
+def test_snapshot_created_event_is_ignored_when_polling():
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_POLL
+    create_failsafe_snapshot()
+    copy_service.share_failsafe_snapshot = MagicMock()
+    copy_service.handler(get_snapshot_created_event('failsafe-failsafe-database-2017-11-26'), None)
+    copy_service.share_failsafe_snapshot.assert_not_called()
+
+
+@mock_rds2
+def test_snapshot_created_event_completes_handed_off_copy_when_polling():
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_POLL
+    rds = client('rds', region_name='ap-southeast-2')
+    snapshot = create_failsafe_snapshot()
+    copy_service.hand_off_failsafe_snapshot(rds, snapshot, 'Deadline reached')
+    copy_service.share_failsafe_snapshot = MagicMock()
+    copy_service.send_sns_to_failsafe_account = MagicMock()
+    copy_service.handler(get_snapshot_created_event('failsafe-failsafe-database-2017-11-26'), None)
+    copy_service.share_failsafe_snapshot.call_args[0][1].should.equal('failsafe-failsafe-database-2017-11-26')
+    copy_service.send_sns_to_failsafe_account.assert_called_once_with('failsafe_database',
+                                                                      'failsafe-failsafe-database-2017-11-26')
+    rds.list_tags_for_resource(ResourceName=snapshot['DBSnapshotArn'])['TagList'].should.be.empty
+
+
+def test_copy_is_handed_off_when_the_function_is_about_to_time_out():
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_POLL
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = describe_db_snapshots
+    rds.copy_db_snapshot.return_value = {'DBSnapshot': {
+        'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+        'DBSnapshotArn': 'arn:aws:rds:ap-southeast-2:129000003686:snapshot:failsafe-failsafe-database-2017-11-26',
+        'DBInstanceIdentifier': 'failsafe_database',
+        'SnapshotType': 'manual',
+        'Status': 'creating'}}
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 10000
+    copy_service.client = MagicMock(return_value=rds)
+    copy_service.share_failsafe_snapshot = MagicMock()
+    copy_service.run_rds_snapshot_backup('failsafe_database', context)
+    rds.add_tags_to_resource.assert_called_once_with(
+        ResourceName='arn:aws:rds:ap-southeast-2:129000003686:snapshot:failsafe-failsafe-database-2017-11-26',
+        Tags=[{'Key': 'FailsafePendingCompletion', 'Value': 'true'}])
+    copy_service.share_failsafe_snapshot.assert_not_called()
+
+
+def test_copy_outlasting_the_function_is_shared_by_a_continuation():
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_POLL
+    copied_snapshot = {'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26',
+                       'DBInstanceIdentifier': 'failsafe_database',
+                       'SnapshotType': 'manual',
+                       'Status': 'creating',
+                       'AllocatedStorage': 10}
+    rds = MagicMock()
+
+    def describe_copy(**kwargs):
+        if kwargs.get('Filters'):
+            return {'DBSnapshots': [copied_snapshot]}
+        return describe_db_snapshots(**kwargs)
+
+    rds.describe_db_snapshots.side_effect = describe_copy
+    rds.copy_db_snapshot.return_value = {'DBSnapshot': dict(copied_snapshot)}
+    short_context = MagicMock()
+    short_context.get_remaining_time_in_millis.return_value = 10000
+    copy_service.client = MagicMock(return_value=rds)
+    copy_service.continuation_invoker = FakeInvoker()
+    clock = MagicMock(return_value=1000)
+    estimator = CopyProgressEstimator(clock=clock)
+    copy_service.snapshot_waiters = WaiterRegistry(lambda rds: SnapshotWaiter(rds, sleep=MagicMock(),
+                                                                              estimator=estimator))
+    copy_service.share_failsafe_snapshot = MagicMock()
+    copy_service.send_sns_to_failsafe_account = MagicMock()
+    copy_service.back_up_instance('failsafe_database', short_context)['Status'].should.equal('pending')
+    copy_service.continuation_invoker.payloads.should.equal([{'Continuation': {
+        'Pipeline': 'copy', 'Phase': 'wait', 'Attempt': 1, 'CompletedPhases': ['delete_old', 'copy'],
+        'Instance': 'failsafe_database', 'FailsafeSnapshotID': 'failsafe-failsafe-database-2017-11-26',
+        'CopyStartedAt': 1000}}])
+    rds.add_tags_to_resource.assert_not_called()
+    copied_snapshot['Status'] = 'available'
+    clock.return_value = 1600
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 900000
+    copy_service.continuation_invoker.drain(copy_service.handler, context).should.equal([[
+        {'Instance': 'failsafe_database', 'Status': 'completed',
+         'FailsafeSnapshotID': 'failsafe-failsafe-database-2017-11-26'}]])
+    rds.copy_db_snapshot.assert_called_once()
+    copy_service.share_failsafe_snapshot.call_args[0][1].should.equal('failsafe-failsafe-database-2017-11-26')
+    copy_service.send_sns_to_failsafe_account.assert_called_once_with(
+        'failsafe_database', 'failsafe-failsafe-database-2017-11-26')
+    estimator.history.get('rate:failsafe_database').should.equal(60)
+
+
+def create_failsafe_snapshot():
+    rds = client('rds', region_name='ap-southeast-2')
+    rds.create_db_instance(DBInstanceIdentifier='failsafe_database',
+                           AllocatedStorage=10,
+                           Engine='postgres',
+                           DBName='staging-postgres',
+                           DBInstanceClass='db.m1.small',
+                           MasterUsername='root_failsafe',
+                           MasterUserPassword='hunter_failsafe')
+    return rds.create_db_snapshot(DBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26',
+                                  DBInstanceIdentifier='failsafe_database')['DBSnapshot']
+
+
+def test_handler_backs_up_every_instance_of_a_batch():
+    copy_service.client = MagicMock()
+    copy_service.run_rds_snapshot_backup = MagicMock(
+        side_effect=lambda instance, context, rds: copy_service.backup_result(instance, 'completed'))
+    event = get_backup_completed_event('reptileinx-01-db', 'reptileinx-02-db', 'reptileinx-01-db')
+    results = copy_service.handler(event, None)
+    [result['Instance'] for result in results].should.equal(['reptileinx-01-db', 'reptileinx-02-db'])
+    copy_service.run_rds_snapshot_backup.call_count.should.equal(2)
+
+
+
+def test_unsuitable_events_of_a_batch_are_skipped_and_the_rest_backed_up():
+    copy_service.client = MagicMock()
+    copy_service.run_rds_snapshot_backup = MagicMock(
+        side_effect=lambda instance, context, rds: copy_service.backup_result(instance, 'completed'))
+    event = get_backup_completed_event('reptileinx-01-db', 'reptileinx-02-db', 'reptileinx-01-db')
+    for record in event['Records'][1:]:
+        message = json.loads(record['Sns']['Message'])
+        message['Event ID'] = message['Event ID'].replace('RDS-EVENT-0002', 'RDS-EVENT-0001')
+        message['Event Message'] = 'Backing up DB instance'
+        record['Sns']['Message'] = json.dumps(message)
+    copy_service.handler(event, None).should.equal([
+        {'Instance': 'reptileinx-02-db', 'Status': 'skipped'},
+        {'Instance': 'reptileinx-01-db', 'Status': 'completed'}])
+    copy_service.run_rds_snapshot_backup.call_count.should.equal(1)
+
+def test_handler_processes_the_notifications_batched_with_a_continuation():
+    copy_service.client = MagicMock()
+    copy_service.run_rds_snapshot_backup = MagicMock(
+        side_effect=lambda instance, context, rds: copy_service.backup_result(instance, 'completed'))
+    copy_service.resume_backup = MagicMock(
+        side_effect=lambda state, context: copy_service.backup_result(state['Instance'], 'completed'))
+    event = get_backup_completed_event('reptileinx-01-db')
+    event['Records'].append({'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps({'Continuation': {
+        'Pipeline': 'copy', 'Phase': 'wait', 'Attempt': 1, 'Instance': 'reptileinx-02-db',
+        'FailsafeSnapshotID': 'failsafe-reptileinx-02-db-2017-11-26'}})}})
+    results = copy_service.handler(event, None)
+    [result['Instance'] for result in results].should.equal(['reptileinx-02-db', 'reptileinx-01-db'])
+    copy_service.run_rds_snapshot_backup.call_args[0][0].should.equal('reptileinx-01-db')
+
+
+def test_handler_reports_failure_of_one_instance_without_stopping_others():
+    copy_service.client = MagicMock()
+
+    def run_rds_snapshot_backup(instance, context, rds):
+        if instance == 'reptileinx-01-db':
+            raise IndexError('list index out of range')
+        return copy_service.backup_result(instance, 'completed', 'failsafe-' + instance)
+
+    copy_service.run_rds_snapshot_backup = run_rds_snapshot_backup
+    results = copy_service.handler(get_backup_completed_event('reptileinx-01-db', 'reptileinx-02-db'), None)
+    results.should.equal([
+        {'Instance': 'reptileinx-01-db', 'Status': 'failed', 'Error': 'list index out of range'},
+        {'Instance': 'reptileinx-02-db', 'Status': 'completed', 'FailsafeSnapshotID': 'failsafe-reptileinx-02-db'}])
+
+
+@mock_rds2
+def test_scheduled_event_backs_up_every_tagged_instance():
+    rds = client('rds', region_name='ap-southeast-2')
+    for instance, failsafe in [('failsafe_database_1', 'true'), ('database_2', 'false'),
+                               ('failsafe_database_3', 'True'), ('database_4', None)]:
+        rds.create_db_instance(DBInstanceIdentifier=instance,
+                               AllocatedStorage=10,
+                               Engine='postgres',
+                               DBInstanceClass='db.m1.small',
+                               MasterUsername='root_failsafe',
+                               MasterUserPassword='hunter_failsafe',
+                               Tags=[{'Key': 'Failsafe', 'Value': failsafe}] if failsafe else [])
+    copy_service.apply_backup_plan = MagicMock(
+        side_effect=lambda rds, plan, inventory, context: [copy_service.backup_result(instance, 'completed')
+                                                           for instance in plan.instances])
+    results = copy_service.handler(get_scheduled_event(), None)
+    sorted(result['Instance'] for result in results).should.equal(['failsafe_database_1', 'failsafe_database_3'])
+
+
+def fleet_client():
+    rds = MagicMock()
+    automated = [{'DBSnapshotIdentifier': 'rds:failsafe-database-{}-2017-11-26'.format(number),
+                  'DBInstanceIdentifier': 'failsafe_database_{}'.format(number),
+                  'SnapshotType': 'automated',
+                  'Status': 'available',
+                  'SnapshotCreateTime': datetime(2017, 11, 26)} for number in (1, 2)]
+    manual = [{'DBSnapshotIdentifier': 'failsafe-failsafe-database-{}-2017-11-25'.format(number),
+               'DBInstanceIdentifier': 'failsafe_database_{}'.format(number),
+               'SnapshotType': 'manual',
+               'Status': 'available',
+               'SnapshotCreateTime': datetime(2017, 11, 25)} for number in (1, 2)]
+    rds.describe_db_snapshots.side_effect = lambda **kwargs: {
+        'DBSnapshots': automated if kwargs.get('SnapshotType') == 'automated' else manual}
+    rds.copy_db_snapshot.side_effect = lambda **kwargs: {'DBSnapshot': {
+        'DBSnapshotIdentifier': kwargs['TargetDBSnapshotIdentifier'],
+        'DBInstanceIdentifier': kwargs['TargetDBSnapshotIdentifier'][9:-11].replace('-', '_'),
+        'SnapshotType': 'manual',
+        'Status': 'creating'}}
+    return rds
+
+
+def test_fleet_run_applies_one_plan_read_from_one_listing():
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_POLL
+    rds = fleet_client()
+
+    def wait(rds, instance, failsafe_snapshot, inventory, context):
+        inventory.record_copy({'DBSnapshot': dict(inventory.find('', 'manual', failsafe_snapshot),
+                                                  Status='available')})
+
+    copy_service.wait_until_failsafe_snapshot_is_available = MagicMock(side_effect=wait)
+    copy_service.send_sns_to_failsafe_account = MagicMock()
+    results = copy_service.run_fleet_backup(rds=rds, instances=['failsafe_database_1', 'failsafe_database_2'])
+    [(result['Instance'], result['Status']) for result in results].should.equal([
+        ('failsafe_database_1', 'completed'), ('failsafe_database_2', 'completed')])
+    [call[1].get('DBInstanceIdentifier') for call in rds.describe_db_snapshots.call_args_list
+     if call[1].get('IncludeShared')].should.equal([None, None])
+    sorted(call[1]['DBSnapshotIdentifier'] for call in rds.delete_db_snapshot.call_args_list).should.equal([
+        'failsafe-failsafe-database-1-2017-11-25', 'failsafe-failsafe-database-2-2017-11-25'])
+    sorted(call[1]['DBSnapshotIdentifier'] for call in rds.modify_db_snapshot_attribute.call_args_list) \
+        .should.equal(['failsafe-failsafe-database-1-2017-11-26', 'failsafe-failsafe-database-2-2017-11-26'])
+    copy_service.send_sns_to_failsafe_account.call_count.should.equal(2)
+
+
+def test_fleet_run_fails_the_instance_whose_old_copy_could_not_be_deleted(tmp_path):
+    copy_service.FAILSAFE_COMPLETION_MODE = copy_service.COMPLETION_MODE_EVENT
+    copy_service.ledger = IdempotencyLedger(rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    rds = fleet_client()
+
+    def delete_db_snapshot(DBSnapshotIdentifier):
+        if DBSnapshotIdentifier == 'failsafe-failsafe-database-1-2017-11-25':
+            raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'DeleteDBSnapshot')
+
+    rds.delete_db_snapshot.side_effect = delete_db_snapshot
+    results = copy_service.run_fleet_backup(rds=rds, instances=['failsafe_database_1', 'failsafe_database_2'])
+    [(result['Instance'], result['Status']) for result in results].should.equal([
+        ('failsafe_database_1', 'failed'), ('failsafe_database_2', 'pending')])
+    results[0]['Error'].should.contain('failsafe-failsafe-database-1-2017-11-25')
+    [call[1]['TargetDBSnapshotIdentifier'] for call in rds.copy_db_snapshot.call_args_list].should.equal([
+        'failsafe-failsafe-database-2-2017-11-26'])
+    copy_service.ledger.get('rds:failsafe-database-1-2017-11-26').should.be.none
+
+
+def test_dry_run_prints_the_plan_without_applying_it():
+    rds = fleet_client()
+    copy_service.run_fleet_backup(rds=rds, instances=['failsafe_database_1'], dry_run=True).should.equal([
+        'delete  failsafe_database_1            failsafe-failsafe-database-1-2017-11-25',
+        'copy    failsafe_database_1            failsafe-failsafe-database-1-2017-11-26 '
+        'from rds:failsafe-database-1-2017-11-26',
+        'share   failsafe_database_1            failsafe-failsafe-database-1-2017-11-26',
+        'notify  failsafe_database_1            failsafe-failsafe-database-1-2017-11-26'])
+    rds.delete_db_snapshot.assert_not_called()
+    rds.copy_db_snapshot.assert_not_called()
+    rds.modify_db_snapshot_attribute.assert_not_called()
+
+
+def test_instance_tags_are_cached_between_scans():
+    rds = MagicMock()
+    rds.describe_db_instances.side_effect = [
+        {'DBInstances': [{'DBInstanceIdentifier': 'failsafe_database_1',
+                          'DBInstanceArn': 'arn:aws:rds:ap-southeast-2:129000003686:db:failsafe_database_1'}],
+         'Marker': 'failsafe_database_1'},
+        {'DBInstances': [{'DBInstanceIdentifier': 'database_2',
+                          'DBInstanceArn': 'arn:aws:rds:ap-southeast-2:129000003686:db:database_2'}]}] * 2
+    rds.list_tags_for_resource.side_effect = [{'TagList': [{'Key': 'Failsafe', 'Value': 'true'}]},
+                                              {'TagList': []}]
+    copy_service.get_db_instances_by_tags(rds, []).should.equal(['failsafe_database_1'])
+    copy_service.get_db_instances_by_tags(rds, []).should.equal(['failsafe_database_1'])
+    rds.list_tags_for_resource.call_count.should.equal(2)
+    rds.describe_db_instances.call_count.should.equal(4)
+
+
+@mock_sns
+def test_save_topic_is_found_beyond_the_first_page_of_topics():
+    sns = client('sns', region_name='ap-southeast-2')
+    for number in range(120):
+        sns.create_topic(Name='topic-{:03d}'.format(number))
+    topic_arn = sns.create_topic(Name=copy_service.SNS_RDS_SAVE_TOPIC)['TopicArn']
+    copy_service.get_subscription_sns_topic_arn().should.equal(topic_arn)
+
+
+def test_save_topic_arn_is_cached_until_it_expires():
+    sns = MagicMock()
+    sns.list_topics.return_value = {'Topics': [
+        {'TopicArn': 'arn:aws:sns:ap-southeast-2:129000003686:reptileinx_save_failsafe_snapshot_sns_topic'}]}
+    copy_service.client = MagicMock(return_value=sns)
+    copy_service.get_subscription_sns_topic_arn()
+    copy_service.get_subscription_sns_topic_arn()
+    sns.list_topics.call_count.should.equal(1)
+    copy_service.SNS_TOPIC_ARN_CACHE_TTL_SECONDS = -1
+    copy_service._sns_topic_arns.clear()
+    copy_service.get_subscription_sns_topic_arn()
+    copy_service.get_subscription_sns_topic_arn()
+    sns.list_topics.call_count.should.equal(3)
+
+
+
+def test_concurrent_backups_look_the_save_topic_up_once():
+    sns = MagicMock()
+    listed = threading.Event()
+
+    def list_topics(**_):
+        listed.wait(1)
+        return {'Topics': [{'TopicArn': 'arn:aws:sns:ap-southeast-2:129000003686:'
+                                        'reptileinx_save_failsafe_snapshot_sns_topic'}]}
+    sns.list_topics.side_effect = list_topics
+    copy_service.client = MagicMock(return_value=sns)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        lookups = [executor.submit(copy_service.get_subscription_sns_topic_arn) for _ in range(4)]
+        listed.set()
+    set(lookup.result() for lookup in lookups).should.equal(
+        {'arn:aws:sns:ap-southeast-2:129000003686:reptileinx_save_failsafe_snapshot_sns_topic'})
+    sns.list_topics.call_count.should.equal(1)
+
+def test_save_topic_arn_from_the_environment_is_not_looked_up():
+    copy_service.SNS_RDS_SAVE_TOPIC_ARN = 'arn:aws:sns:ap-southeast-2:129000003686:save'
+    copy_service.client = MagicMock()
+    copy_service.get_subscription_sns_topic_arn().should.equal('arn:aws:sns:ap-southeast-2:129000003686:save')
+    copy_service.client.assert_not_called()
+
+
+def get_scheduled_event():
+    return {
+        "version": "0",
+        "id": "89d1a02d-5ec7-412e-82f5-13505f849b41",
+        "detail-type": "Scheduled Event",
+        "source": "aws.events",
+        "account": "129000003686",
+        "time": "2017-11-26T18:00:00Z",
+        "region": "ap-southeast-2",
+        "resources": ["arn:aws:events:ap-southeast-2:129000003686:rule/RDSCopySnapshotFunctionTimer"],
+        "detail": {}
+    }
+
+
+def get_backup_completed_event(*instances):
+    return {
+        "Records": [
+            {
+                "EventVersion": "1.0",
+                "EventSource": "aws:sns",
+                "Sns": {
+                    "Type": "Notification",
+                    "TopicArn": "arn:aws:sns:ap-southeast-2:129000003686:reptileinx_copy_failsafe_snapshot_sns_topic",
+                    "Subject": "RDS Notification Message",
+                    "Message": json.dumps({
+                        "Event Source": "db-instance",
+                        "Event Time": "2017-11-26 16:05:27.306",
+                        "Source ID": instance,
+                        "Event ID": "http://docs.amazonwebservices.com/AmazonRDS/latest/UserGuide/USER_Events.html#RDS-EVENT-0002",
+                        "Event Message": "Finished DB Instance backup"
+                    })
+                }
+            } for instance in instances
+        ]
+    }
+
+
+def get_snapshot_created_event(snapshot_id, event_id='RDS-EVENT-0042', event_message='Manual snapshot created'):
+    return {
+        "Records": [
+            {
+                "EventVersion": "1.0",
+                "EventSubscriptionArn": "arn:aws:sns:ap-southeast-2:129000003686:reptileinx_snapshot:183d5f808",
+                "EventSource": "aws:sns",
+                "Sns": {
+                    "Type": "Notification",
+                    "TopicArn": "arn:aws:sns:ap-southeast-2:129000003686:reptileinx_copy_failsafe_snapshot_sns_topic",
+                    "Subject": "RDS Notification Message",
+                    "Message": json.dumps({
+                        "Event Source": "db-snapshot",
+                        "Event Time": "2017-11-26 16:35:27.306",
+                        "Identifier Link": "https://console.aws.amazon.com/rds/home?region=ap-southeast-2#snapshot:id=" + snapshot_id,
+                        "Source ID": snapshot_id,
+                        "Event ID": "http://docs.amazonwebservices.com/AmazonRDS/latest/UserGuide/USER_Events.html#"
+                                    + event_id,
+                        "Event Message": event_message
+                    })
+                }
+            }
+        ]
+    }
+
+
+__all__ = ['sure']  # trick linting to consider python sure by exporting it
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta, timezone
+
+import sure
+from mock import MagicMock
+
+import rdsclients as clients_service
+
+
+def test_clients_are_created_once_per_service_and_region():
+    factory = MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+    registry = clients_service.ClientRegistry(factory)
+    rds = registry.get('rds', 'ap-southeast-2')
+    registry.get('rds', 'ap-southeast-2').should.be(rds)
+    registry.get('sns', 'ap-southeast-2').shouldnt.be(rds)
+    registry.get('rds', 'us-east-1').shouldnt.be(rds)
+    factory.call_count.should.equal(3)
+
+
+def test_clients_are_created_with_the_tuned_config():
+    factory = MagicMock()
+    clients_service.ClientRegistry(factory).get('rds', 'ap-southeast-2')
+    config = factory.call_args[1]['config']
+    config.max_pool_connections.should.equal(clients_service.CLIENT_MAX_POOL_CONNECTIONS)
+    config.tcp_keepalive.should.be.true
+    config.retries.should.equal({'mode': clients_service.CLIENT_RETRY_MODE,
+                                 'max_attempts': clients_service.CLIENT_MAX_ATTEMPTS})
+
+
+def test_clients_of_an_assumed_role_are_renewed_before_the_credentials_expire():
+    now = datetime(2017, 11, 26, 18, tzinfo=timezone.utc)
+    sts = MagicMock()
+    sts.assume_role.return_value = {'Credentials': {'AccessKeyId': 'access',
+                                                    'SecretAccessKey': 'secret',
+                                                    'SessionToken': 'token',
+                                                    'Expiration': now + timedelta(hours=1)}}
+    factory = MagicMock(side_effect=lambda service_name, **kwargs: sts if service_name == 'sts' else MagicMock())
+    clock = MagicMock(return_value=now.timestamp())
+    registry = clients_service.ClientRegistry(factory, clock=clock)
+    role_arn = 'arn:aws:iam::129000003686:role/failsafe'
+    rds = registry.get('rds', 'ap-southeast-2', role_arn)
+    registry.get('rds', 'ap-southeast-2', role_arn).should.be(rds)
+    factory.call_args[1]['aws_session_token'].should.equal('token')
+    clock.return_value = (now + timedelta(minutes=56)).timestamp()
+    registry.get('rds', 'ap-southeast-2', role_arn).shouldnt.be(rds)
+    sts.assume_role.call_count.should.equal(2)
+
+
+__all__ = ['sure']  # trick linting to consider python sure by exporting it
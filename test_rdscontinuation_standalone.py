@@ -0,0 +1,69 @@
+import json
+
+import sure
+from mock import MagicMock
+
+import rdscontinuation
+from rdscontinuation import FakeInvoker, LambdaInvoker, TopicInvoker, \
+    continue_later, read_continuations
+
+
+def test_continuation_is_read_from_a_direct_invocation_and_from_a_topic():
+    invoker = FakeInvoker()
+    continue_later(invoker, 'save', 'wait', 1, Instance='failsafe_database_1',
+                   FailsafeSnapshotID='failsafe-snapshot-1')
+    payload = invoker.payloads[0]
+    state = {'Pipeline': 'save', 'Phase': 'wait', 'Attempt': 1,
+             'Instance': 'failsafe_database_1', 'FailsafeSnapshotID': 'failsafe-snapshot-1'}
+    read_continuations(payload, 'save').should.equal([state])
+    read_continuations({'Records': [{'EventSource': 'aws:sns',
+                                     'Sns': {'Message': json.dumps(payload)}}]}, 'save').should.equal([state])
+    read_continuations(payload, 'copy').should.equal([])
+
+
+def test_rds_notifications_are_not_continuations():
+    read_continuations({'Records': [{'EventSource': 'aws:sns',
+                                     'Sns': {'Message': json.dumps({'Event ID': 'RDS-EVENT-0002',
+                                                                    'Source ID': 'failsafe_database'})}}]},
+                       'copy').should.equal([])
+    read_continuations({'Records': [{'EventSource': 'aws:sns',
+                                     'Sns': {'Message': 'not json'}}]}, 'copy').should.equal([])
+    read_continuations([], 'copy').should.equal([])
+
+
+def test_phase_is_not_continued_beyond_the_maximum_attempts():
+    invoker = FakeInvoker()
+    continue_later(invoker, 'copy', 'wait', rdscontinuation.CONTINUATION_MAX_ATTEMPTS,
+                   Instance='failsafe_database').should.be.true
+    continue_later(invoker, 'copy', 'wait', rdscontinuation.CONTINUATION_MAX_ATTEMPTS + 1,
+                   Instance='failsafe_database').should.be.false
+    continue_later(None, 'copy', 'wait', 1, Instance='failsafe_database').should.be.false
+    invoker.payloads.should.have.length_of(1)
+
+
+def test_invokers_send_the_state_asynchronously():
+    lambda_client, sns = MagicMock(), MagicMock()
+    payload = {'Continuation': {'Pipeline': 'copy', 'Phase': 'copy', 'Attempt': 1}}
+    LambdaInvoker(lambda_client, 'arn:aws:lambda:ap-southeast-2:129000003686:function:copy').invoke(payload)
+    lambda_client.invoke.assert_called_once_with(
+        FunctionName='arn:aws:lambda:ap-southeast-2:129000003686:function:copy',
+        InvocationType='Event', Payload=json.dumps(payload))
+    TopicInvoker(sns, 'arn:aws:sns:ap-southeast-2:129000003686:copy').invoke(payload)
+    sns.publish.assert_called_once_with(TopicArn='arn:aws:sns:ap-southeast-2:129000003686:copy',
+                                        Message=json.dumps(payload))
+
+
+def test_fake_invoker_runs_the_chain_of_invocations():
+    invoker = FakeInvoker()
+
+    def handler(event, context):
+        state = read_continuations(event, 'copy')[0]
+        continue_later(invoker, 'copy', 'wait', state['Attempt'] + 1)
+        return state['Attempt']
+
+    continue_later(invoker, 'copy', 'wait', 1)
+    invoker.drain(handler).should.equal(list(range(1, rdscontinuation.CONTINUATION_MAX_ATTEMPTS + 1)))
+    invoker.payloads.should.be.empty
+
+
+__all__ = ['sure']
@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+import sure
+from botocore.exceptions import ClientError
+from mock import MagicMock
+
+import rdscopyquota as quota_service
+from rdspolling import PollingSchedule
+
+
+def get_rds(*in_progress):
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [
+        {'DBSnapshotIdentifier': snapshot_id, 'Status': 'creating'} for snapshot_id in in_progress]}
+    rds.copy_db_snapshot.side_effect = lambda **kwargs: {'DBSnapshot': {
+        'DBSnapshotIdentifier': kwargs['TargetDBSnapshotIdentifier'], 'Status': 'creating'}}
+    return rds
+
+
+def get_context(remaining_millis):
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = remaining_millis
+    return context
+
+
+def test_copy_is_admitted_while_under_the_quota():
+    rds = get_rds('someone-elses-copy')
+    scheduler = quota_service.CopyQuotaScheduler(limit=2)
+    response = scheduler.copy(rds, SourceDBSnapshotIdentifier='rds:failsafe-database-2017-11-26',
+                              TargetDBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26')
+    response['DBSnapshot']['DBSnapshotIdentifier'].should.equal('failsafe-failsafe-database-2017-11-26')
+    scheduler.in_flight().should.equal(2)
+    rds.describe_db_snapshots.assert_called_once_with(SnapshotType='manual', MaxRecords=100)
+
+
+def test_copy_is_not_admitted_when_the_quota_stays_full_until_the_deadline():
+    rds = get_rds('someone-elses-copy')
+    scheduler = quota_service.CopyQuotaScheduler(limit=1)
+    with pytest.raises(quota_service.CopyNotAdmitted):
+        scheduler.copy(rds, get_context(10000), SourceDBSnapshotIdentifier='rds:failsafe-database-2017-11-26',
+                       TargetDBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26')
+    rds.copy_db_snapshot.assert_not_called()
+
+
+def test_copies_started_here_are_counted_from_the_listing_once_rds_lists_them():
+    rds = get_rds()
+    scheduler = quota_service.CopyQuotaScheduler(limit=2)
+    scheduler.copy(rds, SourceDBSnapshotIdentifier='rds:failsafe-database-2017-11-26',
+                   TargetDBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26')
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [
+        {'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26', 'Status': 'available'}]}
+    scheduler.count(rds).should.equal(0)
+
+
+def test_copy_refused_for_quota_is_queued_again():
+    rds = get_rds()
+    rds.copy_db_snapshot.side_effect = [
+        ClientError({'Error': {'Code': 'SnapshotQuotaExceeded'}}, 'CopyDBSnapshot'),
+        {'DBSnapshot': {'DBSnapshotIdentifier': 'failsafe-failsafe-database-2017-11-26'}}]
+    scheduler = quota_service.CopyQuotaScheduler(limit=2, recount_interval=0.01)
+    scheduler.copy(rds, SourceDBSnapshotIdentifier='rds:failsafe-database-2017-11-26',
+                   TargetDBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26')
+    rds.copy_db_snapshot.call_count.should.equal(2)
+    rds.describe_db_snapshots.call_count.should.equal(2)
+
+
+def test_other_copy_errors_are_raised():
+    rds = get_rds()
+    rds.copy_db_snapshot.side_effect = ClientError({'Error': {'Code': 'DBSnapshotAlreadyExists'}},
+                                                   'CopyDBSnapshot')
+    scheduler = quota_service.CopyQuotaScheduler(limit=2)
+    with pytest.raises(ClientError):
+        scheduler.copy(rds, SourceDBSnapshotIdentifier='rds:failsafe-database-2017-11-26',
+                       TargetDBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26')
+    scheduler.in_flight().should.equal(0)
+
+
+def test_listing_does_not_hold_up_the_other_threads():
+    rds = get_rds()
+    scheduler = quota_service.CopyQuotaScheduler(limit=2)
+    answered = []
+
+    def describe_db_snapshots(**kwargs):
+        other = threading.Thread(target=lambda: answered.append(scheduler.in_flight()))
+        other.start()
+        other.join(1)
+        return {'DBSnapshots': []}
+
+    rds.describe_db_snapshots.side_effect = describe_db_snapshots
+    scheduler.copy(rds, SourceDBSnapshotIdentifier='rds:failsafe-database-2017-11-26',
+                   TargetDBSnapshotIdentifier='failsafe-failsafe-database-2017-11-26')
+    answered.should.equal([0])
+
+
+def test_wake_ups_of_a_full_queue_are_not_counted_as_polls():
+    rds = get_rds()
+    scheduler = quota_service.CopyQuotaScheduler(limit=1, recount_interval=60)
+    scheduler.admit(rds, 'failsafe-snapshot-1')
+    schedule = PollingSchedule(initial_interval=60)
+    waiting = threading.Thread(target=scheduler.admit, args=(rds, 'failsafe-snapshot-2', schedule))
+    waiting.start()
+    for _ in range(3):
+        time.sleep(0.01)
+        scheduler.release('someone-elses-copy')
+    scheduler.release('failsafe-snapshot-1')
+    waiting.join(5)
+    scheduler.in_flight().should.equal(1)
+    schedule.attempts.should.equal(1)
+
+
+def test_parallel_copies_never_exceed_the_quota():
+    rds = get_rds()
+    scheduler = quota_service.CopyQuotaScheduler(limit=2, recount_interval=0.01)
+    peak = []
+
+    def copy(number):
+        snapshot_id = 'failsafe-snapshot-{}'.format(number)
+        scheduler.copy(rds, SourceDBSnapshotIdentifier='rds:snapshot-{}'.format(number),
+                       TargetDBSnapshotIdentifier=snapshot_id)
+        peak.append(scheduler.in_flight())
+        time.sleep(0.02)
+        scheduler.release(snapshot_id)
+
+    threads = [threading.Thread(target=copy, args=(number,)) for number in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rds.copy_db_snapshot.call_count.should.equal(6)
+    max(peak).should.be.lower_than_or_equal_to(2)
+
+
+__all__ = ['sure']  # trick linting to consider python sure by exporting it
@@ -0,0 +1,65 @@
+import sure
+from botocore.exceptions import ClientError
+from mock import MagicMock
+
+import rdsdeletion as deletion_service
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code}}, 'DeleteDBSnapshot')
+
+
+def test_delete_snapshots_reports_deleted_skipped_and_failed():
+    outcomes = {'failsafe-snapshot-1': None,
+                'failsafe-snapshot-2': client_error('DBSnapshotNotFound'),
+                'failsafe-snapshot-3': client_error('AccessDenied')}
+
+    def delete_db_snapshot(DBSnapshotIdentifier):
+        if outcomes[DBSnapshotIdentifier]:
+            raise outcomes[DBSnapshotIdentifier]
+
+    rds = MagicMock()
+    rds.delete_db_snapshot.side_effect = delete_db_snapshot
+    inventory = MagicMock()
+    summary = deletion_service.delete_snapshots(rds, sorted(outcomes), inventory)
+    summary.deleted.should.equal(['failsafe-snapshot-1'])
+    summary.skipped.should.equal({'failsafe-snapshot-2': 'DBSnapshotNotFound'})
+    list(summary.failed).should.equal(['failsafe-snapshot-3'])
+    summary.as_dict().should.equal({'Deleted': 1, 'Skipped': 1, 'Failed': 1})
+    sorted(args[0] for args, _ in inventory.record_delete.call_args_list).should.equal(
+        ['failsafe-snapshot-1', 'failsafe-snapshot-2'])
+
+
+def test_throttled_delete_is_retried_with_backoff():
+    rds = MagicMock()
+    rds.delete_db_snapshot.side_effect = [client_error('Throttling'), client_error('Throttling'), {}]
+    sleep = MagicMock()
+    deletion_service.delete_snapshot(rds, 'failsafe-snapshot-1', sleep=sleep).should.equal(('deleted', None))
+    sleep.call_count.should.equal(2)
+
+
+def test_throttled_delete_fails_after_max_attempts():
+    rds = MagicMock()
+    rds.delete_db_snapshot.side_effect = client_error('Throttling')
+    status, _ = deletion_service.delete_snapshot(rds, 'failsafe-snapshot-1', sleep=MagicMock())
+    status.should.equal('failed')
+    rds.delete_db_snapshot.call_count.should.equal(deletion_service.DELETE_MAX_ATTEMPTS)
+
+
+def test_throttled_delete_fails_at_the_deadline():
+    rds = MagicMock()
+    rds.delete_db_snapshot.side_effect = client_error('Throttling')
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 10000
+    status, _ = deletion_service.delete_snapshot(rds, 'failsafe-snapshot-1', context, sleep=MagicMock())
+    status.should.equal('failed')
+    rds.delete_db_snapshot.call_count.should.equal(1)
+
+
+def test_delete_snapshots_without_snapshots_does_nothing():
+    rds = MagicMock()
+    deletion_service.delete_snapshots(rds, []).as_dict().should.equal({'Deleted': 0, 'Skipped': 0, 'Failed': 0})
+    rds.delete_db_snapshot.assert_not_called()
+
+
+__all__ = ['sure']  # trick linting to consider python sure by exporting it
@@ -0,0 +1,154 @@
+import sure
+from botocore.exceptions import ClientError
+from mock import MagicMock, call
+
+import rdsinventory as inventory_service
+
+
+def describe_pages(*pages):
+    responses = []
+    for number, page in enumerate(pages):
+        response = {'DBSnapshots': [{'DBSnapshotIdentifier': snapshot_id,
+                                     'Status': 'available',
+                                     'SnapshotCreateTime': created}
+                                    for snapshot_id, created in page]}
+        if number < len(pages) - 1:
+            response['Marker'] = 'marker-{}'.format(number + 1)
+        responses.append(response)
+    return responses
+
+
+def test_iterate_snapshot_pages_follows_marker_until_last_page():
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = describe_pages(
+        [('snapshot-1', 1), ('snapshot-2', 2)], [('snapshot-3', 3)])
+    pages = list(inventory_service.iterate_snapshot_pages(
+        rds, SnapshotType='manual', DBInstanceIdentifier='failsafe_database'))
+    pages.should.have.length_of(2)
+    rds.describe_db_snapshots.assert_has_calls([
+        call(SnapshotType='manual', DBInstanceIdentifier='failsafe_database',
+             MaxRecords=100),
+        call(SnapshotType='manual', DBInstanceIdentifier='failsafe_database',
+             MaxRecords=100, Marker='marker-1')])
+
+
+def test_iterate_snapshot_pages_drops_empty_filters():
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': None}
+    list(inventory_service.iterate_snapshot_pages(
+        rds, SnapshotType='shared', DBInstanceIdentifier='',
+        IncludeShared=True)).should.equal([[]])
+    rds.describe_db_snapshots.assert_called_once_with(
+        SnapshotType='shared', IncludeShared=True, MaxRecords=100)
+
+
+def test_iterate_snapshots_is_lazy():
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = describe_pages(
+        [('snapshot-1', 1)], [('snapshot-2', 2)])
+    snapshot = inventory_service.find_snapshot(
+        inventory_service.iterate_snapshots(rds), 'snapshot-1')
+    snapshot['DBSnapshotIdentifier'].should.equal('snapshot-1')
+    rds.describe_db_snapshots.call_count.should.equal(1)
+
+
+def test_newest_snapshot_spans_pages():
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = describe_pages(
+        [('snapshot-1', 1), ('snapshot-3', 3)], [('snapshot-2', 2)])
+    newest = inventory_service.newest_snapshot(
+        inventory_service.iterate_snapshots(rds),
+        lambda snapshot: snapshot['SnapshotCreateTime'])
+    newest['DBSnapshotIdentifier'].should.equal('snapshot-3')
+
+
+def test_newest_snapshot_of_empty_listing_is_none():
+    inventory_service.newest_snapshot([], None).should.be.none
+
+
+def test_snapshot_inventory_reads_each_listing_once():
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [
+        {'DBSnapshotIdentifier': 'failsafe-snapshot-1',
+         'DBInstanceIdentifier': 'failsafe_database',
+         'SnapshotType': 'manual', 'Status': 'available'}]}
+    inventory = inventory_service.SnapshotInventory(rds)
+    inventory.snapshots('failsafe_database', 'manual').should.have.length_of(1)
+    inventory.find('failsafe_database', 'Manual',
+                   'failsafe-snapshot-1').should_not.be.none
+    rds.describe_db_snapshots.call_count.should.equal(1)
+
+
+def test_snapshot_inventory_follows_copy_and_delete_responses():
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [
+        {'DBSnapshotIdentifier': 'failsafe-snapshot-1',
+         'DBInstanceIdentifier': 'failsafe_database',
+         'SnapshotType': 'manual', 'Status': 'available'}]}
+    inventory = inventory_service.SnapshotInventory(rds)
+    inventory.snapshots('failsafe_database', 'manual')
+    inventory.record_delete('failsafe-snapshot-1')
+    inventory.record_copy({'DBSnapshot': {
+        'DBSnapshotIdentifier': 'failsafe-snapshot-2',
+        'DBInstanceIdentifier': 'failsafe_database',
+        'SnapshotType': 'manual', 'Status': 'creating'}})
+    [snapshot['DBSnapshotIdentifier'] for snapshot in inventory.snapshots(
+        'failsafe_database', 'manual')].should.equal(['failsafe-snapshot-2'])
+    rds.describe_db_snapshots.call_count.should.equal(1)
+
+
+def test_snapshot_inventory_refresh_forgets_snapshot_not_found():
+    rds = MagicMock()
+    rds.describe_db_snapshots.side_effect = [
+        {'DBSnapshots': [{'DBSnapshotIdentifier': 'failsafe-snapshot-1',
+                          'DBInstanceIdentifier': 'failsafe_database',
+                          'SnapshotType': 'manual', 'Status': 'creating'}]},
+        ClientError({'Error': {'Code': 'DBSnapshotNotFound'}},
+                    'DescribeDBSnapshots')]
+    inventory = inventory_service.SnapshotInventory(rds)
+    inventory.snapshots('failsafe_database', 'manual')
+    inventory.refresh_snapshot('failsafe-snapshot-1').should.be.none
+    inventory.snapshots('failsafe_database', 'manual').should.be.empty
+
+
+def shared_snapshot(account, snapshot_id):
+    return {'DBSnapshotIdentifier': 'arn:aws:rds:ap-southeast-2:{}:snapshot:{}'
+            .format(account, snapshot_id),
+            'SnapshotType': 'shared', 'Status': 'available'}
+
+
+def test_shared_snapshot_index_matches_exact_id_only():
+    index = inventory_service.SharedSnapshotIndex([
+        shared_snapshot('129000003686', 'failsafe-db-2017-11-26-18-00-2'),
+        shared_snapshot('129000003686', 'failsafe-db-2017-11-26-18-00')])
+    index.find('failsafe-db-2017-11-26-18-00')['DBSnapshotIdentifier'] \
+        .should.equal('arn:aws:rds:ap-southeast-2:129000003686:snapshot:'
+                      'failsafe-db-2017-11-26-18-00')
+    index.find('failsafe-db-2017-11').should.be.none
+    index.should.have.length_of(2)
+
+
+def test_shared_snapshot_index_needs_source_account_for_ambiguous_id():
+    index = inventory_service.SharedSnapshotIndex([
+        shared_snapshot('129000003686', 'failsafe-db-1'),
+        shared_snapshot('129000003687', 'failsafe-db-1')])
+    index.find('failsafe-db-1').should.be.none
+    index.find('failsafe-db-1', '129000003687')['DBSnapshotIdentifier'] \
+        .should.contain('129000003687')
+    index.find('arn:aws:rds:ap-southeast-2:129000003686:snapshot:'
+               'failsafe-db-1')['DBSnapshotIdentifier'] \
+        .should.contain('129000003686')
+
+
+def test_snapshot_inventory_builds_shared_index_once():
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [
+        shared_snapshot('129000003686', 'failsafe-db-1')]}
+    inventory = inventory_service.SnapshotInventory(rds)
+    inventory.shared_index().should.be(inventory.shared_index())
+    inventory.shared_index().find('failsafe-db-1').should_not.be.none
+    rds.describe_db_snapshots.assert_called_once_with(
+        SnapshotType='shared', IncludeShared=True, MaxRecords=100)
+
+
+__all__ = ['sure']  # trick linting to consider python sure by exporting it
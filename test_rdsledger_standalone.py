@@ -0,0 +1,63 @@
+import sure
+from mock import MagicMock
+
+import rdsledger
+import rdsstate
+
+
+def ledger_at(tmp_path, name='ledger.json', now=1000.0):
+    return rdsledger.IdempotencyLedger(rdsstate.open_store(str(tmp_path / name), 'ledger'), lease_seconds=60,
+                                       clock=MagicMock(return_value=now))
+
+
+def test_snapshot_is_claimed_once(tmp_path):
+    ledger = ledger_at(tmp_path)
+    ledger.claim('rds:failsafe-database-2017-11-26', Instance='failsafe_database').should.equal((True, None))
+    claimed, entry = ledger.claim('rds:failsafe-database-2017-11-26')
+    claimed.should.be.false
+    entry.should.equal({'Instance': 'failsafe_database', 'State': 'in_progress', 'UpdatedAt': 1000.0})
+
+
+def test_claim_of_a_dead_invocation_expires(tmp_path):
+    ledger = ledger_at(tmp_path)
+    ledger.claim('rds:failsafe-database-2017-11-26')
+    ledger.clock.return_value = 1059.0
+    ledger.claim('rds:failsafe-database-2017-11-26')[0].should.be.false
+    ledger.clock.return_value = 1060.0
+    ledger.claim('rds:failsafe-database-2017-11-26')[0].should.be.true
+
+
+def test_finished_copy_is_never_claimed_again(tmp_path):
+    ledger = ledger_at(tmp_path, 'ledger.sqlite')
+    ledger.claim('rds:failsafe-database-2017-11-26')
+    ledger.advance('rds:failsafe-database-2017-11-26', rdsledger.SHARED, FailsafeSnapshotID='failsafe-1')
+    ledger.clock.return_value = 1000000.0
+    ledger.claim('rds:failsafe-database-2017-11-26')[0].should.be.false
+    ledger.get('rds:failsafe-database-2017-11-26')['FailsafeSnapshotID'].should.equal('failsafe-1')
+
+
+def test_copied_snapshot_is_resumed(tmp_path):
+    ledger = ledger_at(tmp_path, 'ledger.sqlite')
+    ledger.claim('rds:failsafe-database-2017-11-26')
+    ledger.advance('rds:failsafe-database-2017-11-26', rdsledger.COPIED)
+    claimed, entry = ledger.claim('rds:failsafe-database-2017-11-26', resumable=(rdsledger.COPIED,))
+    claimed.should.be.true
+    entry['State'].should.equal('copied')
+    ledger.get('rds:failsafe-database-2017-11-26')['State'].should.equal('in_progress')
+
+
+def test_released_snapshot_can_be_claimed_again(tmp_path):
+    ledger = ledger_at(tmp_path)
+    ledger.claim('rds:failsafe-database-2017-11-26')
+    ledger.release('rds:failsafe-database-2017-11-26')
+    ledger.get('rds:failsafe-database-2017-11-26').should.be.none
+    ledger.claim('rds:failsafe-database-2017-11-26')[0].should.be.true
+
+
+def test_claim_lost_to_a_concurrent_invocation_is_refused(tmp_path):
+    ledger = ledger_at(tmp_path)
+    ledger.store.put_if = MagicMock(return_value=False)
+    ledger.claim('rds:failsafe-database-2017-11-26')[0].should.be.false
+
+
+__all__ = ['sure']
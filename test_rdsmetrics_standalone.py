@@ -0,0 +1,75 @@
+import json
+
+import sure
+from boto3 import client
+from botocore.exceptions import ClientError
+from mock import MagicMock
+from moto import mock_rds2
+
+import rdsmetrics as metrics_service
+
+
+@mock_rds2
+def test_calls_and_errors_are_counted_per_operation():
+    metrics = metrics_service.ApiMetrics()
+    rds = metrics.instrument(client('rds', region_name='ap-southeast-2'))
+    rds.describe_db_snapshots()
+    rds.describe_db_snapshots()
+    rds.delete_db_snapshot.when.called_with(DBSnapshotIdentifier='failsafe-snapshot-1').should.throw(ClientError)
+    operations = metrics.operations()
+    operations['DescribeDBSnapshots']['Calls'].should.equal(2)
+    operations['DescribeDBSnapshots'].should_not.have.key('Errors')
+    operations['DescribeDBSnapshots']['LatencyMax'].should.be.greater_than(0)
+    operations['DeleteDBSnapshot']['Calls'].should.equal(1)
+    operations['DeleteDBSnapshot']['Errors'].should.equal(1)
+
+
+def test_throttled_attempts_are_counted():
+    metrics = metrics_service.ApiMetrics()
+    operation = MagicMock()
+    operation.name = 'CopyDBSnapshot'
+    metrics._needs_retry(operation, response=(None, {'Error': {'Code': 'Throttling'}}))
+    metrics._needs_retry(operation, response=(None, {'ResponseMetadata': {}}))
+    metrics.operations()['CopyDBSnapshot']['Throttles'].should.equal(1)
+
+
+def test_handler_emits_one_emf_line_even_when_it_fails(capsys):
+    metrics = metrics_service.ApiMetrics(clock=MagicMock(return_value=1511719200))
+    metrics._add('Publish', 'Calls')
+
+    @metrics_service.metered_handler(metrics, 'rdscopysnapshots')
+    def handler(event, context):
+        metrics._add('Publish', 'Calls')
+        raise ValueError(event)
+
+    handler.when.called_with('event', None).should.throw(ValueError)
+    lines = capsys.readouterr().out.splitlines()
+    lines.should.have.length_of(1)
+    record = json.loads(lines[0])
+    record['Function'].should.equal('rdscopysnapshots')
+    record['Publish.Calls'].should.equal(1)
+    record['_aws']['Timestamp'].should.equal(1511719200000)
+    record['_aws']['CloudWatchMetrics'][0]['Dimensions'].should.equal([['Function']])
+    {'Name': 'Publish.LatencyMax', 'Unit': 'Milliseconds'}.should.be.within(
+        record['_aws']['CloudWatchMetrics'][0]['Metrics'])
+
+
+
+def test_copies_are_recorded_with_their_mode():
+    metrics = metrics_service.ApiMetrics(clock=MagicMock(return_value=1511719200))
+    metrics_service.record_copy(metrics, {'AllocatedStorage': 5}, 120.04, 'full')
+    metrics_service.record_copy(metrics, {}, 30, 'full')
+    record = metrics.emf_record('rdssavesnapshot')
+    record['CopyDuration'].should.equal([120.0, 30])
+    record['CopyAllocatedBytes'].should.equal([5 * 1024 ** 3])
+    record['CopyMode'].should.equal('full')
+    record['_aws']['CloudWatchMetrics'][0]['Metrics'].should.contain({'Name': 'CopyDuration', 'Unit': 'Seconds'})
+    metrics_service.record_estimate(metrics, {'Predicted': 600.04, 'Actual': 720})
+    metrics_service.record_estimate(metrics, None)
+    metrics.values()['CopyPredictedDuration'].should.equal([600.0])
+    metrics.values()['CopyActualDuration'].should.equal([720])
+    metrics.reset()
+    metrics.values().should.be.empty
+
+
+__all__ = ['sure']  # trick linting to consider python sure by exporting it
@@ -0,0 +1,71 @@
+from datetime import datetime
+
+import sure
+from mock import MagicMock
+
+from rdsplan import plan_backups
+
+
+def snapshot(snapshot_id, instance, day, status='available'):
+    return {'DBSnapshotIdentifier': snapshot_id,
+            'DBInstanceIdentifier': instance,
+            'Status': status,
+            'SnapshotCreateTime': datetime(2017, 11, day)}
+
+
+def inventory_of(automated, manual):
+    inventory = MagicMock()
+    inventory.snapshots.side_effect = lambda instance, snapshot_type: \
+        automated if snapshot_type == 'automated' else manual
+    return inventory
+
+
+def failsafe_name(name_of_automated_snapshot):
+    return 'failsafe-' + name_of_automated_snapshot[4:]
+
+
+AUTOMATED = [snapshot('rds:database-1-2017-11-25', 'database_1', 25),
+             snapshot('rds:database-1-2017-11-26', 'database_1', 26),
+             snapshot('rds:database-1-2017-11-27', 'database_1', 27, 'creating'),
+             snapshot('rds:database-2-2017-11-26', 'database_2', 26)]
+MANUAL = [snapshot('failsafe-database-1-2017-11-25', 'database_1', 25),
+          snapshot('manual-database-1-2017-11-25', 'database_1', 25),
+          snapshot('failsafe-database-2-2017-11-26', 'database_2', 26, 'copying')]
+
+
+def test_full_mode_deletes_the_old_failsafe_snapshots_before_the_copy():
+    plan = plan_backups(['database_1', 'database_2', 'database_3'], inventory_of(AUTOMATED, MANUAL),
+                        failsafe_name, 'failsafe-')
+    [(action.kind, action.snapshot, action.source) for action in plan.actions['database_1']].should.equal([
+        ('delete', 'failsafe-database-1-2017-11-25', None),
+        ('copy', 'failsafe-database-1-2017-11-26', 'rds:database-1-2017-11-26'),
+        ('share', 'failsafe-database-1-2017-11-26', None),
+        ('notify', 'failsafe-database-1-2017-11-26', None)])
+    plan.deletes_before_copy('database_1').should.equal(['failsafe-database-1-2017-11-25'])
+    plan.deletes_after_copy('database_1').should.equal([])
+    plan.skipped.should.equal({'database_2': 'Copy of failsafe-database-2-2017-11-26 in progress',
+                               'database_3': 'No available automated snapshot'})
+    plan.instances.should.equal(['database_1', 'database_2', 'database_3'])
+    dict(plan.as_dict()).should.equal({'Deletes': 1, 'Copies': 1, 'Shares': 1, 'Notifications': 1, 'Skipped': 2})
+
+
+def test_incremental_mode_deletes_the_old_failsafe_snapshots_after_the_copy():
+    plan = plan_backups(['database_1'], inventory_of(AUTOMATED, MANUAL), failsafe_name, 'failsafe-',
+                        incremental=True)
+    [action.kind for action in plan.actions['database_1']].should.equal(['copy', 'delete', 'share', 'notify'])
+    plan.deletes_before_copy('database_1').should.equal([])
+    plan.deletes_after_copy('database_1').should.equal(['failsafe-database-1-2017-11-25'])
+
+
+def test_available_failsafe_snapshot_is_shared_again_without_a_copy():
+    manual = MANUAL + [snapshot('failsafe-database-1-2017-11-26', 'database_1', 26)]
+    plan = plan_backups(['database_1'], inventory_of(AUTOMATED, manual), failsafe_name, 'failsafe-',
+                        incremental=True)
+    plan.describe().should.equal([
+        'delete  database_1                     failsafe-database-1-2017-11-25',
+        'share   database_1                     failsafe-database-1-2017-11-26',
+        'notify  database_1                     failsafe-database-1-2017-11-26'])
+    plan.deletes_before_copy('database_1').should.equal(['failsafe-database-1-2017-11-25'])
+
+
+__all__ = ['sure']
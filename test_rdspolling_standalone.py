@@ -0,0 +1,62 @@
+import pytest
+import sure
+from mock import MagicMock
+
+import rdspolling as polling_service
+
+
+def get_context(remaining_millis):
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = remaining_millis
+    return context
+
+
+def test_intervals_back_off_exponentially_within_jitter():
+    sleep = MagicMock()
+    schedule = polling_service.PollingSchedule(initial_interval=4, max_interval=20, multiplier=2, sleep=sleep)
+    for _ in range(5):
+        schedule.wait()
+    upper_bounds = [4, 8, 16, 20, 20]
+    for (interval,), _ in sleep.call_args_list:
+        upper_bound = upper_bounds.pop(0)
+        interval.should.be.within(upper_bound / 2.0, upper_bound)
+
+
+def test_schedule_without_context_has_no_deadline():
+    polling_service.PollingSchedule().remaining_seconds().should.be.none
+
+
+def test_wait_sleeps_the_interval_it_is_given():
+    sleep = MagicMock()
+    schedule = polling_service.PollingSchedule(get_context(900000), sleep=sleep)
+    schedule.wait(300)
+    sleep.assert_called_once_with(300)
+    schedule.wait.when.called_with(900).should.throw(polling_service.DeadlineExceeded)
+
+
+def test_wait_raises_deadline_exceeded_before_the_timeout():
+    sleep = MagicMock()
+    schedule = polling_service.PollingSchedule(get_context(20000), initial_interval=10, safety_margin=15,
+                                               sleep=sleep)
+    schedule.wait.when.called_with().should.throw(polling_service.DeadlineExceeded)
+    sleep.assert_not_called()
+
+
+def test_poll_until_returns_first_truthy_result():
+    check = MagicMock(side_effect=[False, None, 'available'])
+    schedule = polling_service.PollingSchedule(get_context(300000), sleep=MagicMock())
+    polling_service.poll_until(check, schedule).should.equal('available')
+    schedule.attempts.should.equal(3)
+
+
+def test_poll_until_stops_when_time_runs_out():
+    context = MagicMock()
+    context.get_remaining_time_in_millis.side_effect = [300000, 100000, 1000]
+    check = MagicMock(return_value=False)
+    schedule = polling_service.PollingSchedule(context, sleep=MagicMock())
+    with pytest.raises(polling_service.DeadlineExceeded):
+        polling_service.poll_until(check, schedule)
+    check.call_count.should.equal(2)
+
+
+__all__ = ['sure']  # trick linting to consider python sure by exporting it
@@ -0,0 +1,60 @@
+import sure
+from mock import MagicMock
+
+import rdsprogress as progress_service
+import rdsstate
+
+
+def copying(percent, allocated_storage=100, instance='failsafe_database_1', snapshot_id='failsafe-snapshot-1'):
+    return {'DBSnapshotIdentifier': snapshot_id, 'DBInstanceIdentifier': instance, 'Status': 'creating',
+            'PercentProgress': percent, 'AllocatedStorage': allocated_storage}
+
+
+def available(allocated_storage=100, instance='failsafe_database_1', snapshot_id='failsafe-snapshot-1'):
+    return dict(copying(100, allocated_storage, instance, snapshot_id), Status='available')
+
+
+def estimator_at(now=0, history=None):
+    return progress_service.CopyProgressEstimator(history, clock=MagicMock(return_value=now))
+
+
+def test_rate_is_fitted_to_the_progress_samples():
+    estimator = estimator_at()
+    estimator.start('failsafe-snapshot-1')
+    for now, percent in ((100, 10), (200, 20), (300, 31)):
+        estimator.clock.return_value = now
+        estimator.observe(copying(percent))
+    estimator.remaining('failsafe-snapshot-1').should.be.within(640, 660)
+
+
+def test_no_estimate_without_progress_or_history():
+    estimator = estimator_at()
+    estimator.start('failsafe-snapshot-1')
+    estimator.remaining('failsafe-snapshot-1').should.be.none
+    estimator.observe(copying(0))
+    estimator.clock.return_value = 100
+    estimator.observe(copying(0))
+    estimator.remaining('failsafe-snapshot-1').should.be.none
+    estimator.remaining('failsafe-snapshot-2').should.be.none
+
+
+def test_past_copies_of_the_instance_predict_the_next_one(tmp_path):
+    history = rdsstate.open_store(str(tmp_path / 'history.json'))
+    estimator = estimator_at(history=history)
+    estimator.start('failsafe-snapshot-1')
+    estimator.clock.return_value = 1000
+    estimator.complete(available()).should.equal({'Predicted': None, 'Actual': 1000})
+    history.get('rate:failsafe_database_1').should.equal(10)
+    estimator = estimator_at(2000, rdsstate.open_store(str(tmp_path / 'history.json')))
+    estimator.start('failsafe-snapshot-2')
+    estimator.observe(copying(0, allocated_storage=200, snapshot_id='failsafe-snapshot-2'))
+    estimator.remaining('failsafe-snapshot-2').should.equal(2000)
+    estimator.clock.return_value = 5000
+    estimator.complete(available(200, snapshot_id='failsafe-snapshot-2')) \
+        .should.equal({'Predicted': 2000, 'Actual': 3000})
+    estimator.outcome('failsafe-snapshot-2').should.equal({'Predicted': 2000, 'Actual': 3000})
+    estimator.outcome('failsafe-snapshot-2').should.be.none
+    history.get('rate:failsafe_database_1').should.equal(12.5)
+
+
+__all__ = ['sure']
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+
+import pytest
+import sure
+from mock import MagicMock
+
+import rdsretention as retention_service
+import rdsstate
+
+
+def failsafe_snapshots(instance, days, newest=datetime(2017, 11, 26, 18), status='available'):
+    return [{'DBSnapshotIdentifier': 'failsafe-{}-{:%Y-%m-%d}'.format(instance, newest - timedelta(age)),
+             'DBInstanceIdentifier': instance,
+             'SnapshotType': 'manual',
+             'Status': status,
+             'SnapshotCreateTime': newest - timedelta(age)}
+            for age in range(days)]
+
+
+def test_policy_keeps_newest_snapshot_of_each_period():
+    policy = retention_service.RetentionPolicy(daily=3, weekly=2, monthly=2, yearly=1)
+    kept = policy.keep(failsafe_snapshots('failsafe_database', 90))
+    sorted(kept).should.equal(['failsafe-failsafe_database-2017-10-31',
+                               'failsafe-failsafe_database-2017-11-19',
+                               'failsafe-failsafe_database-2017-11-24',
+                               'failsafe-failsafe_database-2017-11-25',
+                               'failsafe-failsafe_database-2017-11-26'])
+    kept['failsafe-failsafe_database-2017-11-26'].should.equal(['daily', 'weekly', 'monthly', 'yearly'])
+
+
+def test_policy_must_keep_a_daily_snapshot():
+    with pytest.raises(ValueError):
+        retention_service.RetentionPolicy(daily=0)
+
+
+def test_plan_covers_every_instance_and_spares_other_snapshots():
+    policy = retention_service.RetentionPolicy(daily=2, weekly=0, monthly=0, yearly=0)
+    snapshots = failsafe_snapshots('failsafe_database_1', 4) + failsafe_snapshots('failsafe_database_2', 3) + \
+        failsafe_snapshots('failsafe_database_2', 1, datetime(2017, 11, 27), 'creating') + \
+        [{'DBSnapshotIdentifier': 'before-upgrade', 'DBInstanceIdentifier': 'failsafe_database_1',
+          'Status': 'available', 'SnapshotCreateTime': datetime(2017, 1, 1)}]
+    kept, expired = retention_service.plan_retention(snapshots, policy)
+    len(kept).should.equal(4)
+    expired.should.equal(['failsafe-failsafe_database_1-2017-11-24', 'failsafe-failsafe_database_1-2017-11-23',
+                          'failsafe-failsafe_database_2-2017-11-24'])
+
+
+def test_apply_retention_reads_one_listing_and_deletes_in_bulk():
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': failsafe_snapshots('failsafe_database_1', 10) +
+                                                             failsafe_snapshots('failsafe_database_2', 10)}
+    policy = retention_service.RetentionPolicy(daily=7, weekly=0, monthly=0, yearly=0)
+    summary = retention_service.apply_retention(rds, policy)
+    summary.as_dict().should.equal({'Deleted': 6, 'Skipped': 0, 'Failed': 0})
+    rds.describe_db_snapshots.assert_called_once_with(SnapshotType='manual', IncludeShared=True, MaxRecords=100)
+    rds.delete_db_snapshot.call_count.should.equal(6)
+
+
+def listing(*snapshots):
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [snapshot for group in snapshots for snapshot in group]}
+    return rds
+
+
+def clock_at(*date):
+    return MagicMock(return_value=datetime(*date).timestamp())
+
+
+def test_incremental_run_only_evaluates_instances_with_new_snapshots(tmp_path):
+    store = rdsstate.open_store(str(tmp_path / 'retention.json'))
+    policy = retention_service.RetentionPolicy(daily=7, weekly=0, monthly=0, yearly=0)
+    first = listing(failsafe_snapshots('failsafe_database_1', 8), failsafe_snapshots('failsafe_database_2', 8))
+    retention_service.apply_retention(first, policy, store=store,
+                                      clock=clock_at(2017, 11, 26, 20)).as_dict()['Deleted'].should.equal(2)
+    policy.keep = MagicMock(side_effect=policy.keep)
+    unchanged = listing(failsafe_snapshots('failsafe_database_1', 7), failsafe_snapshots('failsafe_database_2', 7))
+    retention_service.apply_retention(unchanged, policy, store=store,
+                                      clock=clock_at(2017, 11, 26, 21)).as_dict()['Deleted'].should.equal(0)
+    policy.keep.assert_not_called()
+    newer = listing(failsafe_snapshots('failsafe_database_1', 8, datetime(2017, 11, 27, 18)),
+                    failsafe_snapshots('failsafe_database_2', 7))
+    retention_service.apply_retention(newer, policy, store=store, clock=clock_at(2017, 11, 27, 20))
+    newer.delete_db_snapshot.assert_called_once_with(DBSnapshotIdentifier='failsafe-failsafe_database_1-2017-11-20')
+    policy.keep.call_count.should.equal(2)
+    store.get('high_water_mark').should.equal(datetime(2017, 11, 27, 18).timestamp())
+    retention_service.apply_retention(listing(failsafe_snapshots('failsafe_database_1', 7, datetime(2017, 11, 27, 18)),
+                                              failsafe_snapshots('failsafe_database_2', 7)),
+                                      policy, store=store, clock=clock_at(2017, 11, 27, 21))
+    policy.keep.call_count.should.equal(2)
+
+
+def test_manifest_recorded_under_another_policy_is_reviewed_in_full(tmp_path):
+    store = rdsstate.open_store(str(tmp_path / 'retention.sqlite'))
+    snapshots = failsafe_snapshots('failsafe_database_1', 8)
+    retention_service.apply_retention(listing(snapshots[:7]), retention_service.RetentionPolicy(7, 0, 0, 0),
+                                      store=store)
+    rds = listing(snapshots[:7])
+    retention_service.apply_retention(rds, retention_service.RetentionPolicy(5, 0, 0, 0), store=store)
+    rds.delete_db_snapshot.call_count.should.equal(2)
+    sorted(key for key in store.items() if key.startswith('review:')).should.have.length_of(5)
+
+
+def test_kept_snapshot_is_due_when_it_would_leave_the_keep_set():
+    policy = retention_service.RetentionPolicy(daily=7, weekly=4, monthly=0, yearly=0)
+    snapshot = failsafe_snapshots('failsafe_database_1', 1)[0]
+    policy.expiry(snapshot, ['daily']).should.equal(datetime(2017, 12, 3).timestamp())
+    policy.expiry(snapshot, ['daily', 'weekly']).should.equal(datetime(2017, 12, 18).timestamp())
+
+
+__all__ = ['sure']
@@ -0,0 +1,133 @@
+from datetime import datetime, timezone
+from importlib import reload
+
+import pytest
+import sure
+from botocore.exceptions import ClientError
+
+import rdscopysnapshots as copy_service
+import rdssavesnapshot as save_service
+from rdscontinuation import FakeInvoker
+from rdssimulator import RdsSimulator, Simulation, VirtualClock
+
+SOURCE_ACCOUNT_ID = '129000003686'
+START = datetime(2017, 11, 26, 18, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def fresh_services():
+    reload(copy_service)
+    reload(save_service)
+    yield
+    reload(copy_service)
+    reload(save_service)
+
+
+def account(**options):
+    rds = RdsSimulator(VirtualClock(START), SOURCE_ACCOUNT_ID, **options)
+    rds.add_instance('failsafe_database', allocated_storage=500)
+    return rds, rds.add_snapshot('failsafe_database')
+
+
+def error_code(call, **arguments):
+    with pytest.raises(ClientError) as error:
+        call(**arguments)
+    return error.value.response['Error']['Code']
+
+
+def test_copy_takes_time_proportional_to_the_allocated_storage():
+    rds, automated = account(copy_base_seconds=0, copy_seconds_per_gib=10, listing_delay=0)
+    copied = rds.copy_db_snapshot(SourceDBSnapshotIdentifier=automated,
+                                  TargetDBSnapshotIdentifier='failsafe-1')['DBSnapshot']
+    copied['Status'].should.equal('creating')
+    copied['AllocatedStorage'].should.equal(500)
+    rds.clock.sleep(2500)
+    snapshot = rds.describe_db_snapshots(DBSnapshotIdentifier='failsafe-1')['DBSnapshots'][0]
+    snapshot['Status'].should.equal('creating')
+    snapshot['PercentProgress'].should.equal(50)
+    rds.clock.sleep(2500)
+    rds.status('failsafe-1').should.equal('available')
+    rds.copy_db_snapshot(SourceDBSnapshotIdentifier=automated, TargetDBSnapshotIdentifier='failsafe-2')
+    rds.clock.sleep(500)
+    rds.status('failsafe-2').should.equal('available')
+
+
+def test_copies_over_the_account_limit_are_refused():
+    rds, automated = account(max_concurrent_copies=2)
+    for target in ('failsafe-1', 'failsafe-2'):
+        rds.copy_db_snapshot(SourceDBSnapshotIdentifier=automated, TargetDBSnapshotIdentifier=target)
+    error_code(rds.copy_db_snapshot, SourceDBSnapshotIdentifier=automated,
+               TargetDBSnapshotIdentifier='failsafe-3').should.equal('SnapshotQuotaExceeded')
+    error_code(rds.copy_db_snapshot, SourceDBSnapshotIdentifier=automated,
+               TargetDBSnapshotIdentifier='failsafe-1').should.equal('DBSnapshotAlreadyExists')
+    error_code(rds.delete_db_snapshot, DBSnapshotIdentifier='failsafe-1').should.equal('InvalidDBSnapshotState')
+
+
+def test_calls_over_the_rate_limit_are_throttled():
+    rds, _ = account(rate=1, burst=2, max_attempts=1)
+    rds.describe_db_instances()
+    rds.describe_db_instances()
+    error_code(rds.describe_db_instances).should.equal('Throttling')
+    rds.clock.sleep(1)
+    rds.describe_db_instances()['DBInstances'].should.have.length_of(1)
+    rds.max_attempts = 5
+    rds.describe_db_instances()['DBInstances'].should.have.length_of(1)
+    rds.throttles['DescribeDBInstances'].should.be.greater_than(1)
+    rds.clock.elapsed().should.be.greater_than(1)
+
+
+def test_listings_are_eventually_consistent():
+    rds, automated = account(listing_delay=2, deletion_seconds=30, copy_seconds_per_gib=0)
+    rds.copy_db_snapshot(SourceDBSnapshotIdentifier=automated, TargetDBSnapshotIdentifier='failsafe-1')
+    rds.describe_db_snapshots(SnapshotType='manual')['DBSnapshots'].should.be.empty
+    rds.describe_db_snapshots(DBSnapshotIdentifier='failsafe-1')['DBSnapshots'].should.have.length_of(1)
+    rds.clock.sleep(60)
+    rds.delete_db_snapshot(DBSnapshotIdentifier='failsafe-1')
+    [snapshot['Status'] for snapshot in rds.describe_db_snapshots(SnapshotType='manual')['DBSnapshots']] \
+        .should.equal(['deleting'])
+    rds.clock.sleep(30)
+    rds.describe_db_snapshots(SnapshotType='manual')['DBSnapshots'].should.be.empty
+    error_code(rds.describe_db_snapshots, DBSnapshotIdentifier='failsafe-1').should.equal('DBSnapshotNotFound')
+
+
+def test_shared_snapshot_is_listed_and_copied_by_arn():
+    simulation = Simulation(VirtualClock(START), listing_delay=0, copy_seconds_per_gib=0)
+    source = simulation.rds(SOURCE_ACCOUNT_ID)
+    source.add_instance('failsafe_database')
+    source.add_snapshot('failsafe_database', 'failsafe-1', snapshot_type='manual')
+    failsafe = simulation.rds('2352525252332')
+    failsafe.describe_db_snapshots(SnapshotType='shared')['DBSnapshots'].should.be.empty
+    source.modify_db_snapshot_attribute(DBSnapshotIdentifier='failsafe-1', AttributeName='restore',
+                                        ValuesToAdd=['2352525252332'])
+    arn = 'arn:aws:rds:ap-southeast-2:129000003686:snapshot:failsafe-1'
+    [snapshot['DBSnapshotIdentifier'] for snapshot in
+     failsafe.describe_db_snapshots(SnapshotType='shared')['DBSnapshots']].should.equal([arn])
+    failsafe.copy_db_snapshot(SourceDBSnapshotIdentifier=arn, TargetDBSnapshotIdentifier='failsafe-1')
+    failsafe.describe_db_snapshots(DBSnapshotIdentifier='failsafe-1')['DBSnapshots'][0]['DBInstanceIdentifier'] \
+        .should.equal('failsafe_database')
+
+
+def test_hours_long_backup_completes_through_continuations():
+    simulation = Simulation(VirtualClock(START))
+    source = simulation.rds(SOURCE_ACCOUNT_ID)
+    source.add_instance('failsafe_database', allocated_storage=250, tags={'Failsafe': 'true'})
+    source.add_snapshot('failsafe_database', 'rds:failsafe-database-2017-11-26')
+    topic_arn = simulation.sns(SOURCE_ACCOUNT_ID).create_topic(Name=copy_service.SNS_RDS_SAVE_TOPIC)['TopicArn']
+    simulation.install(copy_service, SOURCE_ACCOUNT_ID)
+    copy_service.continuation_invoker = FakeInvoker()
+    simulation.run(copy_service.handler, {'detail-type': 'Scheduled Event', 'source': 'aws.events'}) \
+        .should.equal([{'Instance': 'failsafe_database', 'Status': 'pending',
+                        'FailsafeSnapshotID': 'failsafe-failsafe-database-2017-11-26'}])
+    results = simulation.run_continuations(copy_service.continuation_invoker, copy_service.handler)
+    results[-1][0]['Status'].should.equal('completed')
+    simulation.install(save_service, copy_service.FAILSAFE_ACCOUNT_ID)
+    save_service.continuation_invoker = FakeInvoker()
+    simulation.run(save_service.handler, simulation.sns(SOURCE_ACCOUNT_ID).take_event(topic_arn))
+    results = simulation.run_continuations(save_service.continuation_invoker, save_service.handler)
+    results[-1][0]['Status'].should.equal('saved')
+    simulation.rds(copy_service.FAILSAFE_ACCOUNT_ID).status('failsafe-failsafe-database-2017-11-26') \
+        .should.equal('available')
+    simulation.clock.elapsed().should.be.greater_than(2 * 3600)
+
+
+__all__ = ['sure']
@@ -0,0 +1,32 @@
+import pytest
+import sure
+
+import rdsstate as state_service
+
+
+@pytest.fixture(params=['state.json', 'state.sqlite'])
+def store(request, tmp_path):
+    return state_service.open_store(str(tmp_path / request.param))
+
+
+def test_store_keeps_values_between_instances(store):
+    store.items().should.equal({})
+    store.update({'high_water_mark': 1511719200.0, 'review:failsafe-snapshot-1': 1512324000.0})
+    reopened = state_service.open_store(store.path)
+    reopened.get('high_water_mark').should.equal(1511719200.0)
+    reopened.get('review:failsafe-snapshot-2', 0).should.equal(0)
+
+
+def test_store_removes_keys_in_the_same_update(store):
+    store.update({'review:failsafe-snapshot-1': 1, 'review:failsafe-snapshot-2': 2})
+    store.update({'review:failsafe-snapshot-3': 3}, removed=['review:failsafe-snapshot-1'])
+    store.items().should.equal({'review:failsafe-snapshot-2': 2, 'review:failsafe-snapshot-3': 3})
+
+
+def test_store_is_off_without_location():
+    state_service.open_store('').should.be.none
+    state_service.open_store('/tmp/state.json').should.be.a(state_service.JsonFileStore)
+    state_service.open_store('/tmp/state.db').should.be.a(state_service.SqliteStore)
+
+
+__all__ = ['sure']
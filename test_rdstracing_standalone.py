@@ -0,0 +1,95 @@
+import json
+import threading
+
+import sure
+from mock import MagicMock
+
+import rdstracing as tracing_service
+
+
+class ListExporter(object):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+def test_spans_of_a_handler_share_its_trace_and_nest():
+    exporter = ListExporter()
+    tracer = tracing_service.Tracer(exporter)
+
+    @tracing_service.traced_handler(tracer, 'rdscopysnapshots')
+    def handler(event, context):
+        with tracer.span('backup', instance='failsafe-database-1'):
+            with tracer.span('share', snapshot='failsafe-snapshot-1') as span:
+                span.set_attribute('attempts', 1)
+
+    handler({}, None)
+    share, backup, root = exporter.spans
+    root.name.should.equal('rdscopysnapshots')
+    root.parent_span_id.should.be.none
+    backup.parent_span_id.should.equal(root.span_id)
+    share.parent_span_id.should.equal(backup.span_id)
+    set([root.trace_id, backup.trace_id, share.trace_id]).should.have.length_of(1)
+    share.attributes.should.equal({'snapshot': 'failsafe-snapshot-1', 'attempts': 1})
+    share.duration_ms().should.be.greater_than_or_equal_to(0)
+
+
+def test_failed_phase_is_recorded_with_error_status():
+    exporter = ListExporter()
+    tracer = tracing_service.Tracer(exporter)
+
+    def fail():
+        with tracer.span('copy'):
+            raise ValueError('quota exceeded')
+
+    fail.when.called_with().should.throw(ValueError)
+    exporter.spans[0].status.should.equal({'code': 'ERROR', 'message': 'ValueError: quota exceeded'})
+
+
+def test_spans_of_worker_threads_are_children_of_the_handler_span():
+    exporter = ListExporter()
+    tracer = tracing_service.Tracer(exporter)
+
+    @tracing_service.traced_handler(tracer, 'rdscopysnapshots')
+    def handler(event, context):
+        def backup():
+            with tracer.span('backup'):
+                pass
+        workers = [threading.Thread(target=backup) for _ in range(3)]
+        [worker.start() for worker in workers]
+        [worker.join() for worker in workers]
+
+    handler({}, None)
+    root = exporter.spans[-1]
+    [span.parent_span_id for span in exporter.spans[:-1]].should.equal([root.span_id] * 3)
+
+
+def test_tracing_is_off_without_exporter():
+    tracer = tracing_service.Tracer()
+    handler = MagicMock(return_value='done')
+    tracing_service.traced_handler(tracer, 'rdssavesnapshot')(handler)({}, None).should.equal('done')
+    with tracer.span('save') as span:
+        span.set_attribute('instance', 'failsafe-database-1')
+    tracer.trace_id.should.be.none
+
+
+def test_file_exporter_appends_json_lines(tmp_path):
+    destination = str(tmp_path / 'spans.jsonl')
+    tracer = tracing_service.Tracer(tracing_service.JsonLinesExporter(destination),
+                                    clock=MagicMock(side_effect=[1511719200, 1511719201.5]))
+    with tracer.span('wait', snapshot='failsafe-snapshot-1'):
+        pass
+    with open(destination) as spans:
+        lines = spans.read().splitlines()
+    lines.should.have.length_of(1)
+    span = json.loads(lines[0])
+    span['name'].should.equal('wait')
+    span['durationMs'].should.equal(1500.0)
+    span['startTimeUnixNano'].should.equal(1511719200 * 10 ** 9)
+    span['attributes'].should.equal({'snapshot': 'failsafe-snapshot-1'})
+    span['status'].should.equal({'code': 'OK'})
+
+
+__all__ = ['sure']
@@ -0,0 +1,127 @@
+import itertools
+
+import pytest
+import sure
+from mock import MagicMock
+
+import rdswaiter as waiter_service
+from rdspolling import DeadlineExceeded
+from rdsprogress import CopyProgressEstimator
+
+
+def snapshot(snapshot_id, status):
+    return {'DBSnapshotIdentifier': snapshot_id, 'Status': status}
+
+
+def listing(*snapshots):
+    rds = MagicMock()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': list(snapshots)}
+    return rds
+
+
+def test_one_describe_per_tick_covers_every_snapshot():
+    rds = listing(snapshot('failsafe-1', 'available'), snapshot('failsafe-2', 'creating'))
+    waiter = waiter_service.SnapshotWaiter(rds)
+    first, second = waiter.watch('failsafe-1'), waiter.watch('failsafe-2')
+    waiter.tick()
+    rds.describe_db_snapshots.assert_called_once_with(
+        Filters=[{'Name': 'db-snapshot-id', 'Values': ['failsafe-1', 'failsafe-2']}], MaxRecords=100)
+    first.result(0).should.equal(snapshot('failsafe-1', 'available'))
+    second.done().should.be.false
+    waiter.pending().should.equal(['failsafe-2'])
+
+
+def test_failed_copy_is_reported_at_once():
+    waiter = waiter_service.SnapshotWaiter(listing(snapshot('failsafe-1', 'failed')))
+    future = waiter.watch('failsafe-1')
+    waiter.tick()
+    future.exception(0).should.be.a(waiter_service.SnapshotCopyFailed)
+    str(future.exception(0)).should.equal('Copy of snapshot failsafe-1 is failed')
+    waiter.pending().should.be.empty
+
+
+def test_vanished_snapshot_is_reported():
+    rds = listing(snapshot('failsafe-1', 'creating'))
+    waiter = waiter_service.SnapshotWaiter(rds, missing_ticks=3)
+    seen, never_listed = waiter.watch('failsafe-1'), waiter.watch('failsafe-2')
+    waiter.tick()
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': []}
+    waiter.tick()
+    seen.exception(0).should.be.a(waiter_service.SnapshotCopyFailed)
+    never_listed.done().should.be.false
+    waiter.tick()
+    never_listed.exception(0).should.be.a(waiter_service.SnapshotCopyFailed)
+
+
+def test_wait_completes_snapshots_of_other_threads_on_the_same_tick():
+    rds = listing(snapshot('failsafe-1', 'available'), snapshot('failsafe-2', 'available'))
+    waiter = waiter_service.SnapshotWaiter(rds, tick_interval=5, clock=MagicMock(side_effect=itertools.count(0, 5)),
+                                           sleep=MagicMock())
+    other = waiter.watch('failsafe-2')
+    waiter.wait('failsafe-1').should.equal(snapshot('failsafe-1', 'available'))
+    other.result(0).should.equal(snapshot('failsafe-2', 'available'))
+    rds.describe_db_snapshots.call_count.should.equal(1)
+
+
+def test_wait_gives_up_before_the_deadline():
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 10000
+    rds = listing(snapshot('failsafe-1', 'creating'))
+    waiter = waiter_service.SnapshotWaiter(rds, sleep=MagicMock())
+    with pytest.raises(DeadlineExceeded):
+        waiter.wait('failsafe-1', context)
+    waiter.pending().should.be.empty
+
+
+def test_wait_sleeps_until_the_predicted_completion():
+    clock = MagicMock(return_value=0)
+    rds = listing(dict(snapshot('failsafe-1', 'creating'), PercentProgress=10))
+    sleep = MagicMock(side_effect=lambda seconds: clock.configure_mock(return_value=clock.return_value + seconds))
+    waiter = waiter_service.SnapshotWaiter(rds, tick_interval=5, clock=clock, sleep=sleep,
+                                           estimator=CopyProgressEstimator(clock=clock))
+    waiter.watch('failsafe-1')
+    waiter.tick()
+    clock.return_value = 100
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [dict(snapshot('failsafe-1', 'creating'),
+                                                                   PercentProgress=20)]}
+    waiter.tick()
+    waiter.predicted_wait('failsafe-1').should.equal(800)
+    rds.describe_db_snapshots.return_value = {'DBSnapshots': [snapshot('failsafe-1', 'available')]}
+    waiter.wait('failsafe-1')['Status'].should.equal('available')
+    sleep.assert_called_once_with(800)
+    waiter.estimator.outcome('failsafe-1').should.equal({'Predicted': 900, 'Actual': 900})
+
+
+def test_copy_predicted_to_outlast_the_function_is_handed_off_at_once():
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 600000
+    estimator = MagicMock()
+    estimator.remaining.return_value = 3600
+    waiter = waiter_service.SnapshotWaiter(listing(), sleep=MagicMock(), estimator=estimator)
+    with pytest.raises(DeadlineExceeded):
+        waiter.wait('failsafe-1', context)
+    waiter.sleep.assert_not_called()
+
+
+def test_continued_wait_sleeps_until_the_deadline():
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 600000
+    estimator = MagicMock()
+    estimator.remaining.return_value = 3600
+    sleep = MagicMock(side_effect=lambda seconds: context.get_remaining_time_in_millis.configure_mock(
+        return_value=context.get_remaining_time_in_millis.return_value - seconds * 1000))
+    waiter = waiter_service.SnapshotWaiter(listing(snapshot('failsafe-1', 'creating')), sleep=sleep,
+                                           estimator=estimator)
+    with pytest.raises(DeadlineExceeded):
+        waiter.wait('failsafe-1', context, until_deadline=True)
+    sleep.assert_called_once_with(585)
+
+
+def test_registry_shares_one_waiter_per_client():
+    registry = waiter_service.WaiterRegistry()
+    rds = MagicMock()
+    registry.get(rds).should.be(registry.get(rds))
+    registry.get(MagicMock()).shouldnt.be(registry.get(rds))
+
+
+__all__ = ['sure']
@@ -0,0 +1,187 @@
+import json
+import threading
+import time
+from importlib import reload
+
+import pytest
+import sure
+from botocore.exceptions import EndpointConnectionError
+from mock import MagicMock
+
+import rdssavesnapshot as save_service
+import rdsstate
+from rdscontinuation import FakeInvoker
+from rdsdeletion import DeletionSummary
+from rdsledger import IdempotencyLedger
+from rdspolling import DeadlineExceeded
+
+
+@pytest.fixture(autouse=True)
+def fresh_save_service():
+    reload(save_service)
+    save_service.client = MagicMock()
+    yield
+    reload(save_service)
+
+
+def save_event(*snapshots):
+    return {'Records': [{
+        'EventSource': 'aws:sns',
+        'Sns': {'Message': json.dumps({'Instance': instance,
+                                       'FailsafeSnapshotID': snapshot_id})}}
+        for instance, snapshot_id in snapshots]}
+
+
+def test_every_record_is_saved_once():
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock()
+    results = save_service.handler(save_event(('failsafe_database_1', 'failsafe-snapshot-1'),
+                                              ('failsafe_database_2', 'failsafe-snapshot-2'),
+                                              ('failsafe_database_1', 'failsafe-snapshot-1')), None)
+    results.should.equal([
+        {'Instance': 'failsafe_database_1', 'FailsafeSnapshotID': 'failsafe-snapshot-1', 'Status': 'saved'},
+        {'Instance': 'failsafe_database_2', 'FailsafeSnapshotID': 'failsafe-snapshot-2', 'Status': 'saved'}])
+    sorted(call[0][2] for call in save_service.copy_manual_failsafe_snapshot_and_save.call_args_list) \
+        .should.equal(['failsafe-snapshot-1', 'failsafe-snapshot-2'])
+
+
+def test_failed_record_does_not_stop_the_batch():
+    def copy(rds, instance, snapshot_id, inventory, context):
+        if snapshot_id == 'failsafe-snapshot-1':
+            save_service.terminate_copy_manual_failsafe_snapshot()
+        return {'DBSnapshotIdentifier': snapshot_id}
+
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock(side_effect=copy)
+    save_service.handler.when.called_with(
+        save_event(('failsafe_database_1', 'failsafe-snapshot-1'),
+                   ('failsafe_database_2', 'failsafe-snapshot-2')), None) \
+        .should.throw(save_service.ClientException, 'Save of failsafe-snapshot-1 failed')
+    save_service.copy_manual_failsafe_snapshot_and_save.call_count.should.equal(2)
+
+
+def test_saves_run_concurrently_up_to_the_limit():
+    save_service.MAX_PARALLEL_SAVES = 2
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def copy(*args):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return {'DBSnapshotIdentifier': args[2]}
+
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock(side_effect=copy)
+    results = save_service.handler(save_event(*[('failsafe_database_{}'.format(number),
+                                                 'failsafe-snapshot-{}'.format(number))
+                                                for number in range(6)]), None)
+    [result['Status'] for result in results].should.equal(['saved'] * 6)
+    max(peak).should.equal(2)
+
+
+def test_repeated_record_is_not_saved_again(tmp_path):
+    save_service.ledger = IdempotencyLedger(
+        rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock(
+        return_value={'DBSnapshotIdentifier': 'failsafe-snapshot-1'})
+    event = save_event(('failsafe_database_1', 'failsafe-snapshot-1'))
+    save_service.handler(event, None)[0]['Status'].should.equal('saved')
+    save_service.handler(event, None)[0]['Status'].should.equal('duplicate')
+    save_service.copy_manual_failsafe_snapshot_and_save.call_count.should.equal(1)
+    save_service.ledger.get('failsafe-snapshot-1')['State'].should.equal('saved')
+
+
+def test_failed_save_releases_its_claim(tmp_path):
+    save_service.ledger = IdempotencyLedger(
+        rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock(return_value=None)
+    save_service.handler.when.called_with(save_event(('failsafe_database_1', 'failsafe-snapshot-1')), None) \
+        .should.throw(save_service.ClientException)
+    save_service.ledger.get('failsafe-snapshot-1').should.be.none
+
+
+def test_save_interrupted_by_a_connection_error_releases_its_claim(tmp_path):
+    save_service.ledger = IdempotencyLedger(
+        rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock(
+        side_effect=EndpointConnectionError(endpoint_url='https://rds.amazonaws.com'))
+    save_service.handler.when.called_with(save_event(('failsafe_database_1', 'failsafe-snapshot-1')), None) \
+        .should.throw(save_service.ClientException)
+    save_service.ledger.get('failsafe-snapshot-1').should.be.none
+
+
+def test_copy_outlasting_the_function_is_saved_by_a_continuation(tmp_path):
+    save_service.ledger = IdempotencyLedger(
+        rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    save_service.continuation_invoker = FakeInvoker()
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock(
+        side_effect=DeadlineExceeded('Deadline reached'))
+    save_service.wait_until_snapshot_is_available = MagicMock()
+    event = save_event(('failsafe_database_1', 'failsafe-snapshot-1'))
+    save_service.handler(event, None)[0]['Status'].should.equal('deferred')
+    save_service.continuation_invoker.payloads.should.equal([{'Continuation': {
+        'Pipeline': 'save', 'Phase': 'wait', 'Attempt': 1, 'CompletedPhases': ['copy'],
+        'Instance': 'failsafe_database_1', 'FailsafeSnapshotID': 'failsafe-snapshot-1'}}])
+    save_service.continuation_invoker.drain(save_service.handler).should.equal([[
+        {'Instance': 'failsafe_database_1', 'FailsafeSnapshotID': 'failsafe-snapshot-1', 'Status': 'saved'}]])
+    save_service.wait_until_snapshot_is_available.call_args[0][2].should.equal('failsafe-snapshot-1')
+    save_service.copy_manual_failsafe_snapshot_and_save.call_count.should.equal(1)
+    save_service.ledger.get('failsafe-snapshot-1')['State'].should.equal('saved')
+
+
+
+def test_copy_outlasting_the_function_fails_without_continuations(tmp_path):
+    save_service.ledger = IdempotencyLedger(
+        rdsstate.open_store(str(tmp_path / 'ledger.json')))
+    save_service.copy_quota = MagicMock()
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock(
+        side_effect=DeadlineExceeded('Deadline reached'))
+    save_service.handler.when.called_with(save_event(('failsafe_database_1', 'failsafe-snapshot-1')), None) \
+        .should.throw(save_service.ClientException, 'Save of failsafe-snapshot-1 failed')
+    save_service.ledger.get('failsafe-snapshot-1').should.be.none
+    save_service.copy_quota.release.assert_called_once_with('failsafe-snapshot-1')
+
+def test_records_batched_with_a_continuation_are_saved():
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock()
+    save_service.wait_until_snapshot_is_available = MagicMock()
+    event = save_event(('failsafe_database_1', 'failsafe-snapshot-1'))
+    event['Records'].insert(0, {'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps({'Continuation': {
+        'Pipeline': 'save', 'Phase': 'wait', 'Attempt': 1, 'CompletedPhases': ['copy'],
+        'Instance': 'failsafe_database_2', 'FailsafeSnapshotID': 'failsafe-snapshot-2'}})}})
+    save_service.handler(event, None).should.equal([
+        {'Instance': 'failsafe_database_2', 'FailsafeSnapshotID': 'failsafe-snapshot-2', 'Status': 'saved'},
+        {'Instance': 'failsafe_database_1', 'FailsafeSnapshotID': 'failsafe-snapshot-1', 'Status': 'saved'}])
+    save_service.copy_manual_failsafe_snapshot_and_save.call_count.should.equal(1)
+
+
+def test_available_local_copy_is_kept_in_incremental_mode():
+    save_service.FAILSAFE_COPY_MODE = save_service.COPY_MODE_INCREMENTAL
+    rds = MagicMock()
+    local_copy = {'DBSnapshotIdentifier': 'failsafe-snapshot-1', 'Status': 'available'}
+    save_service.copy_failsafe_snapshot = MagicMock()
+    save_service.data_of_copied_snapshot('failsafe-snapshot-1', 'failsafe_database_1', [local_copy], rds,
+                                         'arn:aws:rds:ap-southeast-2:129000003686:snapshot:failsafe-snapshot-1') \
+        .should.equal({'DBSnapshot': local_copy})
+    rds.delete_db_snapshot.assert_not_called()
+    save_service.copy_failsafe_snapshot.assert_not_called()
+
+
+def test_scheduled_event_runs_retention_instead_of_saves():
+    save_service.apply_retention = MagicMock(return_value=DeletionSummary())
+    save_service.copy_manual_failsafe_snapshot_and_save = MagicMock()
+    save_service.handler({'detail-type': 'Scheduled Event', 'source': 'aws.events'}, None) \
+        .should.equal({'Deleted': 0, 'Skipped': 0, 'Failed': 0})
+    save_service.apply_retention.assert_called_once()
+    save_service.copy_manual_failsafe_snapshot_and_save.assert_not_called()
+
+
+def test_empty_batch_is_reported():
+    save_service.logger = MagicMock()
+    save_service.handler({'Records': []}, None).should.equal([])
+    save_service.logger.info.assert_called_with('No instances tagged for RDS failsafe backup have been found...')
+    save_service.client.assert_not_called()
+
+
+__all__ = ['sure']
@@ -1,4 +1,3 @@
-import datetime
 import sure
 from boto3 import client
 from mock import MagicMock
@@ -61,61 +60,6 @@ def test_local_snapshot_deletion_required():
 
 
 
-@mock_rds2
-def test_evaluate_snapshot_age():
-    rds = client('rds', region_name='ap-southeast-2')
-    save_service.logger = MagicMock()
-    rds.create_db_instance(DBInstanceIdentifier='failsafe_database_5',
-                           AllocatedStorage=10,
-                           Engine='postgres',
-                           DBName='staging-postgres',
-                           DBInstanceClass='db.m1.small',
-                           LicenseModel='license-included',
-                           MasterUsername='root_failsafe',
-                           MasterUserPassword='hunter_failsafe',
-                           Port=3000,
-                           Tags=[
-                               {
-                                   'Key': 'Failsafe',
-                                   'Value': 'true'
-                               },
-                           ],
-                           DBSecurityGroups=["my_sg"])
-
-    rds.create_db_snapshot(DBSnapshotIdentifier='failsafe-snapshot-5', DBInstanceIdentifier='failsafe_database_5')
-    manual_snapshot = save_service.get_snapshots(rds, db_instance_id='failsafe_database_5', snapshot_type='manual')[0]
-    age = save_service.evaluate_snapshot_age(manual_snapshot)
-    age.days.should.be(-1)
-
-
-@mock_rds2
-def test_delete_expired_snapshots():
-    rds = client('rds', region_name='ap-southeast-2')
-    save_service.logger = MagicMock()
-    rds.create_db_instance(DBInstanceIdentifier='failsafe_database_5',
-                           AllocatedStorage=10,
-                           Engine='postgres',
-                           DBName='staging-postgres',
-                           DBInstanceClass='db.m1.small',
-                           LicenseModel='license-included',
-                           MasterUsername='root_failsafe',
-                           MasterUserPassword='hunter_failsafe',
-                           Port=3000,
-                           Tags=[
-                               {
-                                   'Key': 'Failsafe',
-                                   'Value': 'true'
-                               },
-                           ],
-                           DBSecurityGroups=["my_sg"])
-
-    rds.create_db_snapshot(DBSnapshotIdentifier='failsafe-snapshot-5', DBInstanceIdentifier='failsafe_database_5')
-    manual_snapshot = save_service.get_snapshots(rds, db_instance_id='failsafe_database_5', snapshot_type='manual')[0]
-    save_service.perform_delete = MagicMock()
-    save_service.delete_expired_snapshots(manual_snapshot, rds, datetime.timedelta(50))
-    save_service.perform_delete.assert_called()
-
-
 @mock_rds2
 def test_handler_prints_message_when_no_instance_with_tags_is_found():
     event = MagicMock()
@@ -129,7 +73,6 @@ def test_save_logs_warning_when_no_snapshot_is_shared():
     save_service.TESTING_HACK = True
     event = setup_event()
     save_service.get_snapshots = MagicMock(return_value=None)
-    save_service.delete_old_failsafe_manual_snapshots = MagicMock()
     save_service.logger = MagicMock()
     save_service.handler.when.called_with(event, None).should.have.raised(save_service.ClientException)
     save_service.logger.warn.assert_called_with('No shared snapshots found.')
@@ -140,9 +83,14 @@ def test_error_is_logged_if_shared_snapshot_is_not_found():
     rds = client('rds', region_name='ap-southeast-2')
     instance = 'some_db'
     failsafe_snapshot_id = 'some_snapshot_id'
+    listing = MagicMock()
+    listing.describe_db_snapshots.return_value = {'DBSnapshots': [{
+        'DBSnapshotIdentifier': 'arn:aws:rds:ap-southeast-2:129000003686:snapshot:some_snapshot_id-2',
+        'SnapshotType': 'shared'}]}
     save_service.get_snapshots = MagicMock()
     save_service.logger = MagicMock()
-    save_service.copy_manual_failsafe_snapshot_and_save(rds, instance, failsafe_snapshot_id)
+    save_service.copy_manual_failsafe_snapshot_and_save(rds, instance, failsafe_snapshot_id,
+                                                        save_service.SnapshotInventory(listing))
     save_service.logger.error.assert_called_with(
         'Shared snapshot with id ...:snapshot:{} failed to copy.'.format(failsafe_snapshot_id))
 
@@ -196,13 +144,12 @@ def test_end_to_end_method_called_in_correct_order():
     rds = client('rds', region_name='ap-southeast-2')
     event = setup_event()
     save_service.TESTING_HACK = True
-    save_service.delete_old_failsafe_manual_snapshots = MagicMock()
     m = MagicMock()
     save_service.get_snapshots = MagicMock(side_effect=get_snapshots)
     shared_snapshots = m.get_snapshots(rds, db_instance_id='', snapshot_type='shared')
     manual_snapshots = m.get_snapshots(rds, db_instance_id='failsafe_database_1', snapshot_type='shared')
-    save_service.re.search = MagicMock()
-    save_service.match_shared_snapshot_requiring_copy = MagicMock(return_value=True)
+    save_service.find_shared_snapshot = MagicMock(return_value={
+        'DBSnapshotIdentifier': 'arn:aws:rds:ap-southeast-2:129000003686:snapshot:failsafe-db-under-test-snap'})
     save_service.delete_duplicate_snapshots = MagicMock()
     save_service.read_test_notification_payload = MagicMock()
     save_service.copy_failsafe_snapshot = MagicMock()